@@ -12,6 +12,15 @@ export default {
   getStatus(hostname) {
     return Repository.get(`${resource}/${hostname}/status`);
   },
+  getAllStatus() {
+    return Repository.get(`${resource}/status`);
+  },
+  getEvents(hostname) {
+    return new EventSource(`${Repository.defaults.baseURL}${resource}/${hostname}/events`);
+  },
+  getAllEvents() {
+    return new EventSource(`${Repository.defaults.baseURL}${resource}/events`);
+  },
   create(payload) {
     return Repository.post(`${resource}`, payload);
   },
@@ -4,19 +4,27 @@ from flask import Flask, send_file, send_from_directory
 from flask_cors import CORS
 
 
-def create_app(db_path=None):
+def create_app(db_path=None, resume_jobs=False):
+    """
+    :param resume_jobs: True for the web server, to run the jobs left queued in the
+                        database when it starts (see JobQueue.resume) and the drift
+                        checks (see DriftScheduler.start).
+    """
     from .configuration import get_config, DATABASE_FILENAME
-    from .configuration.env import DIST_PATH, DATABASE_PATH
+    from .configuration.env import DIST_PATH, DATABASE_PATH, DATABASE_URI
     from .database import db
     from .resources.magic_castle_api import MagicCastleAPI
     from .resources.progress_api import ProgressAPI
+    from .resources.events_api import EventsAPI
     from .resources.available_resources_api import AvailableResourcesApi
     from .resources.user_api import UserAPI
     from .resources.project_api import ProjectAPI
     from .resources.template_api import TemplateAPI
+    from .resources.metrics_api import MetricsAPI
+    from .resources.warm_pool_api import WarmPoolAPI
 
     if db_path is None:
-        db_path = f"sqlite:///{DATABASE_PATH}/{DATABASE_FILENAME}"
+        db_path = DATABASE_URI or f"sqlite:///{DATABASE_PATH}/{DATABASE_FILENAME}"
     app = Flask(__name__)
     app.config["SQLALCHEMY_DATABASE_URI"] = db_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -46,14 +54,45 @@ def create_app(db_path=None):
         defaults={"apply": True},
         methods=["POST"],
     )
+    app.add_url_rule(
+        "/api/magic-castles/<string:hostname>/cancel",
+        view_func=magic_castle_view,
+        defaults={"cancel": True},
+        methods=["POST"],
+    )
+    app.add_url_rule(
+        "/api/magic-castles/<string:hostname>/preview",
+        view_func=magic_castle_view,
+        defaults={"preview": True},
+        methods=["POST"],
+    )
 
     progress_view = ProgressAPI.as_view("progress")
+    app.add_url_rule(
+        "/api/magic-castles/status",
+        view_func=progress_view,
+        defaults={"hostname": None},
+        methods=["GET"],
+    )
     app.add_url_rule(
         "/api/magic-castles/<string:hostname>/status",
         view_func=progress_view,
         methods=["GET"],
     )
 
+    events_view = EventsAPI.as_view("events")
+    app.add_url_rule(
+        "/api/magic-castles/events",
+        view_func=events_view,
+        defaults={"hostname": None},
+        methods=["GET"],
+    )
+    app.add_url_rule(
+        "/api/magic-castles/<string:hostname>/events",
+        view_func=events_view,
+        methods=["GET"],
+    )
+
     available_resources_view = AvailableResourcesApi.as_view("available_resources")
     app.add_url_rule(
         "/api/available-resources/host/<string:hostname>",
@@ -78,6 +117,9 @@ def create_app(db_path=None):
     user_view = UserAPI.as_view("user")
     app.add_url_rule("/api/users/me", view_func=user_view, methods=["GET"])
 
+    metrics_view = MetricsAPI.as_view("metrics")
+    app.add_url_rule("/api/metrics", view_func=metrics_view, methods=["GET"])
+
     project_view = ProjectAPI.as_view("projects")
     app.add_url_rule(
         "/api/projects",
@@ -90,6 +132,18 @@ def create_app(db_path=None):
         methods=["GET", "PATCH", "DELETE"],
     )
 
+    warm_pool_view = WarmPoolAPI.as_view("warm_pools")
+    app.add_url_rule(
+        "/api/projects/<int:id>/warm-pools",
+        view_func=warm_pool_view,
+        methods=["GET"],
+    )
+    app.add_url_rule(
+        "/api/projects/<int:id>/warm-pools/<string:name>",
+        view_func=warm_pool_view,
+        methods=["PUT", "DELETE"],
+    )
+
     @app.route("/css/<path:path>")
     def send_css_file(path):
         return send_from_directory(os_path.join(DIST_PATH, "css"), path)
@@ -110,4 +164,11 @@ def create_app(db_path=None):
         response.headers["Expires"] = "0"
         return response
 
+    if resume_jobs:
+        from .models.job.job_queue import JobQueue
+        from .models.job.drift_scheduler import DriftScheduler
+
+        JobQueue.resume(app)
+        DriftScheduler.start(app)
+
     return app
@@ -22,6 +22,27 @@ class ConfigurationSchema(Schema):
     dns_providers = fields.Dict()
     port = fields.Integer(load_default=5000)
     debug = fields.Boolean(load_default=True)
+    plan_workers = fields.Integer(load_default=4)
+    max_concurrent_applies = fields.Integer(load_default=4)
+    max_concurrent_applies_per_project = fields.Integer(load_default=2)
+    external_runners = fields.Boolean(load_default=False)
+    runner_lease_duration = fields.Integer(load_default=60)
+    terraform_cache = fields.Boolean(load_default=True)
+    workspace_pool_size = fields.Integer(load_default=2)
+    targeted_plans = fields.Boolean(load_default=True)
+    drift_detection_interval = fields.Integer(load_default=86400)
+    max_concurrent_drift_checks_per_project = fields.Integer(load_default=1)
+    default_parallelism = fields.Integer(load_default=10)
+    max_parallelism = fields.Integer(load_default=30)
+    cancel_timeout = fields.Integer(load_default=120)
+    terraform_memory_limit = fields.Integer(load_default=0)
+    terraform_cpu_limit = fields.Float(load_default=0)
+    terraform_cgroup = fields.Str(load_default="")
+    terraform_min_free_memory = fields.Integer(load_default=0)
+    terraform_timeout = fields.Integer(load_default=0)
+    plan_debounce = fields.Float(load_default=2)
+    keep_full_plan = fields.Boolean(load_default=False)
+    idempotency_key_ttl = fields.Integer(load_default=86400)
 
     # validation
     #         if AuthType.TOKEN in data["auth_type"] and data.get("token", "") == "":
@@ -5,4 +5,8 @@ RUN_PATH = environ.get("MCH_RUN_PATH", getcwd())
 CLUSTERS_PATH = environ.get("MCH_CLUSTERS_PATH", path.join(RUN_PATH, "clusters"))
 DIST_PATH = environ.get("MCH_DIST_PATH", path.join(RUN_PATH, "dist"))
 DATABASE_PATH = environ.get("MCH_DATABASE_PATH", path.join(RUN_PATH, "database"))
+DATABASE_URI = environ.get("MCH_DATABASE_URI")
+TERRAFORM_CACHE_PATH = environ.get(
+    "MCH_TERRAFORM_CACHE_PATH", path.join(RUN_PATH, "terraform-cache")
+)
 CONFIGURATION_FILE_PATH = environ.get("MCH_CONFIGURATION_FILE_PATH", RUN_PATH)
\ No newline at end of file
@@ -1,6 +1,18 @@
-from re import M
+import logging
+import sys
+
+from os import path
+from subprocess import Popen
+
 from ..models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
 from ..models.magic_castle.cluster_status_code import ClusterStatusCode
+from ..models.magic_castle.plan_type import PlanType
+from ..models.job.job import JobORM, utcnow
+from ..models.job.job_status_code import JobStatusCode
+from ..models.job.job_type import JobType
+from ..models.terraform.apply_journal import ApplyJournal
+from ..configuration import get_config
+from ..configuration import env
 from . import db
 
 
@@ -10,12 +22,66 @@ class CleanupManager:
         """Look for cluster status that are running and default
         back to a stable state. Applicable when booting the app
         when and there is definetely no state running.
+
+        Jobs held by a runner with a live lease are left untouched, as are
+        every queued or running job when external runners are enabled: the
+        runners claim the queued jobs and requeue the ones whose lease expired.
+
+        Applies whose terraform process is still running, according to their
+        journal, are reattached by a background process (`python -m mchub.reattach`).
+        The partial terraform state of the other interrupted applies is saved and
+        a new plan is queued to continue from it.
         """
+        busy = set()
+        reattached = []
+        now = utcnow()
+        for orm in JobORM.query.filter(
+            JobORM.status.in_([JobStatusCode.QUEUED, JobStatusCode.RUNNING])
+        ):
+            if get_config()["external_runners"] or (
+                orm.lease_expires is not None and orm.lease_expires > now
+            ):
+                busy.add(orm.hostname)
+                continue
+            if orm.type == JobType.APPLY and orm.status == JobStatusCode.RUNNING:
+                journal = ApplyJournal.read(path.join(env.CLUSTERS_PATH, orm.hostname))
+                if journal is not None and journal.is_alive():
+                    busy.add(orm.hostname)
+                    reattached.append(orm.id)
+                    continue
+            orm.status = JobStatusCode.ERROR
+            orm.finished = now
+            orm.message = "The job was interrupted by a restart of MC Hub."
+        interrupted = []
         for orm in MagicCastleORM.query.all():
-            if orm.status == ClusterStatusCode.BUILD_RUNNING:
-                orm.status = ClusterStatusCode.BUILD_ERROR
+            if orm.hostname in busy:
+                continue
+            if orm.status in (
+                ClusterStatusCode.BUILD_RUNNING,
+                ClusterStatusCode.DESTROY_RUNNING,
+            ):
+                interrupted.append(orm)
             elif orm.status == ClusterStatusCode.PLAN_RUNNING:
                 orm.status = ClusterStatusCode.CREATED
-            elif orm.status == ClusterStatusCode.DESTROY_RUNNING:
-                orm.status = ClusterStatusCode.DESTROY_ERROR
         db.session.commit()
+
+        for orm in interrupted:
+            try:
+                MagicCastle(orm).recover_apply()
+            except Exception as error:
+                logging.error(
+                    f"Could not recover the apply of {orm.hostname} - {error}"
+                )
+                db.session.rollback()
+                orm.status = (
+                    ClusterStatusCode.DESTROY_ERROR
+                    if orm.plan_type == PlanType.DESTROY
+                    else ClusterStatusCode.BUILD_ERROR
+                )
+                db.session.commit()
+        if reattached:
+            Popen(
+                [sys.executable, "-m", "mchub.reattach", *map(str, reattached)],
+                start_new_session=True,
+            )
+        return reattached
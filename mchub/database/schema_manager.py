@@ -0,0 +1,32 @@
+from sqlalchemy import inspect, text
+
+from . import db
+
+
+class SchemaManager:
+    @classmethod
+    def add_missing_columns(cls):
+        """Add the columns defined by the models that are missing from
+        the existing tables. db.create_all() creates the missing tables,
+        but leaves the tables that already exist untouched.
+
+        :return: The added columns, as "table.column" strings.
+        """
+        inspector = inspect(db.engine)
+        added = []
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+                added.append(f"{table.name}.{column.name}")
+        db.session.commit()
+        return added
@@ -46,3 +46,19 @@ class PlanException(ServerException):
         :param additional_details: Additional details which will be logged but not shown to the user.
         """
         super().__init__(message, additional_details=additional_details)
+
+
+class ApplyException(ServerException):
+    def __init__(
+        self,
+        message: str = "An error occurred when applying changes.",
+        *,
+        additional_details: str = "",
+    ):
+        """
+        Instantiates an exception related to an error happening during the cluster apply phase.
+
+        :param message: The error message, which will be logged and displayed to the user.
+        :param additional_details: Additional details which will be logged but not shown to the user.
+        """
+        super().__init__(message, additional_details=additional_details)
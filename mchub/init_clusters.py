@@ -2,40 +2,166 @@
 main.tf.json have their plugin folder correctly initialized. To do
 this, we scan the clusters folder and call terraform init in each
 folder with a main.tf.json.
+
+Folders are initialized in parallel. A folder is skipped when its
+installed modules match the module sources of its main.tf.json and
+it was initialized for the current Magic Castle version and dependency
+lock file, unless --upgrade is given.
 """
 
 import argparse
+import json
+import logging
 
+from concurrent.futures import ThreadPoolExecutor
 from os import scandir, path
-from subprocess import run
-from logging import getLogger
-from sys import exit
+from subprocess import CalledProcessError
+from time import monotonic
 
 from .configuration.env import CLUSTERS_PATH
+from .configuration.magic_castle import MAIN_TERRAFORM_FILENAME
+from .models.terraform.terraform_cache import (
+    TerraformCache,
+    INIT_MARKER_FILENAME,
+    TERRAFORM_DATA_DIRNAME,
+)
+from .models.terraform.terraform_process import run
+from .models.terraform.workspace_pool import WorkspacePool
+
+MODULES_MANIFEST = path.join(TERRAFORM_DATA_DIRNAME, "modules", "modules.json")
+
+INITIALIZED = "initialized"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+def is_initialized(cluster_path):
+    """
+    :return: True if the modules installed in the cluster's folder match the module
+             sources of its main.tf.json, and the folder was initialized for the current
+             Magic Castle version, path and dependency lock file. Local module sources
+             (e.g. `./openstack`) stay the same across Magic Castle versions, hence the
+             version is checked with the key written when the folder was initialized.
+    """
+    try:
+        modules = TerraformCache.get_modules(
+            path.join(cluster_path, MAIN_TERRAFORM_FILENAME)
+        )
+        with open(path.join(cluster_path, MODULES_MANIFEST)) as file:
+            installed = {
+                module["Key"]: module.get("Source")
+                for module in json.load(file)["Modules"]
+            }
+        with open(
+            path.join(cluster_path, TERRAFORM_DATA_DIRNAME, INIT_MARKER_FILENAME)
+        ) as file:
+            init_key = file.read()
+        current_init_key = TerraformCache.get_init_key(cluster_path)
+    except (OSError, KeyError, ValueError):
+        return False
+    return init_key == current_init_key and all(
+        installed.get(name) == source for name, source in modules.items()
+    )
+
+
+def init_cluster(cluster_path, upgrade=False):
+    """
+    Initializes a cluster's folder, from the terraform cache when possible.
+
+    :return: The outcome (initialized, skipped or failed), the time it took in seconds
+             and the error output of terraform init if it failed.
+    """
+    start = monotonic()
+    if not upgrade and is_initialized(cluster_path):
+        return SKIPPED, monotonic() - start, None
+    if (
+        not upgrade
+        and not path.exists(path.join(cluster_path, TERRAFORM_DATA_DIRNAME))
+        and TerraformCache.populate(cluster_path)
+    ):
+        return INITIALIZED, monotonic() - start, None
+
+    cmd_args = ["terraform", "init", "-no-color", "-input=false"]
+    if upgrade:
+        cmd_args += ["-upgrade"]
+    try:
+        run(cmd_args, cwd=cluster_path, check=True, capture_output=True)
+    except CalledProcessError as error:
+        return FAILED, monotonic() - start, error.stderr or error.stdout
+    except Exception as error:
+        return FAILED, monotonic() - start, str(error)
+    TerraformCache.mark_initialized(cluster_path)
+    return INITIALIZED, monotonic() - start, None
+
+
+def init_clusters(clusters_path, jobs, upgrade=False):
+    """
+    Initializes every cluster folder of clusters_path, `jobs` at a time, and logs
+    a summary of the outcomes and timings.
+
+    :return: The outcome, duration and error of each cluster folder, by folder name.
+    """
+    # Directories starting with a dot, like the workspace pool, are not clusters
+    names = sorted(
+        entry.name
+        for entry in scandir(clusters_path)
+        if entry.is_dir() and not entry.name.startswith(".")
+    )
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = dict(
+            zip(
+                names,
+                executor.map(
+                    lambda name: init_cluster(path.join(clusters_path, name), upgrade),
+                    names,
+                ),
+            )
+        )
+
+    for name, (outcome, duration, error) in results.items():
+        if outcome == FAILED:
+            logging.error(f"Could not initialize cluster folder {name}")
+            logging.debug(error)
+        else:
+            logging.debug(f"{name} {outcome} in {duration:.1f}s")
+    counts = {
+        outcome: sum(result[0] == outcome for result in results.values())
+        for outcome in (INITIALIZED, SKIPPED, FAILED)
+    }
+    slowest = sorted(results.items(), key=lambda item: item[1][1], reverse=True)[:5]
+    logging.info(
+        f"Scanned {len(results)} cluster folders in {monotonic() - start:.1f}s: "
+        f"{counts[INITIALIZED]} initialized, {counts[SKIPPED]} skipped, "
+        f"{counts[FAILED]} failed"
+    )
+    if slowest:
+        logging.info(
+            "Slowest: "
+            + ", ".join(f"{name} ({result[1]:.1f}s)" for name, result in slowest)
+        )
+    if counts[FAILED]:
+        logging.error(
+            "Failed: "
+            + ", ".join(name for name, result in results.items() if result[0] == FAILED)
+        )
+    return results
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Scan CLUSTERS_PATH and initialized all clusters with terraform"
     )
     parser.add_argument("--upgrade", action="store_true")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of cluster folders initialized at the same time",
+    )
     arguments = parser.parse_args()
 
-    logger = getLogger()
-    for fd in scandir(CLUSTERS_PATH):
-        if fd.is_dir():
-            cmd_args = ["terraform", "init", "-no-color", "-input=false"]
-            if arguments.upgrade:
-                cmd_args += ["-upgrade"]
-            try:
-                cmd = run(
-                    cmd_args,
-                    cwd=path.join(CLUSTERS_PATH, fd),
-                    check=True,
-                    capture_output=True,
-                )
-            except Exception as error:
-                logger.error("Could not initialize cluster folder {}".format(fd))
-                logger.debug(error)
-                logger.debug(cmd.stderr)
-                logger.debug(cmd.stdout)
-                exit(1)
+    logging.basicConfig(level=logging.INFO)
+    TerraformCache.prewarm()
+    WorkspacePool.prewarm()
+    init_clusters(CLUSTERS_PATH, arguments.jobs, arguments.upgrade)
@@ -24,6 +24,10 @@ class Project(db.Model):
     admin_id = db.Column(db.Integer, nullable=False)
     provider = db.Column(db.Enum(Provider), nullable=False)
     env = db.Column(db.PickleType())
+    min_parallelism = db.Column(db.Integer)
+    max_parallelism = db.Column(db.Integer)
+    parallelism = db.Column(db.Integer)
+    resource_latency = db.Column(db.PickleType())
     magic_castles = db.relationship("MagicCastleORM", back_populates="project")
 
 
@@ -0,0 +1,140 @@
+import logging
+
+from os import makedirs, path, remove
+from threading import Event, Lock
+
+from .file_watcher import FileWatcher
+
+from ...configuration import env
+
+# Directory of the clusters directory holding one file per cluster, written when its
+# status changes, so that the event streams of every MC Hub process are notified
+EVENTS_DIRNAME = ".events"
+
+
+class ClusterSubscription:
+    """
+    The notifications received by an event stream since it last waited.
+    """
+
+    __slots__ = ["hostname", "changed", "event", "lock"]
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.changed = set()
+        self.event = Event()
+        self.lock = Lock()
+
+    def add(self, hostname):
+        with self.lock:
+            self.changed.add(hostname)
+            self.event.set()
+
+    def wait(self, timeout):
+        """
+        :return: The hostnames of the clusters that changed, empty after the timeout.
+        """
+        self.event.wait(timeout)
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            self.event.clear()
+        return changed
+
+
+class ClusterEvents:
+    """
+    ClusterEvents wakes up the event streams of the API when the status or the apply
+    progress of a cluster may have changed. An idle stream only waits on its
+    subscription: nothing is queried or read until a notification arrives.
+
+    Status changes are notified by writing the file of the cluster in the events
+    directory. Apply progress is notified when terraform writes the apply log of the
+    cluster. Both are picked up by a single FileWatcher per process, started with the
+    first subscription.
+    """
+
+    _watcher = None
+    _lock = Lock()
+    # {hostname, or None for the subscriptions to every cluster: {subscription}}
+    _subscriptions = {}
+
+    @staticmethod
+    def get_path():
+        return path.join(env.CLUSTERS_PATH, EVENTS_DIRNAME)
+
+    @classmethod
+    def notify(cls, hostname, deleted=False):
+        """
+        Notifies the streams of every process that the status of the cluster changed.
+
+        :param deleted: True if the cluster was deleted, its file is then removed.
+        """
+        events_path = cls.get_path()
+        try:
+            makedirs(events_path, exist_ok=True)
+            with open(path.join(events_path, hostname), "w"):
+                pass
+            if deleted:
+                remove(path.join(events_path, hostname))
+        except OSError as error:
+            logging.warning(f"Could not notify the status of {hostname} - {error}")
+        cls.publish(hostname, status=True)
+
+    @classmethod
+    def publish(cls, hostname, status):
+        """
+        Wakes up the subscriptions to the cluster. The subscriptions to every cluster
+        are only woken up by status changes.
+        """
+        with cls._lock:
+            subscriptions = set(cls._subscriptions.get(hostname, ()))
+            if status:
+                subscriptions.update(cls._subscriptions.get(None, ()))
+        for subscription in subscriptions:
+            subscription.add(hostname)
+
+    @classmethod
+    def on_change(cls, directory, name):
+        from ..magic_castle.magic_castle import TERRAFORM_APPLY_LOG_FILENAME
+
+        if directory == cls.get_path():
+            cls.publish(name, status=True)
+        elif name == TERRAFORM_APPLY_LOG_FILENAME:
+            cls.publish(path.basename(directory), status=False)
+
+    @classmethod
+    def get_watcher(cls):
+        with cls._lock:
+            if cls._watcher is None:
+                cls._watcher = FileWatcher(cls.on_change)
+            return cls._watcher
+
+    @classmethod
+    def subscribe(cls, hostname=None):
+        """
+        :param hostname: The cluster to follow, or None to follow the status of every
+                         cluster.
+        :return: The subscription, to be passed to unsubscribe once the stream closes.
+        """
+        watcher = cls.get_watcher()
+        events_path = cls.get_path()
+        makedirs(events_path, exist_ok=True)
+        watcher.watch(events_path)
+        if hostname is not None:
+            watcher.watch(path.join(env.CLUSTERS_PATH, hostname))
+        subscription = ClusterSubscription(hostname)
+        with cls._lock:
+            cls._subscriptions.setdefault(hostname, set()).add(subscription)
+        return subscription
+
+    @classmethod
+    def unsubscribe(cls, subscription):
+        with cls._lock:
+            subscriptions = cls._subscriptions.get(subscription.hostname, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                cls._subscriptions.pop(subscription.hostname, None)
+        watcher = cls.get_watcher()
+        watcher.unwatch(cls.get_path())
+        if subscription.hostname is not None:
+            watcher.unwatch(path.join(env.CLUSTERS_PATH, subscription.hostname))
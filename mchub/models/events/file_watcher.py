@@ -0,0 +1,187 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+from threading import Lock, Thread
+from time import sleep
+
+# inotify(7) events reported for the files of a watched directory
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# struct inotify_event: wd, mask, cookie and length of the name that follows
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+# Seconds between two scans of the directories that are not watched with inotify
+POLL_INTERVAL = 1
+
+
+def load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (AttributeError, OSError):
+        # Not on Linux
+        return None
+    return libc
+
+
+class FileWatcher:
+    """
+    FileWatcher calls back with the directory and the name of every file written,
+    created or renamed in the directories it watches. A single inotify instance and a
+    single thread serve every directory, hence watching costs nothing until a file
+    changes.
+
+    Directories that cannot be watched with inotify, because they do not exist yet or
+    inotify is not available (e.g. on macOS), are scanned every `POLL_INTERVAL` seconds
+    instead, comparing the size and modification time of their files.
+    """
+
+    __slots__ = ["callback", "libc", "fd", "directories", "watches", "lock", "thread"]
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.libc = load_libc()
+        self.fd = None
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        # {directory: [inotify watch descriptor or None, number of watchers, files]}
+        self.directories = {}
+        # {inotify watch descriptor: directory}
+        self.watches = {}
+        self.lock = Lock()
+        self.thread = None
+
+    def watch(self, directory):
+        with self.lock:
+            if directory in self.directories:
+                self.directories[directory][1] += 1
+            else:
+                self.directories[directory] = [None, 1, None]
+                self.add_watch(directory)
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self.run, name="mchub-file-watcher", daemon=True
+                )
+                self.thread.start()
+
+    def unwatch(self, directory):
+        with self.lock:
+            watched = self.directories.get(directory)
+            if watched is None:
+                return
+            watched[1] -= 1
+            if watched[1] > 0:
+                return
+            del self.directories[directory]
+            if watched[0] is not None:
+                self.watches.pop(watched[0], None)
+                self.libc.inotify_rm_watch(self.fd, watched[0])
+
+    def add_watch(self, directory):
+        """
+        :return: True if the directory is now watched with inotify.
+        """
+        if self.fd is None:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            return False
+        self.directories[directory][0] = wd
+        self.directories[directory][2] = None
+        self.watches[wd] = directory
+        return True
+
+    def run(self):
+        while True:
+            try:
+                if self.fd is not None:
+                    readable, _, _ = select.select([self.fd], [], [], POLL_INTERVAL)
+                    if readable:
+                        self.read()
+                else:
+                    sleep(POLL_INTERVAL)
+                self.poll()
+            except Exception:
+                logging.exception("The file watcher failed")
+                sleep(POLL_INTERVAL)
+
+    def read(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        changes = []
+        offset = 0
+        with self.lock:
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                directory = self.watches.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory was removed, it is scanned until it exists again
+                    del self.watches[wd]
+                    if directory in self.directories:
+                        self.directories[directory][0] = None
+                elif name:
+                    changes.append((directory, os.fsdecode(name)))
+        for directory, name in dict.fromkeys(changes):
+            self.notify(directory, name)
+
+    def poll(self):
+        changes = []
+        with self.lock:
+            for directory, watched in self.directories.items():
+                if watched[0] is not None:
+                    continue
+                if self.add_watch(directory):
+                    # Whatever was written before the watch was added
+                    changes.extend((directory, name) for name in list_files(directory))
+                    continue
+                files = list_files(directory)
+                if watched[2] is not None:
+                    changes.extend(
+                        (directory, name)
+                        for name, stat in files.items()
+                        if watched[2].get(name) != stat
+                    )
+                watched[2] = files
+        for directory, name in changes:
+            self.notify(directory, name)
+
+    def notify(self, directory, name):
+        try:
+            self.callback(directory, name)
+        except Exception:
+            logging.exception(f"Could not notify the change of {name} in {directory}")
+
+
+def list_files(directory):
+    """
+    :return: The size and modification time of the files of the directory.
+    """
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        pass
+    return files
@@ -0,0 +1,103 @@
+import datetime
+import hashlib
+
+from sqlalchemy.exc import IntegrityError
+
+from ..job.job import utcnow
+
+from ...configuration import get_config
+from ...database import db
+
+
+class IdempotencyKeyORM(db.Model):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (db.UniqueConstraint("scope", "key"),)
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(256), nullable=False)
+    key = db.Column(db.String(256), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id"))
+    response = db.Column(db.PickleType())
+    status_code = db.Column(db.Integer)
+    created = db.Column(db.DateTime(), default=utcnow)
+
+
+class IdempotencyKey:
+    """
+    IdempotencyKey records the response of a request sent with an `Idempotency-Key` header,
+    along with the job it started, for `idempotency_key_ttl` seconds. A request repeated
+    with the same key, by the same user, gets the recorded response instead of being
+    handled again, e.g. when a browser retries the creation of a cluster.
+
+    Keys are scoped by user. A key is reserved before the request is handled, so a
+    duplicate received while the original is in progress is rejected instead of
+    starting the same terraform work twice.
+    """
+
+    __slots__ = ["orm"]
+
+    def __init__(self, orm):
+        self.orm = orm
+
+    @staticmethod
+    def ttl():
+        return datetime.timedelta(seconds=get_config()["idempotency_key_ttl"])
+
+    @staticmethod
+    def get_fingerprint(method, path, body: bytes):
+        digest = hashlib.sha256(f"{method} {path}\n".encode())
+        digest.update(body or b"")
+        return digest.hexdigest()
+
+    @classmethod
+    def reserve(cls, scope, key, fingerprint):
+        """
+        Reserves the key for a request, unless it was already used within the TTL.
+
+        :return: The reserved key, and the key of the original request if the key was
+                 already used (None otherwise).
+        """
+        expired = utcnow() - cls.ttl()
+        IdempotencyKeyORM.query.filter(IdempotencyKeyORM.created < expired).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+
+        orm = IdempotencyKeyORM(scope=scope, key=key, fingerprint=fingerprint)
+        db.session.add(orm)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            original = IdempotencyKeyORM.query.filter_by(scope=scope, key=key).first()
+            return None, cls(original)
+        return cls(orm), None
+
+    @property
+    def fingerprint(self):
+        return self.orm.fingerprint
+
+    @property
+    def completed(self):
+        return self.orm.status_code is not None
+
+    @property
+    def response(self):
+        return self.orm.response, self.orm.status_code
+
+    def complete(self, data, status_code):
+        self.orm.response = data
+        self.orm.status_code = status_code
+        if isinstance(data, dict) and isinstance(data.get("job_id"), int):
+            self.orm.job_id = data["job_id"]
+        db.session.commit()
+
+    def release(self):
+        """
+        Frees the key of a request that failed, so that it can be retried.
+        """
+        db.session.rollback()
+        IdempotencyKeyORM.query.filter_by(id=self.orm.id).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
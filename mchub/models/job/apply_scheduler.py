@@ -0,0 +1,244 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Condition, RLock
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from .job import Job, JobORM, utcnow
+from .job_queue import JobQueue
+from .job_status_code import JobStatusCode
+from .job_type import JobType
+
+from ...configuration import get_config
+from ...database import db
+
+# Workers saving the outcome of the applies once terraform exited
+COMPLETION_WORKERS = 2
+
+
+class ApplyScheduler:
+    """
+    ApplyScheduler bounds the number of `terraform apply` running at the same time.
+
+    Queued applies are ordered by priority lane: interactive builds first, then destructions
+    requested by users, then destructions of expired clusters, then the builds of warm pool
+    clusters. Within a lane, projects take turns: the n-th queued apply of a project comes
+    after the (n-1)-th queued apply of every other project, and the applies already running
+    for a project count as queued ahead of its own. Remaining ties are broken by arrival
+    order (FIFO).
+
+    An apply starts only while fewer than `max_concurrent_applies` applies are running and
+    fewer than `max_concurrent_applies_per_project` applies are running for its project.
+    Applies are claimed with a conditional update of their job record, hence the limits hold
+    across every MC Hub process sharing the database. Whenever an apply is submitted or
+    finishes, the scheduler starts the next applies that fit within the limits.
+
+    No thread waits for the applies: terraform is started through the TerraformSupervisor,
+    and a completion callback hands the outcome of each apply to a small pool of
+    `COMPLETION_WORKERS` workers, which save it and start the next applies.
+    """
+
+    _executor = None
+    _lock = RLock()
+    # Notified whenever an apply started by this process completed
+    _completed = Condition(_lock)
+    # The ids of the applies started by this process and not completed yet
+    _active = set()
+
+    @staticmethod
+    def order(queued, running):
+        """
+        Orders the queued jobs in the sequence they will be started.
+
+        :param queued: The queued apply jobs (JobORM).
+        :param running: The running apply jobs (JobORM).
+        :return: The queued jobs, in order.
+        """
+        running_per_project = Counter(job.project_id for job in running)
+        queued_per_lane = Counter()
+        turn = {}
+        for job in sorted(queued, key=lambda job: (job.priority, job.queued, job.id)):
+            lane = (job.priority, job.project_id)
+            turn[job.id] = running_per_project[job.project_id] + queued_per_lane[lane]
+            queued_per_lane[lane] += 1
+        return sorted(
+            queued, key=lambda job: (job.priority, turn[job.id], job.queued, job.id)
+        )
+
+    @classmethod
+    def select(cls, queued, running, max_concurrency, max_concurrency_per_project):
+        """
+        Selects the queued jobs which can start without exceeding the concurrency limits.
+        """
+        total = len(running)
+        per_project = Counter(job.project_id for job in running)
+        selected = []
+        for job in cls.order(queued, running):
+            if total >= max_concurrency:
+                break
+            if per_project[job.project_id] >= max_concurrency_per_project:
+                continue
+            selected.append(job)
+            total += 1
+            per_project[job.project_id] += 1
+        return selected
+
+    @staticmethod
+    def jobs():
+        orms = JobORM.query.filter(
+            JobORM.type == JobType.APPLY,
+            JobORM.status.in_([JobStatusCode.QUEUED, JobStatusCode.RUNNING]),
+        ).all()
+        queued = [orm for orm in orms if orm.status == JobStatusCode.QUEUED]
+        running = [orm for orm in orms if orm.status == JobStatusCode.RUNNING]
+        return queued, running
+
+    @classmethod
+    def position(cls, job: Job):
+        """
+        :return: The position of a queued job in the apply queue and the depth of the queue,
+                 or None if the job is not queued.
+        """
+        queued, running = cls.jobs()
+        order = [orm.id for orm in cls.order(queued, running)]
+        if job.id not in order:
+            return None
+        return {"position": order.index(job.id) + 1, "depth": len(order)}
+
+    @staticmethod
+    def claim(orm, max_concurrency, max_concurrency_per_project, **values):
+        """
+        Marks a queued job as running, unless another process claimed it first
+        or the concurrency limits were reached in the meantime.
+
+        :param values: Additional columns to set on the claimed job (e.g. a runner lease).
+        :return: True if the job was claimed.
+        """
+        running = aliased(JobORM)
+        running_count = (
+            db.session.query(func.count(running.id))
+            .filter(
+                running.type == JobType.APPLY,
+                running.status == JobStatusCode.RUNNING,
+            )
+            .scalar_subquery()
+        )
+        project_running_count = (
+            db.session.query(func.count(running.id))
+            .filter(
+                running.type == JobType.APPLY,
+                running.status == JobStatusCode.RUNNING,
+                running.project_id == orm.project_id,
+            )
+            .scalar_subquery()
+        )
+        claimed = JobORM.query.filter(
+            JobORM.id == orm.id,
+            JobORM.status == JobStatusCode.QUEUED,
+            running_count < max_concurrency,
+            project_running_count < max_concurrency_per_project,
+        ).update(
+            {"status": JobStatusCode.RUNNING, "started": utcnow(), **values},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return claimed == 1
+
+    @classmethod
+    def executor(cls):
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=COMPLETION_WORKERS,
+                    thread_name_prefix="mchub-apply",
+                )
+        return cls._executor
+
+    @classmethod
+    def submit(cls, job: Job):
+        if get_config()["external_runners"]:
+            # The job stays queued until a runner claims it
+            return
+        cls.dispatch()
+
+    @classmethod
+    def dispatch(cls):
+        """
+        Starts the queued applies that fit within the concurrency limits.
+        """
+        app = current_app._get_current_object()
+        max_concurrency = get_config()["max_concurrent_applies"]
+        max_concurrency_per_project = get_config()["max_concurrent_applies_per_project"]
+        with cls._lock:
+            queued, running = cls.jobs()
+            for orm in cls.select(
+                queued, running, max_concurrency, max_concurrency_per_project
+            ):
+                if cls.claim(orm, max_concurrency, max_concurrency_per_project):
+                    cls.start(app, Job(orm))
+
+    @classmethod
+    def start(cls, app, job: Job):
+        """
+        Starts the terraform apply of a claimed job, whose outcome is saved by `complete`.
+        """
+        magic_castle = None
+        try:
+            magic_castle, parallelism = JobQueue.prepare(job)
+            terraform_run = magic_castle.start_apply(
+                parallelism,
+                job,
+                cancelled=partial(cls.is_cancel_requested, app, job.id),
+            )
+        except Exception as error:
+            JobQueue.record_error(job, magic_castle, error)
+            cls.executor().submit(cls.run_dispatch, app)
+            return
+        with cls._lock:
+            cls._active.add(job.id)
+        terraform_run.future.add_done_callback(
+            lambda _: cls.executor().submit(cls.complete, app, job.id, terraform_run)
+        )
+
+    @staticmethod
+    def is_cancel_requested(app, job_id):
+        with app.app_context():
+            return Job.get(job_id).is_cancel_requested()
+
+    @classmethod
+    def complete(cls, app, job_id, terraform_run):
+        """
+        Saves the outcome of an apply once terraform exited and starts the next applies.
+        """
+        with app.app_context():
+            job = Job.get(job_id)
+            magic_castle = None
+            try:
+                magic_castle = JobQueue.get_magic_castle(job)
+                magic_castle.finish_apply(terraform_run, job.parallelism, job)
+            except Exception as error:
+                JobQueue.record_error(job, magic_castle, error)
+            else:
+                job.succeed()
+            finally:
+                cls.dispatch()
+                with cls._lock:
+                    cls._active.discard(job_id)
+                    cls._completed.notify_all()
+
+    @classmethod
+    def wait(cls):
+        """
+        Waits until the applies started by this process completed, along with the
+        applies they started in turn.
+        """
+        with cls._lock:
+            cls._completed.wait_for(lambda: not cls._active)
+
+    @classmethod
+    def run_dispatch(cls, app):
+        with app.app_context():
+            cls.dispatch()
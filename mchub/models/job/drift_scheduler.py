@@ -0,0 +1,203 @@
+import logging
+
+from collections import Counter
+from datetime import timedelta
+from threading import Timer
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased
+
+from .job import Job, JobORM, utcnow
+from .job_priority import JobPriority
+from .job_queue import JobQueue
+from .job_status_code import JobStatusCode
+from .job_type import JobType
+
+from ...configuration import get_config
+from ...database import db
+
+# Seconds between two polls of the drift checks due, when the web server runs them
+POLL_INTERVAL = 60
+
+
+class DriftScheduler:
+    """
+    DriftScheduler queues the drift checks of the clusters, i.e. `terraform plan -refresh-only`
+    runs that compare the cloud resources with the terraform state without changing anything.
+
+    A cluster is checked every `drift_detection_interval` seconds while it is provisioned and
+    has no plan waiting to be applied nor job in progress. A project has at most
+    `max_concurrent_drift_checks_per_project` drift checks queued or running, and a drift
+    check only starts while no plan is queued or running for its project, hence it never
+    delays the work requested by users.
+
+    Drift checks are run by the runners (`python -m mchub.runner`) when `external_runners`
+    is enabled. Otherwise, each process of the web server polls the checks that are due
+    every `POLL_INTERVAL` seconds and runs them one after the other in its polling thread,
+    so they never hold a worker of the JobQueue.
+    """
+
+    @staticmethod
+    def interval():
+        return get_config()["drift_detection_interval"]
+
+    @staticmethod
+    def max_concurrency_per_project():
+        return get_config()["max_concurrent_drift_checks_per_project"]
+
+    @staticmethod
+    def due():
+        """
+        :return: The clusters whose last drift check is older than the interval, those
+                 never checked first, then the least recently checked.
+        """
+        from ..magic_castle.magic_castle import MagicCastleORM
+        from ..magic_castle.cluster_status_code import ClusterStatusCode
+        from ..magic_castle.plan_type import PlanType
+
+        threshold = utcnow() - timedelta(seconds=DriftScheduler.interval())
+        return (
+            MagicCastleORM.query.filter(
+                MagicCastleORM.status == ClusterStatusCode.PROVISIONING_SUCCESS,
+                or_(
+                    MagicCastleORM.plan_type == PlanType.NONE,
+                    MagicCastleORM.plan_type.is_(None),
+                ),
+                or_(
+                    MagicCastleORM.drift_checked.is_(None),
+                    MagicCastleORM.drift_checked < threshold,
+                ),
+            )
+            .order_by(
+                MagicCastleORM.drift_checked.isnot(None),
+                MagicCastleORM.drift_checked,
+                MagicCastleORM.id,
+            )
+            .all()
+        )
+
+    @classmethod
+    def schedule(cls):
+        """
+        Queues the drift checks of the clusters that are due, within the per project limit.
+
+        :return: The queued jobs.
+        """
+        if not cls.interval():
+            return []
+        active = JobORM.query.filter(
+            JobORM.status.in_([JobStatusCode.QUEUED, JobStatusCode.RUNNING])
+        ).all()
+        busy = {orm.hostname for orm in active}
+        per_project = Counter(
+            orm.project_id for orm in active if orm.type == JobType.DRIFT
+        )
+        jobs = []
+        for cluster in cls.due():
+            if (
+                cluster.hostname in busy
+                or per_project[cluster.project_id] >= cls.max_concurrency_per_project()
+            ):
+                continue
+            jobs.append(
+                Job.create(
+                    cluster.hostname,
+                    JobType.DRIFT,
+                    project_id=cluster.project_id,
+                    priority=JobPriority.DRIFT,
+                )
+            )
+            per_project[cluster.project_id] += 1
+        return jobs
+
+    @staticmethod
+    def jobs():
+        return (
+            JobORM.query.filter(
+                JobORM.type == JobType.DRIFT, JobORM.status == JobStatusCode.QUEUED
+            )
+            .order_by(JobORM.queued, JobORM.id)
+            .all()
+        )
+
+    @classmethod
+    def claim(cls, orm, **values):
+        """
+        Marks a queued drift check as running, unless another process claimed it first,
+        a plan is queued or running for its project, or its project reached the limit.
+
+        :param values: Additional columns to set on the claimed job (e.g. a runner lease).
+        :return: True if the job was claimed.
+        """
+        other = aliased(JobORM)
+        project_plan_count = (
+            db.session.query(func.count(other.id))
+            .filter(
+                other.type == JobType.PLAN,
+                other.status.in_([JobStatusCode.QUEUED, JobStatusCode.RUNNING]),
+                other.project_id == orm.project_id,
+            )
+            .scalar_subquery()
+        )
+        project_running_count = (
+            db.session.query(func.count(other.id))
+            .filter(
+                other.type == JobType.DRIFT,
+                other.status == JobStatusCode.RUNNING,
+                other.project_id == orm.project_id,
+            )
+            .scalar_subquery()
+        )
+        claimed = JobORM.query.filter(
+            JobORM.id == orm.id,
+            JobORM.status == JobStatusCode.QUEUED,
+            project_plan_count == 0,
+            project_running_count < cls.max_concurrency_per_project(),
+        ).update(
+            {"status": JobStatusCode.RUNNING, "started": utcnow(), **values},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return claimed == 1
+
+    @classmethod
+    def start(cls, app):
+        """
+        Polls the drift checks in a background thread of this process, unless the runners
+        run them or drift detection is disabled.
+        """
+        with app.app_context():
+            if get_config()["external_runners"] or not cls.interval():
+                return
+        timer = Timer(POLL_INTERVAL, cls.poll, (app,))
+        timer.daemon = True
+        timer.start()
+
+    @classmethod
+    def poll(cls, app):
+        """
+        Queues the drift checks that are due, runs the queued ones and polls again later.
+        """
+        try:
+            with app.app_context():
+                cls.schedule()
+            while cls.run_next(app):
+                pass
+        except Exception as error:
+            logging.exception(f"Failed to run the drift checks - {error}")
+        finally:
+            cls.start(app)
+
+    @classmethod
+    def run_next(cls, app):
+        """
+        Claims and runs the next drift check that can start.
+
+        :return: True if a drift check ran.
+        """
+        with app.app_context():
+            for orm in cls.jobs():
+                if cls.claim(orm):
+                    JobQueue.perform(Job(orm))
+                    return True
+        return False
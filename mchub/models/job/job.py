@@ -0,0 +1,262 @@
+import datetime
+
+from sqlalchemy.sql import func
+
+from .job_priority import JobPriority
+from .job_status_code import JobStatusCode
+from .job_type import JobType
+
+from ..events.cluster_events import ClusterEvents
+from ...database import db
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class JobORM(db.Model):
+    __tablename__ = "job"
+    id = db.Column(db.Integer, primary_key=True)
+    hostname = db.Column(db.String(256), nullable=False, index=True)
+    type = db.Column(db.Enum(JobType), nullable=False)
+    project_id = db.Column(db.Integer)
+    priority = db.Column(db.Integer, default=JobPriority.INTERACTIVE)
+    status = db.Column(db.Enum(JobStatusCode), default=JobStatusCode.QUEUED)
+    queued = db.Column(db.DateTime(), default=func.now())
+    started = db.Column(db.DateTime())
+    finished = db.Column(db.DateTime())
+    message = db.Column(db.String())
+    runner = db.Column(db.String(256))
+    lease_expires = db.Column(db.DateTime())
+    parallelism = db.Column(db.Integer)
+    cancel_requested = db.Column(db.DateTime())
+    peak_memory = db.Column(db.BigInteger)
+    not_before = db.Column(db.DateTime())
+
+
+class Job:
+    """
+    Job is a unit of terraform work (e.g. a plan) executed in the background for a cluster.
+
+    The job record keeps track of when the job was queued, started and finished so the
+    API can report on work that is still pending after the request has returned.
+    """
+
+    __slots__ = ["orm"]
+
+    def __init__(self, orm):
+        self.orm = orm
+
+    @classmethod
+    def create(
+        cls,
+        hostname,
+        type: JobType,
+        *,
+        project_id=None,
+        priority: JobPriority = JobPriority.INTERACTIVE,
+        not_before=None,
+    ):
+        job = cls(
+            JobORM(
+                hostname=hostname,
+                type=type,
+                project_id=project_id,
+                priority=priority,
+                status=JobStatusCode.QUEUED,
+                not_before=not_before,
+            )
+        )
+        db.session.add(job.orm)
+        db.session.commit()
+        ClusterEvents.notify(hostname)
+        return job
+
+    @classmethod
+    def get(cls, id):
+        orm = JobORM.query.get(id)
+        return cls(orm) if orm else None
+
+    @classmethod
+    def latest(cls, hostname):
+        """
+        :return: The latest plan or apply job of the cluster. Background drift checks
+                 are left out, as they are not work requested by the user.
+        """
+        orm = (
+            JobORM.query.filter(
+                JobORM.hostname == hostname, JobORM.type != JobType.DRIFT
+            )
+            .order_by(JobORM.id.desc())
+            .first()
+        )
+        return cls(orm) if orm else None
+
+    @classmethod
+    def is_running(cls, hostname, type: JobType, exclude=None):
+        """
+        :return: True if a job of the given type is running for the cluster.
+        """
+        return (
+            JobORM.query.filter(
+                JobORM.hostname == hostname,
+                JobORM.type == type,
+                JobORM.status == JobStatusCode.RUNNING,
+                JobORM.id != exclude,
+            ).count()
+            > 0
+        )
+
+    @property
+    def id(self):
+        return self.orm.id
+
+    @property
+    def hostname(self):
+        return self.orm.hostname
+
+    @property
+    def type(self) -> JobType:
+        return self.orm.type
+
+    @property
+    def priority(self) -> JobPriority:
+        return JobPriority(self.orm.priority)
+
+    @property
+    def status(self) -> JobStatusCode:
+        return self.orm.status
+
+    @property
+    def parallelism(self):
+        return self.orm.parallelism
+
+    def get_delay(self):
+        """
+        :return: The number of seconds left before the job can start.
+        """
+        db.session.refresh(self.orm)
+        if self.orm.not_before is None:
+            return 0
+        return max(0, (self.orm.not_before - utcnow()).total_seconds())
+
+    def defer(self, not_before):
+        """
+        Postpones the start of the job unless a worker started it in the meantime.
+
+        :return: True if the job was postponed.
+        """
+        deferred = JobORM.query.filter(
+            JobORM.id == self.id, JobORM.status == JobStatusCode.QUEUED
+        ).update({"not_before": not_before}, synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(self.orm)
+        return deferred == 1
+
+    def start(self):
+        """
+        Starts the job unless a worker, possibly of another process, started it first.
+
+        :return: True if the job was started.
+        """
+        started = JobORM.query.filter(
+            JobORM.id == self.id, JobORM.status == JobStatusCode.QUEUED
+        ).update(
+            {"status": JobStatusCode.RUNNING, "started": utcnow()},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        db.session.refresh(self.orm)
+        if started == 1:
+            ClusterEvents.notify(self.hostname)
+        return started == 1
+
+    def set_parallelism(self, parallelism):
+        self.orm.parallelism = parallelism
+        db.session.commit()
+
+    def record_peak_memory(self, peak_memory):
+        """
+        Keeps the largest peak memory, in bytes, of the terraform commands run by the job.
+        """
+        if peak_memory > (self.orm.peak_memory or 0):
+            self.orm.peak_memory = peak_memory
+            db.session.commit()
+
+    def succeed(self):
+        self.orm.status = JobStatusCode.SUCCESS
+        self.orm.finished = utcnow()
+        db.session.commit()
+        ClusterEvents.notify(self.hostname)
+
+    def is_cancel_requested(self):
+        """
+        :return: True if the cancellation of the job was requested, from any process.
+        """
+        return (
+            db.session.query(JobORM.cancel_requested)
+            .filter(JobORM.id == self.id)
+            .scalar()
+            is not None
+        )
+
+    def request_cancel(self):
+        JobORM.query.filter(
+            JobORM.id == self.id, JobORM.status == JobStatusCode.RUNNING
+        ).update({"cancel_requested": utcnow()}, synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(self.orm)
+
+    def cancel_queued(self):
+        """
+        Cancels the job unless a worker started it in the meantime.
+
+        :return: True if the job was cancelled.
+        """
+        now = utcnow()
+        cancelled = JobORM.query.filter(
+            JobORM.id == self.id, JobORM.status == JobStatusCode.QUEUED
+        ).update(
+            {
+                "status": JobStatusCode.CANCELLED,
+                "cancel_requested": now,
+                "finished": now,
+                "message": "The job was cancelled.",
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        db.session.refresh(self.orm)
+        if cancelled == 1:
+            ClusterEvents.notify(self.hostname)
+        return cancelled == 1
+
+    def cancel(self):
+        self.orm.status = JobStatusCode.CANCELLED
+        self.orm.finished = utcnow()
+        self.orm.message = "The job was cancelled."
+        db.session.commit()
+        ClusterEvents.notify(self.hostname)
+
+    def fail(self, message: str):
+        self.orm.status = JobStatusCode.ERROR
+        self.orm.finished = utcnow()
+        self.orm.message = message
+        db.session.commit()
+        ClusterEvents.notify(self.hostname)
+
+    @property
+    def state(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "priority": self.priority.name.lower(),
+            "status": self.status,
+            "queued": self.orm.queued.isoformat() if self.orm.queued else None,
+            "started": self.orm.started.isoformat() if self.orm.started else None,
+            "finished": self.orm.finished.isoformat() if self.orm.finished else None,
+            "message": self.orm.message,
+            "runner": self.orm.runner,
+            "parallelism": self.orm.parallelism,
+            "peak_memory": self.orm.peak_memory,
+        }
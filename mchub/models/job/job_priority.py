@@ -0,0 +1,9 @@
+from enum import IntEnum
+
+
+class JobPriority(IntEnum):
+    INTERACTIVE = 0
+    DESTROY = 1
+    CULLING = 2
+    DRIFT = 3
+    WARM_POOL = 4
@@ -0,0 +1,190 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Timer
+
+from flask import current_app
+
+from .job import Job, JobORM
+from .job_status_code import JobStatusCode
+from .job_type import JobType
+from ..terraform.terraform_parallelism import TerraformParallelism
+
+from ...configuration import get_config
+from ...database import db
+from ...exceptions.invalid_usage_exception import (
+    ClusterNotFoundException,
+    InvalidUsageException,
+)
+from ...exceptions.server_exception import ServerException
+
+# Seconds between two checks of the outdated plan a queued plan waits for
+RUNNING_PLAN_POLL_INTERVAL = 1
+
+
+class JobQueue:
+    """
+    JobQueue runs jobs in a bounded pool of background workers, so that a request
+    which triggers terraform work can return before the work is done.
+
+    The number of workers is defined by `plan_workers` in configuration.json. Each worker
+    pushes its own application context, hence its own database session.
+
+    When `external_runners` is enabled, jobs are left in the database for the
+    runner daemons (`python -m mchub.runner`) to claim instead.
+    """
+
+    _executor = None
+    _lock = Lock()
+
+    @classmethod
+    def executor(cls):
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=get_config()["plan_workers"],
+                    thread_name_prefix="mchub-job",
+                )
+        return cls._executor
+
+    @classmethod
+    def submit(cls, job: Job):
+        if get_config()["external_runners"]:
+            # The job stays queued until a runner claims it
+            return
+        app = current_app._get_current_object()
+        cls.schedule(app, job.id, cls.get_delay(job))
+
+    @staticmethod
+    def get_delay(job: Job):
+        """
+        :return: The number of seconds to wait before the job can start. A plan waits for
+                 the outdated plan of the same cluster still running, as both would
+                 contend for the terraform state lock.
+        """
+        delay = job.get_delay()
+        if job.type == JobType.PLAN and Job.is_running(
+            job.hostname, JobType.PLAN, exclude=job.id
+        ):
+            delay = max(delay, RUNNING_PLAN_POLL_INTERVAL)
+        return delay
+
+    @classmethod
+    def schedule(cls, app, job_id, delay):
+        """
+        Hands the job to a worker once its `not_before` time has come. The job is checked
+        again at that time, since its start may have been postponed in the meantime.
+        """
+        if delay <= 0:
+            cls.executor().submit(cls.run, app, job_id)
+            return
+        timer = Timer(delay, cls.run_when_due, (app, job_id))
+        timer.daemon = True
+        timer.start()
+
+    @classmethod
+    def run_when_due(cls, app, job_id):
+        with app.app_context():
+            job = Job.get(job_id)
+            if job is None or job.status != JobStatusCode.QUEUED:
+                return
+            cls.schedule(app, job_id, cls.get_delay(job))
+
+    @classmethod
+    def run(cls, app, job_id):
+        with app.app_context():
+            cls.execute(job_id)
+
+    @classmethod
+    def execute(cls, job_id):
+        job = Job.get(job_id)
+        if not job.start():
+            # Resumed by several processes, the job runs in the first one to start it
+            return
+        cls.perform(job)
+
+    @classmethod
+    def resume(cls, app):
+        """
+        Hands the jobs left queued in the database to this process, such as the plans
+        queued by `python -m mchub.schema_update --clean` to recover the interrupted
+        applies. Called when the web server starts: every process of the web server
+        resumes the queued jobs, and each job runs in the first process to start it.
+        """
+        from .apply_scheduler import ApplyScheduler
+
+        if get_config()["external_runners"]:
+            # The runners claim the queued jobs
+            return
+        with app.app_context():
+            plans = (
+                JobORM.query.filter(
+                    JobORM.type == JobType.PLAN,
+                    JobORM.status == JobStatusCode.QUEUED,
+                )
+                .order_by(JobORM.id)
+                .all()
+            )
+            for orm in plans:
+                job = Job(orm)
+                cls.schedule(app, job.id, cls.get_delay(job))
+            ApplyScheduler.dispatch()
+
+    @staticmethod
+    def get_magic_castle(job: Job):
+        """
+        :raise ClusterNotFoundException: When the cluster of the job no longer exists.
+        """
+        from ..magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+        orm = MagicCastleORM.query.filter_by(hostname=job.hostname).first()
+        if orm is None:
+            raise ClusterNotFoundException
+        return MagicCastle(orm)
+
+    @staticmethod
+    def prepare(job: Job):
+        """
+        :return: The cluster of the job and the parallelism of its terraform commands.
+        :raise ClusterNotFoundException: When the cluster no longer exists.
+        """
+        magic_castle = JobQueue.get_magic_castle(job)
+        parallelism = TerraformParallelism.choose(magic_castle.project)
+        job.set_parallelism(parallelism)
+        return magic_castle, parallelism
+
+    @staticmethod
+    def record_error(job: Job, magic_castle, error: Exception):
+        """
+        Records the outcome of a job interrupted by an error, which may follow a cancellation.
+        Called while handling the error.
+        """
+        if isinstance(error, (InvalidUsageException, ServerException)):
+            if magic_castle is not None and job.is_cancel_requested():
+                magic_castle.reset_after_cancel(job)
+                job.cancel()
+            else:
+                job.fail(error.message)
+        else:
+            logging.exception(f"Job {job.id} failed unexpectedly - {error}")
+            db.session.rollback()
+            job.fail("An unexpected error occurred while running the job.")
+
+    @staticmethod
+    def perform(job: Job):
+        """
+        Runs a job that has been started and records its outcome.
+        """
+        magic_castle = None
+        try:
+            magic_castle, parallelism = JobQueue.prepare(job)
+            if job.type == JobType.PLAN:
+                magic_castle.run_plan(parallelism, job)
+            elif job.type == JobType.APPLY:
+                magic_castle.run_apply(parallelism, job)
+            elif job.type == JobType.DRIFT:
+                magic_castle.run_drift_check(parallelism, job)
+        except Exception as error:
+            JobQueue.record_error(job, magic_castle, error)
+        else:
+            job.succeed()
@@ -0,0 +1,281 @@
+import logging
+import socket
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from os import getpid, path
+from threading import Event, Lock
+from time import monotonic, sleep
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased
+
+from .apply_scheduler import ApplyScheduler
+from .drift_scheduler import DriftScheduler
+from .job import Job, JobORM, utcnow
+from .job_queue import JobQueue
+from .job_status_code import JobStatusCode
+from .job_type import JobType
+from ..terraform.apply_journal import ApplyJournal
+
+from ...configuration import env, get_config
+from ...database import db
+
+
+class JobRunner:
+    """
+    JobRunner executes the plan and apply jobs queued in the database, from a process
+    separate from the web server (`python -m mchub.runner`).
+
+    A runner claims a job by marking it as running with its name and a lease expiration.
+    While the job runs, the runner renews the lease periodically (its heartbeat). When a
+    runner dies, its leases expire and any runner puts its plans and drift checks back in
+    the queue. Its applies are never run again, as terraform apply may outlive the runner:
+    they are taken over by a runner of the host running terraform (see `recover_applies`).
+
+    Several runners, on one or many hosts, can drain the queue in parallel, as long as they
+    share the database and the clusters directory. Applies are claimed through the
+    ApplyScheduler, hence the concurrency limits hold across runners. Runners that run drift
+    checks also queue them, through the DriftScheduler, each time they renew their leases.
+    """
+
+    def __init__(self, name=None, workers=4, lease_duration=None, job_types=None):
+        self.name = name or f"{socket.gethostname()}:{getpid()}"
+        self.workers = workers
+        self.job_types = set(job_types or JobType)
+        self.lease_duration = timedelta(
+            seconds=lease_duration or get_config()["runner_lease_duration"]
+        )
+        self.active = set()
+        self._lock = Lock()
+        self._stopping = Event()
+        self._executor = None
+
+    def lease(self):
+        return {"runner": self.name, "lease_expires": utcnow() + self.lease_duration}
+
+    def heartbeat(self):
+        """
+        Extends the lease of the jobs this runner is running.
+        """
+        with self._lock:
+            active = list(self.active)
+        if not active:
+            return
+        JobORM.query.filter(
+            JobORM.id.in_(active),
+            JobORM.runner == self.name,
+            JobORM.status == JobStatusCode.RUNNING,
+        ).update(
+            {"lease_expires": self.lease()["lease_expires"]}, synchronize_session=False
+        )
+        db.session.commit()
+
+    @staticmethod
+    def reclaim():
+        """
+        Puts back in the queue the plans and drift checks whose runner stopped renewing
+        its lease.
+
+        :return: The number of jobs put back in the queue.
+        """
+        reclaimed = JobORM.query.filter(
+            JobORM.type != JobType.APPLY,
+            JobORM.status == JobStatusCode.RUNNING,
+            JobORM.lease_expires < utcnow(),
+        ).update(
+            {
+                "status": JobStatusCode.QUEUED,
+                "started": None,
+                "runner": None,
+                "lease_expires": None,
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return reclaimed
+
+    def take_over(self, orm):
+        """
+        Leases a running job whose lease expired, unless another runner took it over first.
+
+        :return: True if the job was taken over.
+        """
+        taken = JobORM.query.filter(
+            JobORM.id == orm.id,
+            JobORM.status == JobStatusCode.RUNNING,
+            JobORM.lease_expires < utcnow(),
+        ).update(self.lease(), synchronize_session=False)
+        db.session.commit()
+        db.session.refresh(orm)
+        return taken == 1
+
+    def recover_applies(self, app):
+        """
+        Takes over the applies whose runner stopped renewing its lease. An apply whose
+        terraform process is still running on this host, according to its journal, is
+        reattached to. Otherwise, the apply is recovered from the terraform state it left
+        (see MagicCastle.recover_apply) and its job fails. Applies journaled on another
+        host are left to the runners of that host, which alone can tell whether terraform
+        still runs.
+
+        :return: The number of applies taken over.
+        """
+        from ..magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+        expired = JobORM.query.filter(
+            JobORM.type == JobType.APPLY,
+            JobORM.status == JobStatusCode.RUNNING,
+            JobORM.lease_expires < utcnow(),
+        ).all()
+        recovered = 0
+        for orm in expired:
+            journal = ApplyJournal.read(path.join(env.CLUSTERS_PATH, orm.hostname))
+            if journal is not None and journal.host != socket.gethostname():
+                continue
+            if not self.take_over(orm):
+                continue
+            recovered += 1
+            job = Job(orm)
+            if journal is not None and journal.is_alive():
+                logging.warning(f"Runner {self.name} reattached to apply job {job.id}")
+                with self._lock:
+                    self.active.add(job.id)
+                self._executor.submit(self.execute, app, job.id)
+                continue
+
+            logging.warning(f"Runner {self.name} recovering apply job {job.id}")
+            job.fail("The runner of the job stopped while applying the plan.")
+            cluster = MagicCastleORM.query.filter_by(hostname=job.hostname).first()
+            if cluster is None:
+                continue
+            try:
+                MagicCastle(cluster).recover_apply()
+            except Exception as error:
+                logging.exception(
+                    f"Could not recover the apply of {job.hostname} - {error}"
+                )
+                db.session.rollback()
+        return recovered
+
+    def claim(self):
+        """
+        Claims the next job to run. Plans come first since a user is waiting for them,
+        then the applies selected by the ApplyScheduler, then the drift checks.
+
+        :return: The claimed job, or None if there is nothing this runner can start.
+        """
+        plans = []
+        if JobType.PLAN in self.job_types:
+            plans = (
+                JobORM.query.filter(
+                    JobORM.type == JobType.PLAN,
+                    JobORM.status == JobStatusCode.QUEUED,
+                    or_(JobORM.not_before.is_(None), JobORM.not_before <= utcnow()),
+                )
+                .order_by(JobORM.queued, JobORM.id)
+                .all()
+            )
+        for orm in plans:
+            # A plan waits for the outdated plan of the same cluster still running
+            other = aliased(JobORM)
+            running_plan_count = (
+                db.session.query(func.count(other.id))
+                .filter(
+                    other.type == JobType.PLAN,
+                    other.status == JobStatusCode.RUNNING,
+                    other.hostname == orm.hostname,
+                )
+                .scalar_subquery()
+            )
+            claimed = JobORM.query.filter(
+                JobORM.id == orm.id,
+                JobORM.status == JobStatusCode.QUEUED,
+                running_plan_count == 0,
+            ).update(
+                {"status": JobStatusCode.RUNNING, "started": utcnow(), **self.lease()},
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if claimed == 1:
+                return Job(orm)
+
+        if JobType.APPLY in self.job_types:
+            max_concurrency = get_config()["max_concurrent_applies"]
+            max_concurrency_per_project = get_config()[
+                "max_concurrent_applies_per_project"
+            ]
+            queued, running = ApplyScheduler.jobs()
+            for orm in ApplyScheduler.select(
+                queued, running, max_concurrency, max_concurrency_per_project
+            ):
+                if ApplyScheduler.claim(
+                    orm, max_concurrency, max_concurrency_per_project, **self.lease()
+                ):
+                    return Job(orm)
+
+        if JobType.DRIFT in self.job_types:
+            for orm in DriftScheduler.jobs():
+                if DriftScheduler.claim(orm, **self.lease()):
+                    return Job(orm)
+        return None
+
+    def execute(self, app, job_id):
+        with app.app_context():
+            try:
+                JobQueue.perform(Job.get(job_id))
+            finally:
+                with self._lock:
+                    self.active.discard(job_id)
+
+    def fill(self, app):
+        """
+        Claims jobs until every worker of this runner is busy or the queue is empty.
+        """
+        while len(self.active) < self.workers:
+            job = self.claim()
+            if job is None:
+                break
+            logging.info(f"Runner {self.name} claimed {job.type.value} job {job.id}")
+            with self._lock:
+                self.active.add(job.id)
+            self._executor.submit(self.execute, app, job.id)
+
+    def run(self, app, poll_interval=2):
+        """
+        Runs jobs until `stop` is called, then waits for the running jobs to finish.
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="mchub-runner"
+        )
+        heartbeat_interval = self.lease_duration.total_seconds() / 3
+        last_heartbeat = 0
+        logging.info(f"Runner {self.name} started with {self.workers} workers")
+        with app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    if monotonic() - last_heartbeat >= heartbeat_interval:
+                        self.heartbeat()
+                        reclaimed = self.reclaim()
+                        if reclaimed:
+                            logging.warning(
+                                f"Requeued {reclaimed} jobs with an expired lease"
+                            )
+                        self.recover_applies(app)
+                        if JobType.DRIFT in self.job_types:
+                            DriftScheduler.schedule()
+                        last_heartbeat = monotonic()
+                    self.fill(app)
+                except Exception as error:
+                    logging.exception(f"Runner {self.name} failed to poll - {error}")
+                    db.session.rollback()
+                self._stopping.wait(poll_interval)
+
+            logging.info(f"Runner {self.name} waiting for {len(self.active)} jobs")
+            while self.active:
+                self.heartbeat()
+                sleep(min(poll_interval, heartbeat_interval))
+        self._executor.shutdown(wait=True)
+
+    def stop(self):
+        self._stopping.set()
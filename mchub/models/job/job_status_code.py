@@ -0,0 +1,9 @@
+from enum import Enum
+
+
+class JobStatusCode(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCESS = "success"
+    ERROR = "error"
+    CANCELLED = "cancelled"
@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class JobType(str, Enum):
+    PLAN = "plan"
+    APPLY = "apply"
+    DRIFT = "drift"
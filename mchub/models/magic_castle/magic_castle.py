@@ -1,16 +1,29 @@
 import datetime
+import gzip
+import hashlib
 import json
 import logging
 
 import humanize
 
-from os import path, environ, mkdir, remove, scandir, rename, symlink
-from subprocess import run, CalledProcessError
-from shutil import rmtree
-from threading import Thread
+from os import (
+    path,
+    environ,
+    link,
+    makedirs,
+    mkdir,
+    remove,
+    scandir,
+    rename,
+    stat,
+    symlink,
+)
+from subprocess import CalledProcessError
+from shutil import copy2, copytree, rmtree
+from tempfile import mkdtemp
 
 from marshmallow import ValidationError
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from sqlalchemy.exc import IntegrityError
 
 from mchub.models.cloud.cloud_manager import CloudManager
@@ -18,17 +31,45 @@ from mchub.models.cloud.cloud_manager import CloudManager
 from .magic_castle_configuration import MagicCastleConfiguration
 from .cluster_status_code import ClusterStatusCode
 from .plan_type import PlanType
+from .plan_mode import PlanMode
 
+from ..events.cluster_events import ClusterEvents
 from ..terraform.terraform_state import TerraformState
+from ..terraform.apply_journal import ApplyJournal
+from ..terraform.apply_log_tracker import ApplyLogTracker
 from ..terraform.terraform_plan_parser import TerraformPlanParser
+from ..terraform.terraform_cache import (
+    TerraformCache,
+    TERRAFORM_DATA_DIRNAME,
+    TERRAFORM_LOCK_FILENAME,
+    link_or_copy,
+)
+from ..terraform.terraform_parallelism import TerraformParallelism
+from ..terraform.terraform_process import (
+    run,
+    TerraformCancelledError,
+    TerraformRun,
+    TerraformSupervisor,
+    TerraformTimeoutError,
+)
+from ..terraform.workspace_pool import WorkspacePool
 from ..cloud.dns_manager import DnsManager
 from ..cloud.project import Project
+from ..job.job import Job
+from ..job.job_queue import JobQueue
+from ..job.job_priority import JobPriority
+from ..job.apply_scheduler import ApplyScheduler
+from ..job.job_type import JobType
+from ..job.job_status_code import JobStatusCode
 from ..puppet.provisioning_manager import ProvisioningManager, MAX_PROVISIONING_TIME
+from ..warm_pool.warm_pool import WarmPoolORM
 
+from ...configuration import get_config
 from ...configuration.magic_castle import (
     MAIN_TERRAFORM_FILENAME,
     TERRAFORM_STATE_FILENAME,
     MAGIC_CASTLE_PATH,
+    MAGIC_CASTLE_VERSION,
 )
 from ...configuration.env import CLUSTERS_PATH
 
@@ -41,77 +82,21 @@ from ...exceptions.invalid_usage_exception import (
 )
 from ...exceptions.server_exception import (
     PlanException,
+    ApplyException,
 )
 
 from ...database import db
 
-
 TERRAFORM_PLAN_BINARY_FILENAME = "terraform_plan"
 TERRAFORM_APPLY_LOG_FILENAME = "terraform_apply.log"
 TERRAFORM_PLAN_LOG_FILENAME = "terraform_plan.log"
-
-
-def terraform_apply(cluster_id, env, main_path, destroy):
-    log_path = path.join(main_path, TERRAFORM_APPLY_LOG_FILENAME)
-    plan_path = path.join(main_path, TERRAFORM_PLAN_BINARY_FILENAME)
-    try:
-        with open(log_path, "w") as output_file:
-            run(
-                [
-                    "terraform",
-                    "apply",
-                    "-input=false",
-                    "-no-color",
-                    "-auto-approve",
-                    plan_path,
-                ],
-                cwd=main_path,
-                stdout=output_file,
-                stderr=output_file,
-                check=True,
-                env=env,
-            )
-    except CalledProcessError as err:
-        logging.error(f"An error occurred while running terraform apply: {err}")
-        if destroy:
-            status = ClusterStatusCode.DESTROY_ERROR
-        else:
-            status = ClusterStatusCode.BUILD_ERROR
-        # Disable removal from database
-        destroy = False
-    else:
-        if not destroy:
-            status = ClusterStatusCode.PROVISIONING_RUNNING
-    finally:
-        # Remove plan
-        if destroy:
-            rmtree(main_path, ignore_errors=True)
-        else:
-            remove(path.join(main_path, TERRAFORM_PLAN_BINARY_FILENAME))
-
-        # Retrieve terraform state
-        try:
-            with open(
-                path.join(main_path, TERRAFORM_STATE_FILENAME), "r"
-            ) as tf_state_file:
-                tf_state = TerraformState(json.load(tf_state_file))
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            tf_state = None
-
-        # Save results in database
-        from ... import create_app
-
-        with create_app().app_context():
-            orm = MagicCastleORM.query.get(cluster_id)
-            if destroy:
-                db.session.delete(orm)
-            else:
-                orm.plan_type = PlanType.NONE
-                orm.plan = None
-                orm.status = status
-                orm.tf_state = tf_state
-                orm.applied_config = orm.config
-            db.session.commit()
+# Plan exported with terraform show -json when `keep_full_plan` is enabled
+TERRAFORM_FULL_PLAN_FILENAME = "terraform_plan.json.gz"
+TERRAFORM_PLANS_DIRNAME = "plans"
+TERRAFORM_DRIFT_LOG_FILENAME = "terraform_drift.log"
+TERRAFORM_PREVIEWS_DIRNAME = "previews"
+# Throwaway workspaces of the previews, in the clusters directory for hardlinks to work
+PREVIEW_WORKSPACES_DIRNAME = ".previews"
 
 
 class MagicCastleORM(db.Model):
@@ -125,9 +110,19 @@ class MagicCastleORM(db.Model):
     config = db.Column(db.PickleType())
     applied_config = db.Column(db.PickleType())
     tf_state = db.Column(db.PickleType())
-    plan = db.Column(db.PickleType())
+    # Only the resource changes of the plan, loaded when the progress is requested
+    plan = db.deferred(db.Column(db.PickleType()))
+    plan_fingerprint = db.Column(db.String(64))
+    plan_targets = db.Column(db.PickleType())
+    drift = db.Column(db.PickleType())
+    drift_checked = db.Column(db.DateTime())
     project_id = db.Column(db.Integer, db.ForeignKey("project.id"))
     project = db.relationship("Project", back_populates="magic_castles", uselist=False)
+    warm_pool_id = db.Column(db.Integer, db.ForeignKey(WarmPoolORM.id))
+    # Incremented by every update of the row, NULL for the rows created before it existed
+    version = db.Column(
+        db.Integer, default=1, onupdate=text("coalesce(version, 0) + 1")
+    )
 
 
 class MagicCastle:
@@ -221,11 +216,9 @@ class MagicCastle:
     @property
     def status(self) -> ClusterStatusCode:
         if self.orm.status == ClusterStatusCode.PROVISIONING_RUNNING:
-            now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
-            if ProvisioningManager.check_online(self.hostname):
-                self.status = ClusterStatusCode.PROVISIONING_SUCCESS
-            elif MAX_PROVISIONING_TIME < (now - self.orm.created).total_seconds():
-                self.status = ClusterStatusCode.PROVISIONING_ERROR
+            self.update_provisioning_status(
+                ProvisioningManager.check_online(self.hostname)
+            )
 
         return self.orm.status
 
@@ -233,6 +226,7 @@ class MagicCastle:
     def status(self, status: ClusterStatusCode):
         self.orm.status = status
         db.session.commit()
+        ClusterEvents.notify(self.hostname)
 
         # Log cluster status updates for log analytics
         print(
@@ -245,6 +239,19 @@ class MagicCastle:
             flush=True,
         )
 
+    def update_provisioning_status(self, online):
+        """
+        Ends the provisioning of the cluster once its services are online, or once it
+        has lasted longer than MAX_PROVISIONING_TIME.
+
+        :param online: The result of ProvisioningManager.check_online for the cluster.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if online:
+            self.status = ClusterStatusCode.PROVISIONING_SUCCESS
+        elif MAX_PROVISIONING_TIME < (now - self.orm.created).total_seconds():
+            self.status = ClusterStatusCode.PROVISIONING_ERROR
+
     def rotate_terraform_logs(self, *, apply: bool):
         """
         Rotates filenames for logs generated by running `terraform plan` or `terraform apply`.
@@ -298,17 +305,24 @@ class MagicCastle:
     def plan(self, plan: dict):
         self.orm.plan = plan
 
+    @property
+    def plan_targets(self):
+        return self.orm.plan_targets
+
+    @plan_targets.setter
+    def plan_targets(self, targets):
+        self.orm.plan_targets = targets
+
+    @property
+    def plan_mode(self) -> PlanMode:
+        return PlanMode.TARGETED if self.plan_targets else PlanMode.FULL
+
     def get_progress(self):
         if self.plan is None:
             return None
-
-        try:
-            with open(path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME), "r") as file:
-                terraform_output = file.read()
-        except FileNotFoundError:
-            # terraform apply was not launched yet, therefore the log file does not exist
-            terraform_output = ""
-        return TerraformPlanParser.get_done_changes(self.plan, terraform_output)
+        return ApplyLogTracker.get(
+            path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME)
+        ).get_changes(self.plan)
 
     @property
     def state(self):
@@ -320,8 +334,27 @@ class MagicCastle:
             "age": self.age,
             "expiration_date": self.expiration_date,
             "cloud": {"name": self.project.name, "id": self.project.id},
+            "drift": self.drift,
         }
 
+    @property
+    def drift(self):
+        return self.orm.drift
+
+    def get_change_version(self):
+        """
+        The change version is cheap to get, compared to the state or the progress of the
+        cluster, and changes whenever they may have changed.
+
+        :return: The version of the row of the cluster, with the inode, the size and
+                 the modification time of its apply log.
+        """
+        try:
+            log = stat(path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME))
+        except FileNotFoundError:
+            return [self.orm.version, None]
+        return [self.orm.version, [log.st_ino, log.st_size, log.st_mtime_ns]]
+
     @property
     def tf_state(self):
         return self.orm.tf_state
@@ -370,15 +403,20 @@ class MagicCastle:
     def plan_creation(self, data):
         self.set_configuration(data)
         self.plan_type = PlanType.BUILD
+        self.plan_targets = None
         db.session.add(self.orm)
         try:
             db.session.commit()
         except IntegrityError:
             raise ClusterExistsException
 
-        # Create cluster folder on the filesystem
+        # Take an initialized workspace from the pool, or create the cluster folder
         try:
-            mkdir(self.path)
+            from_pool = WorkspacePool.take(
+                self.path, self.project.provider, DnsManager(self.domain).module
+            )
+            if not from_pool:
+                mkdir(self.path)
         except Exception as error:
             self.delete()
             raise PlanException(
@@ -386,7 +424,7 @@ class MagicCastle:
                 additional_details=f"hostname: {self.hostname}, error: {error}",
             )
 
-        if MAGIC_CASTLE_PATH[:3] != "git":
+        if not from_pool and MAGIC_CASTLE_PATH[:3] != "git":
             symlink(
                 path.join(MAGIC_CASTLE_PATH, self.project.provider),
                 path.join(self.path, self.project.provider),
@@ -406,31 +444,45 @@ class MagicCastle:
                 additional_details=f"hostname: {self.hostname}, error: {error}",
             )
 
-        # Initialize terraform modules
-        try:
-            run(
-                ["terraform", "init", "-no-color", "-input=false"],
-                cwd=self.path,
-                capture_output=True,
-                check=True,
-            )
-        except Exception as error:
-            self.delete()
-            raise PlanException(
-                "Could not initialize Terraform modules.",
-                additional_details=f"hostname: {self.hostname}, error: {error}",
-            )
+        self.status = ClusterStatusCode.PLAN_RUNNING
+        return self.queue_plan()
 
-        self.status = ClusterStatusCode.CREATED
-        self.create_plan()
+    def get_pending_plan(self):
+        """
+        :return: The job of the modification plan queued or running for the cluster, or None.
+        """
+        if (
+            self.orm.status != ClusterStatusCode.PLAN_RUNNING
+            or self.plan_type != PlanType.BUILD
+        ):
+            return None
+        job = Job.latest(self.hostname)
+        if (
+            job is None
+            or job.type != JobType.PLAN
+            or job.status not in (JobStatusCode.QUEUED, JobStatusCode.RUNNING)
+        ):
+            return None
+        return job
+
+    def is_superseded(self, job: Job):
+        """
+        :return: True if a plan of a newer configuration was queued after the given job.
+        """
+        latest = Job.latest(self.hostname)
+        return job is not None and latest is not None and latest.id != job.id
 
     def plan_modification(self, data):
         if not self.found:
             raise ClusterNotFoundException
-        if self.is_busy:
+        pending = self.get_pending_plan()
+        if self.is_busy and pending is None:
             raise BusyClusterException
 
+        hostname = self.hostname
         config_changed = self.set_configuration(data)
+        if pending is not None:
+            return self.coalesce_plan(pending, config_changed, hostname)
         prev_plan_type = self.plan_type
         self.plan_type = PlanType.BUILD
         db.session.commit()
@@ -452,30 +504,256 @@ class MagicCastle:
             or prev_plan_type != PlanType.BUILD
         ):
             self.remove_existing_plan()
+            self.set_plan_targets()
+            if self.reuse_plan():
+                return None
             self.rotate_terraform_logs(apply=False)
-            self.create_plan()
+            self.status = ClusterStatusCode.PLAN_RUNNING
+            return self.queue_plan(debounce=True)
+        return None
+
+    def set_plan_targets(self):
+        # Scaling compute nodes only plans the affected resources
+        if get_config()["targeted_plans"] and self.tf_state is not None:
+            self.plan_targets = self.config.get_scaling_targets(
+                self.applied_config, self.tf_state
+            )
+        else:
+            self.plan_targets = None
+
+    def coalesce_plan(self, pending: Job, config_changed, hostname):
+        """
+        Replaces the configuration of the modification plan queued or running, instead of
+        rejecting the modification. A queued plan waits `plan_debounce` more seconds for
+        further modifications. A running plan is outdated: a new plan is queued, and the
+        outcome of the running one is discarded once it finishes.
+
+        :return: The job in charge of planning the latest configuration.
+        """
+        if self.hostname != hostname:
+            # The cluster cannot be renamed while terraform may run in its folder
+            db.session.rollback()
+            raise BusyClusterException
+        if not config_changed:
+            db.session.commit()
+            return pending
+        self.set_plan_targets()
+        db.session.commit()
+        if pending.status == JobStatusCode.QUEUED and pending.defer(
+            self.get_debounce_deadline()
+        ):
+            return pending
+        return self.queue_plan(debounce=True)
+
+    @staticmethod
+    def get_debounce_deadline():
+        debounce = get_config()["plan_debounce"]
+        if not debounce:
+            return None
+        return datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None
+        ) + datetime.timedelta(seconds=debounce)
 
     def plan_destruction(self):
         if self.is_busy:
             raise BusyClusterException
 
         self.plan_type = PlanType.DESTROY
+        self.plan_targets = None
         if self.tf_state is not None:
             self.remove_existing_plan()
+            if self.reuse_plan():
+                return None
             self.rotate_terraform_logs(apply=False)
-            self.create_plan()
+            self.status = ClusterStatusCode.PLAN_RUNNING
+            return self.queue_plan()
         else:
             self.delete()
+            return None
 
-    def create_plan(self):
+    def get_plan_fingerprint(self):
+        """
+        Computes a digest of the inputs of terraform plan: main.tf.json, the credentials of
+        the project and of the DNS provider, the Magic Castle version, the serial of the
+        terraform state, the type of plan and its targets.
+        """
+        digest = hashlib.sha256()
+        with open(self.main_file, "rb") as main_file:
+            digest.update(main_file.read())
+        try:
+            with open(path.join(self.path, TERRAFORM_STATE_FILENAME)) as state_file:
+                state = json.load(state_file)
+            serial = [state.get("lineage"), state.get("serial")]
+        except (FileNotFoundError, json.JSONDecodeError):
+            serial = None
+        digest.update(
+            json.dumps(
+                [
+                    self.project.env,
+                    DnsManager(self.domain).get_environment_variables(),
+                    MAGIC_CASTLE_VERSION,
+                    serial,
+                    self.plan_type.value,
+                    self.plan_targets,
+                ],
+                sort_keys=True,
+            ).encode()
+        )
+        return digest.hexdigest()
+
+    def save_plan(self, fingerprint):
+        """
+        Keeps the plan binary and the parsed plan under the fingerprint of their inputs.
+        """
+        plans_path = path.join(self.path, TERRAFORM_PLANS_DIRNAME)
+        try:
+            makedirs(plans_path, exist_ok=True)
+            saved_plan = path.join(plans_path, fingerprint)
+            if not path.exists(saved_plan):
+                link(path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME), saved_plan)
+            with open(f"{saved_plan}.json", "w") as file:
+                json.dump(self.plan, file)
+        except OSError as error:
+            logging.warning(f"Could not save the plan of {self.hostname} - {error}")
+
+    def save_full_plan(self, job=None):
+        """
+        Exports the binary plan with `terraform show -json`, compressed, for the admins to
+        inspect. MC Hub itself only relies on the resource changes kept with the cluster.
+        """
+        try:
+            result = run(
+                [
+                    "terraform",
+                    "show",
+                    "-no-color",
+                    "-json",
+                    TERRAFORM_PLAN_BINARY_FILENAME,
+                ],
+                cwd=self.path,
+                capture_output=True,
+                check=True,
+                job=job,
+            )
+            with gzip.open(
+                path.join(self.path, TERRAFORM_FULL_PLAN_FILENAME), "wb"
+            ) as file:
+                file.write(result.stdout)
+        except (CalledProcessError, OSError) as error:
+            logging.warning(
+                f"Could not save the full plan of {self.hostname} - {error}"
+            )
+
+    def reuse_plan(self):
+        """
+        Restores the plan created earlier from the same inputs, if any, instead of planning.
+
+        :return: True if the plan was restored.
+        """
+        fingerprint = self.get_plan_fingerprint()
+        saved_plan = path.join(self.path, TERRAFORM_PLANS_DIRNAME, fingerprint)
+        try:
+            with open(f"{saved_plan}.json") as file:
+                plan = json.load(file)
+            link(saved_plan, path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME))
+        except (OSError, json.JSONDecodeError):
+            return False
+
+        self.plan = plan
+        self.orm.plan_fingerprint = fingerprint
+        if self.tf_state:
+            self.status = ClusterStatusCode.PROVISIONING_RUNNING
+        else:
+            self.status = ClusterStatusCode.CREATED
+        return True
+
+    def queue_plan(self, debounce=False, submit=True):
+        """
+        Queues the creation of the terraform plan in the background job queue.
+
+        :param debounce: True to start the plan after `plan_debounce` seconds, so that
+                         the modifications sent in the meantime are planned together.
+        :param submit: False to only record the job in the database, for the web server
+                       to pick it up when it starts (see JobQueue.resume).
+        :return: The job in charge of creating the plan.
+        """
+        job = Job.create(
+            self.hostname,
+            JobType.PLAN,
+            project_id=self.project.id,
+            not_before=self.get_debounce_deadline() if debounce else None,
+        )
+        if submit:
+            JobQueue.submit(job)
+        return job
+
+    @property
+    def initialized(self):
+        return path.exists(path.join(self.path, TERRAFORM_DATA_DIRNAME))
+
+    def init(self, job=None):
+        try:
+            self.init_modules(job)
+        except PlanException:
+            self.status = ClusterStatusCode.PLAN_ERROR
+            raise
+
+    def init_modules(self, job=None):
+        """
+        Initializes the terraform modules, without changing the status of the cluster.
+        """
+        if TerraformCache.populate(self.path):
+            return
+        try:
+            run(
+                ["terraform", "init", "-no-color", "-input=false"],
+                cwd=self.path,
+                capture_output=True,
+                check=True,
+                job=job,
+            )
+        except Exception as error:
+            raise PlanException(
+                "Could not initialize Terraform modules.",
+                additional_details=f"hostname: {self.hostname}, error: {error}",
+            )
+        TerraformCache.mark_initialized(self.path)
+
+    def run_plan(self, parallelism=None, job=None):
+        """
+        Initializes the terraform modules if required and creates the plan.
+        Called by the job queue worker in charge of the plan job.
+        """
+        # The configuration may have changed while the plan was queued
+        self.config.write(self.main_file)
+        if not self.initialized:
+            self.init(job)
+        self.create_plan(parallelism, job)
+        if (
+            self.orm.warm_pool_id is not None
+            and self.plan_type == PlanType.BUILD
+            and self.orm.status == ClusterStatusCode.CREATED
+        ):
+            # The clusters of a warm pool are built without waiting for a user
+            self.apply()
+
+    def create_plan(self, parallelism=None, job=None):
         destroy = self.plan_type == PlanType.DESTROY
+        self.orm.plan_fingerprint = None
         self.status = ClusterStatusCode.PLAN_RUNNING
+        fingerprint = self.get_plan_fingerprint()
 
         environment_variables = environ.copy()
         dns_manager = DnsManager(self.domain)
         environment_variables.update(dns_manager.get_environment_variables())
         environment_variables.update(self.project.env)
         plan_log = path.join(self.path, TERRAFORM_PLAN_LOG_FILENAME)
+        try:
+            # The binary plan may be hardlinked to a saved plan, which terraform would
+            # overwrite in place
+            remove(path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME))
+        except FileNotFoundError:
+            pass
         try:
             with open(plan_log, "w") as output_file:
                 run(
@@ -484,20 +762,43 @@ class MagicCastle:
                         "plan",
                         "-input=false",
                         "-no-color",
+                        "-json",
                         "-refresh=" + ("true" if destroy else "false"),
                         "-destroy=" + ("true" if destroy else "false"),
                         "-out=" + path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME),
+                        *[f"-target={target}" for target in self.plan_targets or []],
+                        *TerraformParallelism.get_args(parallelism),
                     ],
                     cwd=self.path,
                     env=environment_variables,
                     stdout=output_file,
                     stderr=output_file,
                     check=True,
+                    job=job,
+                )
+        except CalledProcessError as error:
+            if self.is_superseded(job):
+                raise PlanException(
+                    "The plan was superseded by a newer configuration.",
+                    additional_details=f"hostname: {self.hostname}",
+                )
+            if self.plan_targets and not isinstance(
+                error, (TerraformCancelledError, TerraformTimeoutError)
+            ):
+                logging.warning(
+                    f"Targeted plan of {self.hostname} failed, planning the whole cluster"
                 )
-        except CalledProcessError:
+                self.plan_targets = None
+                return self.create_plan(parallelism, job)
             self.status = ClusterStatusCode.PLAN_ERROR
             with open(plan_log, "r") as input_file:
                 log = input_file.read()
+            if TerraformPlanParser.is_json_log(log):
+                log = json.dumps(
+                    TerraformPlanParser.get_diagnostics(
+                        TerraformPlanParser.parse_json_log(log)
+                    )
+                )
             raise PlanException(
                 "An error occurred while planning changes.",
                 additional_details=f"hostname: {self.hostname}\nlog: {log}",
@@ -509,54 +810,302 @@ class MagicCastle:
                 additional_details=f"hostname: {self.hostname}\nerror: {err}",
             )
 
+        # The planned changes are streamed by terraform plan -json,
+        # no need to export the binary plan with terraform show.
+        with open(plan_log, "r") as input_file:
+            plan = TerraformPlanParser.get_planned_changes(
+                TerraformPlanParser.iter_json_log(input_file)
+            )
+        if self.is_superseded(job):
+            # The newer plan replaces the binary plan, this one can still be reused
+            self.plan = plan
+            self.save_plan(fingerprint)
+            db.session.rollback()
+            logging.info(f"Discarded the outdated plan of {self.hostname}")
+            return
+        self.plan = plan
+        self.orm.plan_fingerprint = fingerprint
+        self.save_plan(fingerprint)
+        if get_config()["keep_full_plan"]:
+            self.save_full_plan(job)
+
+        if self.tf_state:
+            self.status = ClusterStatusCode.PROVISIONING_RUNNING
+        else:
+            self.status = ClusterStatusCode.CREATED
+        db.session.commit()
+
+    def preview(self, data):
+        """
+        Plans a configuration without changing the cluster: the configuration, the status,
+        the logs and the plan of the cluster are left untouched. The plan runs in a
+        throwaway copy of the cluster's folder, whose terraform files are hardlinked.
+
+        Previews are cached by a digest of their inputs (main.tf.json, credentials,
+        terraform state serial and Magic Castle version), until the next apply.
+
+        :return: The resource changes and the change summary of the plan.
+        """
+        if not self.found:
+            raise ClusterNotFoundException
+        if self.orm.status in (
+            ClusterStatusCode.BUILD_RUNNING,
+            ClusterStatusCode.DESTROY_RUNNING,
+        ):
+            raise BusyClusterException
+
+        data = dict(data)
+        data.pop("expiration_date", None)
+        cloud = data.pop("cloud", None)
+        cloud_id = cloud.get("id") if isinstance(cloud, dict) else None
+        project = Project.query.get(cloud_id) if cloud_id else self.project
+        if project is None:
+            raise InvalidUsageException("Invalid project id")
+        try:
+            config = MagicCastleConfiguration(project.provider, data)
+        except ValidationError as err:
+            raise InvalidUsageException(
+                f"The magic castle configuration could not be parsed.\nError: {err.messages}"
+            )
+
+        environment_variables = environ.copy()
+        environment_variables.update(
+            DnsManager(config.domain).get_environment_variables()
+        )
+        environment_variables.update(project.env)
         try:
-            proc = run(
+            with open(path.join(self.path, TERRAFORM_STATE_FILENAME)) as state_file:
+                state = json.load(state_file)
+            serial = [state.get("lineage"), state.get("serial")]
+        except (FileNotFoundError, json.JSONDecodeError):
+            serial = None
+        digest = hashlib.sha256(config.render().encode())
+        digest.update(
+            json.dumps(
+                [
+                    project.env,
+                    DnsManager(config.domain).get_environment_variables(),
+                    MAGIC_CASTLE_VERSION,
+                    serial,
+                ],
+                sort_keys=True,
+            ).encode()
+        )
+        cached_preview = path.join(
+            self.path,
+            TERRAFORM_PLANS_DIRNAME,
+            TERRAFORM_PREVIEWS_DIRNAME,
+            f"{digest.hexdigest()}.json",
+        )
+        try:
+            with open(cached_preview) as file:
+                return {**json.load(file), "cached": True}
+        except (OSError, json.JSONDecodeError):
+            pass
+
+        workspace = self.create_preview_workspace(config)
+        try:
+            # Without the state lock, the plans of the cluster are never blocked
+            result = run(
                 [
                     "terraform",
-                    "show",
+                    "plan",
+                    "-input=false",
                     "-no-color",
                     "-json",
-                    path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME),
+                    "-refresh=false",
+                    "-lock=false",
                 ],
-                cwd=self.path,
+                cwd=workspace,
+                env=environment_variables,
                 capture_output=True,
-                check=True,
             )
-        except CalledProcessError:
-            self.status = ClusterStatusCode.PLAN_ERROR
+        except OSError as error:
             raise PlanException(
-                "An error occurred while exporting planned changes.",
-                additional_details=f"hostname: {self.hostname}",
+                "An error occurred while previewing changes.",
+                additional_details=f"hostname: {self.hostname}, error: {error}",
             )
-        except BaseException as err:
-            self.status = ClusterStatusCode.PLAN_ERROR
+        finally:
+            rmtree(workspace, ignore_errors=True)
+
+        events = TerraformPlanParser.parse_json_log(
+            (result.stdout or b"").decode(errors="replace")
+        )
+        if result.returncode != 0:
             raise PlanException(
-                "An error occurred while exporting planned changes.",
-                additional_details=f"hostname: {self.hostname}\nerror: {err}",
+                "An error occurred while previewing changes.",
+                additional_details=f"hostname: {self.hostname}\nlog: "
+                f"{json.dumps(TerraformPlanParser.get_diagnostics(events))}",
             )
+        plan = TerraformPlanParser.get_planned_changes(events)
+        preview = {
+            "resources": TerraformPlanParser.get_resources_changes(plan),
+            "change_summary": plan["change_summary"],
+        }
+        try:
+            makedirs(path.dirname(cached_preview), exist_ok=True)
+            with open(cached_preview, "w") as file:
+                json.dump(preview, file)
+        except OSError as error:
+            logging.warning(f"Could not cache the preview of {self.hostname} - {error}")
+        return {**preview, "cached": False}
+
+    def create_preview_workspace(self, config):
+        """
+        Creates a throwaway copy of the cluster's folder with the given configuration and
+        initializes its terraform modules.
 
+        :return: The path of the workspace, to be removed by the caller.
+        :raise PlanException: When the workspace cannot be created or initialized.
+        """
+        workspaces_path = path.join(CLUSTERS_PATH, PREVIEW_WORKSPACES_DIRNAME)
+        workspace = None
         try:
-            self.plan = json.loads(proc.stdout)
-        except json.JSONDecodeError:
-            self.status = ClusterStatusCode.PLAN_ERROR
+            makedirs(workspaces_path, exist_ok=True)
+            workspace = mkdtemp(dir=workspaces_path, prefix=f"{self.hostname}-")
+            self.copy_workspace(workspace)
+            config.write(path.join(workspace, MAIN_TERRAFORM_FILENAME))
+        except OSError as error:
+            if workspace is not None:
+                rmtree(workspace, ignore_errors=True)
             raise PlanException(
-                "An error occurred while parsing planned changes.",
-                additional_details=f"hostname: {self.hostname}",
+                "Could not create the workspace of the preview.",
+                additional_details=f"hostname: {self.hostname}, error: {error}",
             )
-        except BaseException as err:
-            self.status = ClusterStatusCode.PLAN_ERROR
-            raise PlanException(
-                "An error occurred while parsing planned changes.",
-                additional_details=f"hostname: {self.hostname}\nerror: {err}",
+        if not path.exists(
+            path.join(workspace, TERRAFORM_DATA_DIRNAME)
+        ) and not TerraformCache.populate(workspace):
+            try:
+                run(
+                    ["terraform", "init", "-no-color", "-input=false"],
+                    cwd=workspace,
+                    capture_output=True,
+                    check=True,
+                )
+            except (CalledProcessError, OSError) as error:
+                rmtree(workspace, ignore_errors=True)
+                raise PlanException(
+                    "Could not initialize Terraform modules.",
+                    additional_details=f"hostname: {self.hostname}, error: {error}",
+                )
+        return workspace
+
+    def copy_workspace(self, workspace):
+        """
+        Copies the cluster's folder to the workspace, except for the plans and the logs.
+        The terraform modules and providers are hardlinked, the state is copied.
+        """
+        with scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    # Links to the local modules of Magic Castle
+                    symlink(
+                        path.join(self.path, entry.name),
+                        path.join(workspace, entry.name),
+                    )
+        data_path = path.join(self.path, TERRAFORM_DATA_DIRNAME)
+        if path.exists(data_path):
+            copytree(
+                data_path,
+                path.join(workspace, TERRAFORM_DATA_DIRNAME),
+                symlinks=True,
+                copy_function=link_or_copy,
             )
+        for filename in (TERRAFORM_LOCK_FILENAME, TERRAFORM_STATE_FILENAME):
+            if path.exists(path.join(self.path, filename)):
+                copy2(path.join(self.path, filename), path.join(workspace, filename))
 
-        if self.tf_state:
-            self.status = ClusterStatusCode.PROVISIONING_RUNNING
-        else:
-            self.status = ClusterStatusCode.CREATED
+    def run_drift_check(self, parallelism=None, job=None):
+        """
+        Compares the cloud resources with the terraform state using `terraform plan -refresh-only`
+        and saves the resources changed outside of terraform in the drift summary.
+        Called by the runner in charge of the drift job. Nothing is written to the state.
+        """
+        if (
+            self.status != ClusterStatusCode.PROVISIONING_SUCCESS
+            or self.plan_type not in (PlanType.NONE, None)
+        ):
+            # The cluster changed since the check was scheduled
+            return
+
+        checked = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if not self.initialized:
+            try:
+                # A failed check never changes the status of a provisioned cluster
+                self.init_modules(job)
+            except PlanException as error:
+                self.orm.drift = {
+                    "checked": checked.isoformat(),
+                    "drifted": False,
+                    "resources": [],
+                    "errors": [
+                        {"summary": error.message, "detail": None, "address": None}
+                    ],
+                }
+                self.orm.drift_checked = checked
+                db.session.commit()
+                raise
+
+        environment_variables = environ.copy()
+        environment_variables.update(
+            DnsManager(self.domain).get_environment_variables()
+        )
+        environment_variables.update(self.project.env)
+        drift_log = path.join(self.path, TERRAFORM_DRIFT_LOG_FILENAME)
+        error = None
+        try:
+            with open(drift_log, "w") as output_file:
+                # Without the state lock, an interactive plan is never blocked by the check
+                run(
+                    [
+                        "terraform",
+                        "plan",
+                        "-refresh-only",
+                        "-input=false",
+                        "-no-color",
+                        "-json",
+                        "-lock=false",
+                        *TerraformParallelism.get_args(parallelism),
+                    ],
+                    cwd=self.path,
+                    env=environment_variables,
+                    stdout=output_file,
+                    stderr=output_file,
+                    check=True,
+                    job=job,
+                )
+        except CalledProcessError as err:
+            error = err
+
+        try:
+            with open(drift_log, "r") as input_file:
+                events = TerraformPlanParser.parse_json_log(input_file.read())
+        except FileNotFoundError:
+            events = []
+        resources = TerraformPlanParser.get_drifted_resources(events)
+        self.orm.drift = {
+            "checked": checked.isoformat(),
+            "drifted": len(resources) > 0,
+            "resources": resources,
+            "errors": TerraformPlanParser.get_diagnostics(events),
+        }
+        self.orm.drift_checked = checked
         db.session.commit()
 
-    def apply(self):
+        if error is not None:
+            raise PlanException(
+                "An error occurred while detecting drift.",
+                additional_details=f"hostname: {self.hostname}, error: {error}",
+            )
+
+    def apply(self, culling=False):
+        """
+        Queues the application of the terraform plan in the apply scheduler.
+
+        :param culling: True if the destruction is requested because the cluster expired,
+                        in which case it is scheduled after the destructions requested by users.
+        :return: The job in charge of applying the plan.
+        """
         if self.plan is None or not path.exists(
             path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME)
         ):
@@ -566,34 +1115,316 @@ class MagicCastle:
 
         if self.plan_type == PlanType.BUILD:
             self.status = ClusterStatusCode.BUILD_RUNNING
-            destroy = False
+            if self.orm.warm_pool_id is not None:
+                priority = JobPriority.WARM_POOL
+            else:
+                priority = JobPriority.INTERACTIVE
         elif self.plan_type == PlanType.DESTROY:
             self.status = ClusterStatusCode.DESTROY_RUNNING
-            destroy = True
+            priority = JobPriority.CULLING if culling else JobPriority.DESTROY
         else:
             raise PlanNotCreatedException
 
+        self.rotate_terraform_logs(apply=True)
+        job = Job.create(
+            self.hostname,
+            JobType.APPLY,
+            project_id=self.project.id,
+            priority=priority,
+        )
+        ApplyScheduler.submit(job)
+        return job
+
+    def get_apply_command(self, parallelism, job, output_file):
+        """
+        :return: The arguments of terraform apply with the existing plan, and the keyword
+                 arguments of the command writing its log to the output file.
+        """
         env = environ.copy()
-        if destroy:
+        if self.plan_type == PlanType.DESTROY:
             env["TF_WARN_OUTPUT_ERRORS"] = "1"
         env.update(self.project.env)
         env.update(DnsManager(self.domain).get_environment_variables())
+        args = [
+            "terraform",
+            "apply",
+            "-input=false",
+            "-no-color",
+            "-json",
+            "-auto-approve",
+            *TerraformParallelism.get_args(parallelism),
+            path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME),
+        ]
+        # terraform writes its log itself and runs in its own session,
+        # hence it outlives a restart of MC Hub
+        return args, dict(
+            cwd=self.path,
+            stdout=output_file,
+            stderr=output_file,
+            env=env,
+            start_new_session=True,
+            on_start=lambda process: ApplyJournal.record(
+                self.path,
+                process.pid,
+                job_id=job.id if job is not None else None,
+                log_offset=output_file.tell(),
+            ),
+        )
 
-        self.rotate_terraform_logs(apply=True)
-        Thread(
-            target=terraform_apply, args=[self.orm.id, env, self.path, destroy]
-        ).start()
+    def run_apply(self, parallelism=None, job=None):
+        """
+        Runs terraform apply with the existing plan and saves the results in the database.
+        Called by the runners once the job in charge of the apply is started.
+
+        :param parallelism: The `-parallelism` of terraform, chosen by TerraformParallelism.
+                            The outcome of the apply adjusts the parallelism of the project.
+        """
+        # The cluster is deleted from the database once destroyed
+        project = self.project
+        log_path = path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME)
+        journal = ApplyJournal.read(self.path)
+        error = None
+        try:
+            if journal is not None and journal.is_alive():
+                self.reattach_apply(journal, job)
+            else:
+                with open(log_path, "w") as output_file:
+                    args, kwargs = self.get_apply_command(parallelism, job, output_file)
+                    run(args, check=True, job=job, **kwargs)
+        except CalledProcessError as err:
+            error = err
+        finally:
+            events = self.save_apply(error)
+        self.complete_apply(project, parallelism, events, error)
+
+    def start_apply(self, parallelism=None, job=None, cancelled=None) -> TerraformRun:
+        """
+        Starts terraform apply with the existing plan through the TerraformSupervisor,
+        without waiting for it. Once the returned run completed, `finish_apply` saves its
+        results. Called by the apply scheduler once the job in charge of the apply is started.
+
+        :param cancelled: Called from the worker thread of the supervisor, the apply is
+                          interrupted once it returns True.
+        """
+        output_file = open(path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME), "w")
+        try:
+            args, kwargs = self.get_apply_command(parallelism, job, output_file)
+            terraform_run = TerraformSupervisor.start(
+                args, cancelled=cancelled, **kwargs
+            )
+        except BaseException:
+            output_file.close()
+            raise
+        terraform_run.future.add_done_callback(lambda _: output_file.close())
+        return terraform_run
+
+    def finish_apply(self, terraform_run: TerraformRun, parallelism=None, job=None):
+        """
+        Saves the results of an apply started with `start_apply` in the database.
+        """
+        project = self.project
+        error = None
+        try:
+            terraform_run.result(job=job, check=True)
+        except CalledProcessError as err:
+            error = err
+        finally:
+            events = self.save_apply(error)
+        self.complete_apply(project, parallelism, events, error)
+
+    def save_apply(self, error=None):
+        """
+        Removes the plan applied, successfully or not, and saves the new terraform state
+        of the cluster in the database. A destroyed cluster is deleted from the database.
+
+        :return: The messages of the terraform apply.
+        """
+        log_path = path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME)
+        plan_path = path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME)
+        # Disable removal from database when the destruction failed
+        destroy = self.plan_type == PlanType.DESTROY and error is None
+        if error is not None:
+            if self.plan_type == PlanType.DESTROY:
+                status = ClusterStatusCode.DESTROY_ERROR
+            else:
+                status = ClusterStatusCode.BUILD_ERROR
+        else:
+            status = ClusterStatusCode.PROVISIONING_RUNNING
+
+        try:
+            with open(log_path, "r") as input_file:
+                events = TerraformPlanParser.parse_json_log(input_file.read())
+        except FileNotFoundError:
+            events = []
+
+        # Remove plan, and the saved plans since the terraform state has changed
+        if destroy:
+            rmtree(self.path, ignore_errors=True)
+        else:
+            remove(plan_path)
+            rmtree(path.join(self.path, TERRAFORM_PLANS_DIRNAME), ignore_errors=True)
+
+        tf_state = self.read_terraform_state()
+
+        # Save results in database
+        if destroy:
+            db.session.delete(self.orm)
+        else:
+            self.orm.plan_type = PlanType.NONE
+            self.orm.plan = None
+            self.orm.plan_fingerprint = None
+            self.orm.plan_targets = None
+            self.orm.drift = None
+            self.orm.status = status
+            self.orm.tf_state = tf_state
+            self.orm.applied_config = self.orm.config
+        db.session.commit()
+        ApplyJournal.discard(self.path)
+        return events
+
+    def complete_apply(self, project, parallelism, events, error=None):
+        """
+        Adjusts the parallelism of the project from the messages of the apply.
+
+        :raise ApplyException: When the apply failed.
+        """
+        if parallelism is not None:
+            TerraformParallelism.observe(project, parallelism, events)
+
+        if error is not None:
+            raise ApplyException(
+                "An error occurred while applying changes.",
+                additional_details=f"hostname: {self.hostname}, error: {error}, "
+                f"diagnostics: {json.dumps(TerraformPlanParser.get_diagnostics(events))}",
+            )
+
+    def read_terraform_state(self):
+        try:
+            with open(path.join(self.path, TERRAFORM_STATE_FILENAME), "r") as file:
+                return TerraformState(json.load(file))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+    def reattach_apply(self, journal: ApplyJournal, job: Job = None):
+        """
+        Waits for a terraform apply that kept running through a restart of MC Hub.
+        As terraform is not a child of this process, its outcome is read from its log.
+
+        :raise CalledProcessError: When the apply failed or was interrupted.
+        """
+        logging.info(
+            f"Reattaching to terraform apply of {self.hostname} ({journal.pid})"
+        )
+        journal.wait(job.is_cancel_requested if job is not None else None)
+        args = ["terraform", "apply"]
+        try:
+            with open(path.join(self.path, TERRAFORM_APPLY_LOG_FILENAME), "r") as file:
+                file.seek(journal.log_offset)
+                events = TerraformPlanParser.parse_json_log(file.read())
+        except FileNotFoundError:
+            raise CalledProcessError(1, args)
+        if TerraformPlanParser.get_diagnostics(events) or not any(
+            event.get("type") == "change_summary" for event in events
+        ):
+            if job is not None and job.is_cancel_requested():
+                raise TerraformCancelledError(1, args)
+            raise CalledProcessError(1, args)
+
+    def recover_apply(self):
+        """
+        Saves the outcome of an apply which died with MC Hub: the terraform state written
+        until then replaces the one in the database, and a new plan of the same type is
+        queued, which only plans the changes the apply did not make.
+
+        :return: The job in charge of the new plan, or None if the cluster was destroyed.
+        """
+        plan_type = self.plan_type
+        ApplyJournal.discard(self.path)
+        tf_state = self.read_terraform_state()
+        if plan_type == PlanType.DESTROY and (
+            not path.exists(self.path) or tf_state is None
+        ):
+            self.delete()
+            return None
+
+        self.remove_existing_plan()
+        rmtree(path.join(self.path, TERRAFORM_PLANS_DIRNAME), ignore_errors=True)
+        self.orm.plan = None
+        self.orm.plan_fingerprint = None
+        self.orm.plan_targets = None
+        self.orm.drift = None
+        self.orm.tf_state = tf_state
+        self.orm.applied_config = self.orm.config
+        self.orm.status = (
+            ClusterStatusCode.DESTROY_ERROR
+            if plan_type == PlanType.DESTROY
+            else ClusterStatusCode.BUILD_ERROR
+        )
+        db.session.commit()
+        if plan_type not in (PlanType.BUILD, PlanType.DESTROY):
+            return None
+
+        logging.info(f"Planning the changes left by the apply of {self.hostname}")
+        self.rotate_terraform_logs(apply=False)
+        self.status = ClusterStatusCode.PLAN_RUNNING
+        # Recovered by `schema_update --clean`, which exits before the plan could run,
+        # or by a runner, which claims the plan from the queue
+        return self.queue_plan(submit=False)
+
+    def cancel(self):
+        """
+        Cancels the plan or apply in progress. A queued job is cancelled right away. A running
+        job is cancelled by the worker running it, which interrupts terraform.
+
+        :return: The cancelled job.
+        """
+        job = Job.latest(self.hostname)
+        if job is None or job.status not in (
+            JobStatusCode.QUEUED,
+            JobStatusCode.RUNNING,
+        ):
+            raise InvalidUsageException(
+                "This cluster has no plan or apply in progress."
+            )
+        if job.cancel_queued():
+            self.reset_after_cancel(job)
+        else:
+            job.request_cancel()
+        return job
+
+    def reset_after_cancel(self, job: Job):
+        """
+        Returns the cluster to a stable status once its job is cancelled. A cancelled plan is
+        discarded. The plan of an apply cancelled before it started is kept, so it can be
+        applied later, while an interrupted apply keeps the error status and the partial
+        terraform state saved by run_apply.
+        """
+        if job.type == JobType.APPLY and job.orm.started is not None:
+            return
+        if job.type == JobType.PLAN:
+            self.remove_existing_plan()
+            self.plan = None
+            self.plan_type = PlanType.NONE
+            self.orm.plan_fingerprint = None
+            self.plan_targets = None
+        if self.tf_state:
+            self.status = ClusterStatusCode.PROVISIONING_RUNNING
+        else:
+            self.status = ClusterStatusCode.CREATED
 
     def delete(self):
+        hostname = self.hostname
         # Removes the content of the cluster's folder, even if not empty
         rmtree(self.path, ignore_errors=True)
         db.session.delete(self.orm)
         db.session.commit()
+        ClusterEvents.notify(hostname, deleted=True)
 
     def remove_existing_plan(self):
-        try:
-            # Remove existing plan, if it exists
-            remove(path.join(self.path, TERRAFORM_PLAN_BINARY_FILENAME))
-        except FileNotFoundError:
-            # Must be a new cluster, without existing plans
-            pass
+        for filename in (TERRAFORM_PLAN_BINARY_FILENAME, TERRAFORM_FULL_PLAN_FILENAME):
+            try:
+                # Remove existing plan, if it exists
+                remove(path.join(self.path, filename))
+            except FileNotFoundError:
+                # Must be a new cluster, without existing plans
+                pass
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import re
 
@@ -25,6 +26,22 @@ IGNORED_CONFIGURATION_FIELDS = [
     "puppetenv_rev",
 ]
 
+# Instances that can be added, removed or resized without planning the whole cluster
+SCALABLE_INSTANCE_TAGS = {"node"}
+
+# Resources of each instance, by cloud provider, and module of the cluster configuration
+INSTANCE_RESOURCES = {
+    "openstack": [
+        "openstack_compute_instance_v2.instances",
+        "openstack_networking_port_v2.nic",
+    ],
+}
+CLUSTER_CONFIG_MODULE = "cluster_config"
+# Address of a resource of the state keyed by a string, like the resources of instances
+KEYED_ADDRESS = re.compile(
+    r'(?P<resource>(?P<module>module\.\w+)\.\w+\.\w+)\["(?P<key>[^"]+)"\]'
+)
+
 
 def validate_cluster_name(cluster_name):
     # Must follow RFC 1035's subdomain naming rules: https://tools.ietf.org/html/rfc1035#section-2.3.1
@@ -124,11 +141,95 @@ class MagicCastleConfiguration(Mapping):
 
         return cls(provider, configuration)
 
-    def write(self, filename):
+    def get_scaling_targets(self, previous, tf_state=None):
         """
-        Formats the configuration and writes it to the cluster's main.tf.json file.
+        Compares the configuration with the previous one and lists the resources to plan when
+        the only changes are the count or the type of instances tagged with scalable tags.
+
+        The resources of the state keyed by the name of an affected instance are targeted,
+        e.g. its volumes and its floating IP. An added instance is expected to have the
+        same resources as the instances of its prefix found in the state: the whole
+        cluster is planned when they have resources other than `INSTANCE_RESOURCES`,
+        whose addresses cannot be derived, or when no instance of its prefix is found.
+
+        :param previous: The configuration currently applied to the cluster.
+        :param tf_state: The TerraformState of the cluster.
+        :return: The terraform addresses to target, or None if the whole cluster must be planned.
         """
+        if (
+            previous is None
+            or self.provider != previous.provider
+            or self.provider not in INSTANCE_RESOURCES
+            # States saved before their addresses were recorded
+            or getattr(tf_state, "addresses", None) is None
+        ):
+            return None
+        if {key: value for key, value in self.items() if key != "instances"} != {
+            key: value for key, value in previous.items() if key != "instances"
+        } or self["instances"].keys() != previous["instances"].keys():
+            return None
+
+        # The provider may be a Provider enum, whose format is not its value
+        module = "module." + self.provider
+        # The resources of the module keyed by a string, like the resources of instances
+        keyed = [
+            match
+            for match in map(KEYED_ADDRESS.fullmatch, tf_state.addresses)
+            if match is not None and match["module"] == module
+        ]
+        resources = [
+            f"{module}.{resource}" for resource in INSTANCE_RESOURCES[self.provider]
+        ]
+
+        targets = []
+        for prefix, instance in self["instances"].items():
+            previous_instance = previous["instances"][prefix]
+            if instance == previous_instance:
+                continue
+            if (
+                instance.get("tags") != previous_instance.get("tags")
+                or not set(instance.get("tags", [])) <= SCALABLE_INSTANCE_TAGS
+            ):
+                return None
+            count = instance.get("count", 0)
+            previous_count = previous_instance.get("count", 0)
+            if instance.get("type") != previous_instance.get("type"):
+                # Resized instances and removed instances
+                indexes = range(1, max(count, previous_count) + 1)
+            else:
+                indexes = range(
+                    min(count, previous_count) + 1, max(count, previous_count) + 1
+                )
 
+            # The resources of an instance are keyed by its name, or by its name followed
+            # by a dash, like its volumes
+            existing = [
+                match
+                for match in keyed
+                if re.fullmatch(rf"{re.escape(prefix)}\d+(-.*)?", match["key"])
+            ]
+            for index in indexes:
+                name = f"{prefix}{index}"
+                addresses = [
+                    match[0]
+                    for match in existing
+                    if match["key"] == name or match["key"].startswith(f"{name}-")
+                ]
+                if not addresses:
+                    if not existing or any(
+                        match["resource"] not in resources for match in existing
+                    ):
+                        return None
+                    addresses = [f'{resource}["{name}"]' for resource in resources]
+                targets += addresses
+        if not targets:
+            return None
+        return targets + [f"{module}.module.{CLUSTER_CONFIG_MODULE}"]
+
+    def render(self):
+        """
+        Formats the configuration as the content of the cluster's main.tf.json file.
+        """
         main_tf_data = {
             "terraform": {"required_version": TERRAFORM_REQUIRED_VERSION},
             "module": {
@@ -144,6 +245,26 @@ class MagicCastleConfiguration(Mapping):
         main_tf_data["module"].update(
             DnsManager(self["domain"]).get_magic_castle_configuration()
         )
+        return json.dumps(main_tf_data)
+
+    def write(self, filename):
+        """
+        Formats the configuration and writes it to the cluster's main.tf.json file.
+        The file is left untouched when its content would not change.
+
+        :return: True if the file was written.
+        """
+        content = self.render()
+        try:
+            with open(filename, "rb") as main_terraform_file:
+                if (
+                    hashlib.sha256(main_terraform_file.read()).digest()
+                    == hashlib.sha256(content.encode()).digest()
+                ):
+                    return False
+        except FileNotFoundError:
+            pass
 
         with open(filename, "w") as main_terraform_file:
-            json.dump(main_tf_data, main_terraform_file)
+            main_terraform_file.write(content)
+        return True
@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class PlanMode(str, Enum):
+    FULL = "full"
+    TARGETED = "targeted"
@@ -1,8 +1,11 @@
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import ConnectionError, ReadTimeout
 
 MAX_PROVISIONING_TIME = 3600
+# Maximum number of clusters checked at once by check_all_online
+MAX_CONCURRENT_CHECKS = 16
 
 
 class ProvisioningManager:
@@ -34,3 +37,19 @@ class ProvisioningManager:
             )
         except (ConnectionError, ReadTimeout):
             return False
+
+    @classmethod
+    def check_all_online(cls, hostnames):
+        """
+        Checks the clusters concurrently, so that checking many clusters takes about
+        as long as checking one.
+
+        :return: {hostname: True if the services of the cluster are online}
+        """
+        hostnames = list(hostnames)
+        if len(hostnames) < 2:
+            return {hostname: cls.check_online(hostname) for hostname in hostnames}
+        with ThreadPoolExecutor(
+            max_workers=min(len(hostnames), MAX_CONCURRENT_CHECKS)
+        ) as executor:
+            return dict(zip(hostnames, executor.map(cls.check_online, hostnames)))
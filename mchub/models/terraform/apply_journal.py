@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import signal
+import socket
+
+from os import path
+from time import sleep, time
+
+TERRAFORM_APPLY_JOURNAL_FILENAME = "terraform_apply.journal"
+# Seconds between two checks of a reattached terraform apply
+REATTACH_POLL_INTERVAL = 5
+
+
+def get_process_start_time(pid):
+    """
+    :return: The start time of the process, in clock ticks since boot, which tells apart
+             two processes having the same pid. None if the process does not exist.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            stat = file.read()
+    except OSError:
+        return None
+    # The command name, in parentheses, may contain spaces
+    fields = stat[stat.rindex(")") + 2 :].split()
+    if fields[0] == "Z":
+        # Exited, waiting for its parent to collect its status
+        return None
+    return int(fields[19])
+
+
+class ApplyJournal:
+    """
+    ApplyJournal records the terraform apply running in a cluster's workspace in a file next
+    to the terraform state: the pid and start time of terraform, the host running it, the
+    apply job and the offset of the apply in its log.
+
+    The journal is written when terraform starts and removed once the outcome of the apply is
+    saved in the database. A journal left behind by a restart of MC Hub tells whether the
+    apply is still running, and can be reattached to, or died with MC Hub.
+    """
+
+    __slots__ = [
+        "workspace",
+        "pid",
+        "start_time",
+        "started",
+        "host",
+        "job_id",
+        "log_offset",
+    ]
+
+    def __init__(
+        self,
+        workspace,
+        pid,
+        start_time,
+        *,
+        started=None,
+        host=None,
+        job_id=None,
+        log_offset=0,
+    ):
+        self.workspace = workspace
+        self.pid = pid
+        self.start_time = start_time
+        self.started = started if started is not None else time()
+        self.host = host or socket.gethostname()
+        self.job_id = job_id
+        self.log_offset = log_offset
+
+    @staticmethod
+    def get_path(workspace):
+        return path.join(workspace, TERRAFORM_APPLY_JOURNAL_FILENAME)
+
+    @classmethod
+    def record(cls, workspace, pid, *, job_id=None, log_offset=0):
+        """
+        Durably writes the journal of the terraform apply started in the workspace.
+        """
+        journal = cls(
+            workspace,
+            pid,
+            get_process_start_time(pid),
+            job_id=job_id,
+            log_offset=log_offset,
+        )
+        journal_path = cls.get_path(workspace)
+        with open(f"{journal_path}.tmp", "w") as file:
+            json.dump(
+                {
+                    slot: getattr(journal, slot)
+                    for slot in cls.__slots__
+                    if slot != "workspace"
+                },
+                file,
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{journal_path}.tmp", journal_path)
+        return journal
+
+    @classmethod
+    def read(cls, workspace):
+        """
+        :return: The journal of the workspace, or None if no apply was left behind.
+        """
+        try:
+            with open(cls.get_path(workspace)) as file:
+                return cls(workspace, **json.load(file))
+        except FileNotFoundError:
+            return None
+        except (TypeError, ValueError):
+            logging.warning(f"Ignoring the corrupted apply journal of {workspace}")
+            return None
+
+    @classmethod
+    def discard(cls, workspace):
+        try:
+            os.remove(cls.get_path(workspace))
+        except FileNotFoundError:
+            pass
+
+    def is_alive(self):
+        """
+        :return: True if the journaled terraform apply is still running on this host.
+        """
+        return (
+            self.host == socket.gethostname()
+            and self.start_time is not None
+            and get_process_start_time(self.pid) == self.start_time
+        )
+
+    def wait(self, cancelled=None):
+        """
+        Waits for the journaled terraform apply, which is not a child of this process,
+        to exit. The apply is interrupted once `cancelled` returns True.
+        """
+        interrupted = False
+        while self.is_alive():
+            if not interrupted and cancelled is not None and cancelled():
+                os.kill(self.pid, signal.SIGINT)
+                interrupted = True
+            sleep(REATTACH_POLL_INTERVAL)
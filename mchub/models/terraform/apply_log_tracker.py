@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+
+from collections import OrderedDict
+from threading import Lock
+
+from .terraform_plan_parser import (
+    ApplyOutputIndex,
+    ApplyProgress,
+    TerraformPlanParser,
+)
+
+# Appended bytes read through a memory map rather than copied in memory
+MMAP_THRESHOLD = 1 << 20
+# Bytes at the start of the log compared on each poll, to detect a log rewritten in place
+HEAD_SIZE = 256
+# Number of apply logs tracked by the process, the least recently polled being dropped
+MAX_TRACKERS = 1024
+
+
+class ApplyLogTracker:
+    """
+    ApplyLogTracker follows the log of `terraform apply -json` of a cluster from one
+    progress poll to the next. It remembers the inode of the log and the byte offset it
+    read up to, parses only the messages appended since the previous poll, and keeps the
+    progress of each resource up to date in an ApplyProgress. A poll therefore costs the
+    same whether the log holds a hundred messages or a million. The logs of applies run
+    without `-json` are followed the same way, their lines being added to an
+    ApplyOutputIndex.
+
+    The log is read again from the start when it is replaced (a new inode, e.g. once
+    rotated) or rewritten in place (truncated, or its first bytes changed), as happens
+    when a new apply starts.
+    """
+
+    __slots__ = [
+        "path",
+        "inode",
+        "head",
+        "offset",
+        "pending",
+        "json",
+        "progress",
+        "lock",
+    ]
+
+    _trackers = OrderedDict()
+    _lock = Lock()
+
+    def __init__(self, log_path):
+        self.path = log_path
+        self.lock = Lock()
+        self.reset()
+
+    @classmethod
+    def get(cls, log_path):
+        with cls._lock:
+            tracker = cls._trackers.pop(log_path, None)
+            if tracker is None:
+                tracker = cls(log_path)
+            cls._trackers[log_path] = tracker
+            while len(cls._trackers) > MAX_TRACKERS:
+                cls._trackers.popitem(last=False)
+        return tracker
+
+    @classmethod
+    def discard(cls, log_path):
+        with cls._lock:
+            cls._trackers.pop(log_path, None)
+
+    def reset(self, inode=None, head=b""):
+        self.inode = inode
+        self.head = head
+        self.offset = 0
+        self.pending = b""
+        # Whether the log holds json messages, unknown until its first character is read
+        self.json = None
+        self.progress = ApplyProgress()
+
+    def parse(self, buffer, start, end):
+        """
+        Adds the complete lines of buffer[start:end] to the progress, keeping the last
+        line for the next poll when terraform is still writing it.
+        """
+        if not self.json:
+            newline = buffer.rfind(b"\n", start, end)
+            if newline == -1:
+                self.pending += buffer[start:end]
+            else:
+                output = self.pending + buffer[start : newline + 1]
+                self.pending = buffer[newline + 1 : end]
+                self.progress.add(output.decode(errors="replace"))
+            return
+        position = start
+        while position < end:
+            newline = buffer.find(b"\n", position, end)
+            if newline == -1:
+                self.pending += buffer[position:end]
+                break
+            line = self.pending + buffer[position:newline]
+            self.pending = b""
+            position = newline + 1
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(event, dict):
+                self.progress.add(event)
+
+    def update(self, file):
+        """
+        Reads the bytes appended to the log since the previous poll.
+        """
+        stat = os.fstat(file.fileno())
+        head = file.read(HEAD_SIZE)
+        inode = (stat.st_dev, stat.st_ino)
+        if (
+            inode != self.inode
+            or stat.st_size < self.offset
+            or head[: len(self.head)] != self.head
+        ):
+            self.reset(inode, head)
+        elif len(self.head) < HEAD_SIZE:
+            self.head = head
+
+        if self.json is None:
+            stripped = head.lstrip()
+            if not stripped:
+                return
+            self.json = stripped.startswith(b"{")
+            if not self.json:
+                self.progress = ApplyOutputIndex()
+        if stat.st_size == self.offset:
+            return
+
+        if stat.st_size - self.offset >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                self.parse(buffer, self.offset, min(len(buffer), stat.st_size))
+                self.offset = min(len(buffer), stat.st_size)
+        else:
+            file.seek(self.offset)
+            data = file.read(stat.st_size - self.offset)
+            self.parse(data, 0, len(data))
+            self.offset += len(data)
+
+    def get_changes(self, initial_plan):
+        """
+        :return: The resource changes of the initial plan with their progress, as returned
+                 by TerraformPlanParser.get_applied_changes, or by get_done_changes for
+                 the logs of applies run without `-json`.
+        """
+        with self.lock:
+            try:
+                with open(self.path, "rb") as file:
+                    self.update(file)
+            except FileNotFoundError:
+                # terraform apply was not launched yet, therefore the log file does not exist
+                self.reset()
+            if self.json is None:
+                return TerraformPlanParser.get_done_changes(initial_plan, "")
+            return self.progress.get_changes(initial_plan)
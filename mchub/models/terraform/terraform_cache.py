@@ -0,0 +1,259 @@
+import fcntl
+import hashlib
+import json
+import logging
+
+from os import link, makedirs, path, rename, symlink
+from shutil import copy2, copytree, rmtree
+from tempfile import mkdtemp
+
+from .terraform_process import run
+
+from ...configuration import get_config
+from ...configuration.env import TERRAFORM_CACHE_PATH
+from ...configuration.magic_castle import (
+    MAGIC_CASTLE_PATH,
+    MAGIC_CASTLE_SOURCE,
+    MAGIC_CASTLE_VERSION,
+    MAIN_TERRAFORM_FILENAME,
+    TERRAFORM_REQUIRED_VERSION,
+)
+
+TERRAFORM_DATA_DIRNAME = ".terraform"
+TERRAFORM_LOCK_FILENAME = ".terraform.lock.hcl"
+COMPLETE_MARKER_FILENAME = ".complete"
+# Written in the .terraform directory of a cluster with the key of its initialized modules
+INIT_MARKER_FILENAME = "mchub-init"
+
+
+def link_or_copy(source, destination):
+    """
+    Hardlinks a file, or copies it when the destination is on another filesystem.
+    """
+    try:
+        link(source, destination)
+    except OSError:
+        copy2(source, destination)
+
+
+class TerraformCache:
+    """
+    TerraformCache keeps a local copy of the terraform modules and providers required by
+    the clusters, so that initializing a new cluster does not fetch them from the network.
+
+    Each cache entry is the result of `terraform init` for a given set of module sources.
+    Entries are content-addressed: the key is a digest of the module sources and of the
+    Magic Castle version and path, hence upgrading MAGIC_CASTLE_VERSION creates new entries.
+    The `.terraform` directory of an entry, whose providers are in terraform's unpacked
+    mirror layout, is hardlinked into the cluster's directory along with the lock file.
+
+    The cache is disabled with `terraform_cache` in configuration.json.
+    """
+
+    @staticmethod
+    def enabled():
+        return get_config()["terraform_cache"]
+
+    @staticmethod
+    def get_modules(main_file):
+        """
+        :return: The source of each module of a cluster's main.tf.json, by module name.
+        """
+        with open(main_file) as file:
+            main_tf_data = json.load(file)
+        return {
+            name: module["source"]
+            for name, module in main_tf_data.get("module", {}).items()
+        }
+
+    @staticmethod
+    def get_sources(provider, dns_module=None):
+        """
+        :return: The module sources of a cluster, by module name, as written in main.tf.json.
+        """
+        modules = {provider: MAGIC_CASTLE_SOURCE[provider]}
+        if dns_module is not None:
+            modules["dns"] = MAGIC_CASTLE_SOURCE["dns"][dns_module]
+        return modules
+
+    @staticmethod
+    def get_combinations():
+        """
+        :return: The (cloud provider, DNS module) combinations of the clusters MC Hub can
+                 create with configuration.json, including clusters without DNS.
+        """
+        dns_modules = sorted(
+            {
+                dns_provider["module"]
+                for dns_provider in get_config().get("dns_providers", {}).values()
+            }
+            & MAGIC_CASTLE_SOURCE["dns"].keys()
+        )
+        providers = [provider for provider in MAGIC_CASTLE_SOURCE if provider != "dns"]
+        return [
+            (provider, dns_module)
+            for provider in providers
+            for dns_module in [None, *dns_modules]
+        ]
+
+    @staticmethod
+    def link_local_modules(workspace, modules):
+        """
+        Local module sources are relative to the cluster's directory: links them to
+        the Magic Castle release in MAGIC_CASTLE_PATH.
+        """
+        for source in modules.values():
+            if source.startswith("."):
+                name = source.split("/")[1]
+                if not path.exists(path.join(workspace, name)):
+                    symlink(
+                        path.join(MAGIC_CASTLE_PATH, name), path.join(workspace, name)
+                    )
+
+    @staticmethod
+    def get_key(modules):
+        digest = hashlib.sha256(
+            json.dumps(
+                {
+                    "version": MAGIC_CASTLE_VERSION,
+                    "path": MAGIC_CASTLE_PATH,
+                    "modules": modules,
+                },
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+        return f"{MAGIC_CASTLE_VERSION}-{'-'.join(sorted(modules))}-{digest[:16]}"
+
+    @classmethod
+    def get_init_key(cls, cluster_path):
+        """
+        :return: The key of the modules of a cluster's main.tf.json followed by a digest
+                 of its dependency lock file.
+        """
+        modules = cls.get_modules(path.join(cluster_path, MAIN_TERRAFORM_FILENAME))
+        with open(path.join(cluster_path, TERRAFORM_LOCK_FILENAME), "rb") as file:
+            lock_digest = hashlib.sha256(file.read()).hexdigest()
+        return f"{cls.get_key(modules)}-{lock_digest[:16]}"
+
+    @classmethod
+    def mark_initialized(cls, cluster_path):
+        """
+        Records the key of the modules initialized in a cluster's directory, compared with
+        the current key by `python -m mchub.init_clusters` to skip the directory.
+        """
+        try:
+            init_key = cls.get_init_key(cluster_path)
+            with open(
+                path.join(cluster_path, TERRAFORM_DATA_DIRNAME, INIT_MARKER_FILENAME),
+                "w",
+            ) as file:
+                file.write(init_key)
+        except (OSError, ValueError) as error:
+            logging.warning(f"Could not mark {cluster_path} as initialized - {error}")
+
+    @classmethod
+    def get_path(cls, modules):
+        return path.join(TERRAFORM_CACHE_PATH, cls.get_key(modules))
+
+    @classmethod
+    def warm(cls, modules):
+        """
+        Creates the cache entry for the given module sources, unless it already exists.
+        Processes sharing the cache wait for each other instead of initializing twice.
+
+        :return: The path of the cache entry.
+        """
+        entry = cls.get_path(modules)
+        if path.exists(path.join(entry, COMPLETE_MARKER_FILENAME)):
+            return entry
+
+        makedirs(TERRAFORM_CACHE_PATH, exist_ok=True)
+        with open(f"{entry}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if path.exists(path.join(entry, COMPLETE_MARKER_FILENAME)):
+                return entry
+
+            workspace = mkdtemp(dir=TERRAFORM_CACHE_PATH, prefix=".init-")
+            try:
+                with open(path.join(workspace, MAIN_TERRAFORM_FILENAME), "w") as file:
+                    json.dump(
+                        {
+                            "terraform": {
+                                "required_version": TERRAFORM_REQUIRED_VERSION
+                            },
+                            "module": {
+                                name: {"source": source}
+                                for name, source in modules.items()
+                            },
+                        },
+                        file,
+                    )
+                cls.link_local_modules(workspace, modules)
+                run(
+                    [
+                        "terraform",
+                        "init",
+                        "-no-color",
+                        "-input=false",
+                        "-backend=false",
+                    ],
+                    cwd=workspace,
+                    capture_output=True,
+                    check=True,
+                )
+                if not path.isdir(path.join(workspace, TERRAFORM_DATA_DIRNAME)):
+                    raise FileNotFoundError(
+                        f"terraform init did not create {TERRAFORM_DATA_DIRNAME}"
+                    )
+                open(path.join(workspace, COMPLETE_MARKER_FILENAME), "w").close()
+                rmtree(entry, ignore_errors=True)
+                rename(workspace, entry)
+            except BaseException:
+                rmtree(workspace, ignore_errors=True)
+                raise
+        return entry
+
+    @classmethod
+    def populate(cls, cluster_path):
+        """
+        Initializes a cluster's directory from the cache, creating the cache entry if needed.
+
+        :return: True if the cluster's directory was initialized, False if `terraform init`
+                 must be run in the cluster's directory instead.
+        """
+        if not cls.enabled():
+            return False
+        try:
+            modules = cls.get_modules(path.join(cluster_path, MAIN_TERRAFORM_FILENAME))
+            entry = cls.warm(modules)
+            copytree(
+                path.join(entry, TERRAFORM_DATA_DIRNAME),
+                path.join(cluster_path, TERRAFORM_DATA_DIRNAME),
+                symlinks=True,
+                copy_function=link_or_copy,
+            )
+            lock_file = path.join(entry, TERRAFORM_LOCK_FILENAME)
+            if path.exists(lock_file):
+                copy2(lock_file, path.join(cluster_path, TERRAFORM_LOCK_FILENAME))
+        except Exception as error:
+            logging.warning(
+                f"Could not initialize {cluster_path} from the terraform cache - {error}"
+            )
+            rmtree(path.join(cluster_path, TERRAFORM_DATA_DIRNAME), ignore_errors=True)
+            return False
+        cls.mark_initialized(cluster_path)
+        return True
+
+    @classmethod
+    def prewarm(cls):
+        """
+        Creates the cache entries for the configured Magic Castle version, cloud provider
+        and every DNS module of configuration.json.
+        """
+        if not cls.enabled():
+            return
+        for provider, dns_module in cls.get_combinations():
+            try:
+                cls.warm(cls.get_sources(provider, dns_module))
+            except Exception as error:
+                logging.error(f"Could not pre-warm the terraform cache - {error}")
@@ -0,0 +1,128 @@
+import re
+
+from statistics import mean, median
+
+from .terraform_plan_parser import TerraformPlanParser
+
+from ...configuration import get_config
+from ...database import db
+
+# Errors of the cloud APIs telling the client to slow down
+THROTTLING_PATTERN = re.compile(
+    r"\b429\b|too many requests|rate ?limit|over ?limit|throttl|"
+    r"\b503\b|service unavailable|timed out|timeout",
+    re.IGNORECASE,
+)
+# A resource is slow when it takes this many times longer than it usually does
+SLOWDOWN_RATIO = 2
+# Weight of the latest apply in the usual time spent on each type of resource
+LATENCY_SMOOTHING = 0.3
+
+
+class TerraformParallelism:
+    """
+    TerraformParallelism chooses the `-parallelism` of terraform for each project, from the
+    outcome of its previous applies (additive increase, multiplicative decrease).
+
+    After each apply, the parallelism of the project is:
+    - halved when the cloud throttled the requests (rate-limit errors, 503, timeouts);
+    - lowered by a quarter when resources took twice as long as they usually do for the
+      project, since the cloud APIs are slowing down;
+    - raised by one when the apply succeeded at the usual pace.
+
+    The value always lies within the bounds set by the project admin (`min_parallelism`
+    and `max_parallelism`), themselves capped by `max_parallelism` in configuration.json.
+    """
+
+    @staticmethod
+    def bounds(project):
+        ceiling = get_config()["max_parallelism"]
+        minimum = min(max(1, project.min_parallelism or 1), ceiling)
+        maximum = min(max(minimum, project.max_parallelism or ceiling), ceiling)
+        return minimum, maximum
+
+    @classmethod
+    def clamp(cls, project, parallelism):
+        minimum, maximum = cls.bounds(project)
+        return min(maximum, max(minimum, parallelism))
+
+    @classmethod
+    def choose(cls, project):
+        """
+        :return: The parallelism of the next terraform run of the project.
+        """
+        return cls.clamp(
+            project, project.parallelism or get_config()["default_parallelism"]
+        )
+
+    @staticmethod
+    def get_args(parallelism):
+        """
+        :return: The arguments of a terraform command run with the given parallelism.
+        """
+        return [f"-parallelism={parallelism}"] if parallelism else []
+
+    @staticmethod
+    def is_throttled(events):
+        """
+        :return: True if a diagnostic of the terraform run reports a throttling error.
+        """
+        return any(
+            THROTTLING_PATTERN.search(
+                f"{diagnostic['summary'] or ''} {diagnostic['detail'] or ''}"
+            )
+            for severity in ("error", "warning")
+            for diagnostic in TerraformPlanParser.get_diagnostics(events, severity)
+        )
+
+    @staticmethod
+    def get_latencies(events):
+        """
+        :return: The mean number of seconds spent on each type of resource by the apply.
+        """
+        elapsed = {}
+        for event in events:
+            if event.get("type") == "apply_complete":
+                hook = event["hook"]
+                if "elapsed_seconds" in hook:
+                    elapsed.setdefault(hook["resource"]["resource_type"], []).append(
+                        hook["elapsed_seconds"]
+                    )
+        return {
+            resource_type: mean(values) for resource_type, values in elapsed.items()
+        }
+
+    @classmethod
+    def observe(cls, project, parallelism, events):
+        """
+        Adjusts the parallelism of the project from the messages of an apply run with
+        the given parallelism, and updates the usual time spent on each type of resource.
+
+        :return: The parallelism of the next terraform run of the project.
+        """
+        latencies = cls.get_latencies(events)
+        usual = dict(project.resource_latency or {})
+        ratios = [
+            latency / usual[resource_type]
+            for resource_type, latency in latencies.items()
+            if usual.get(resource_type)
+        ]
+
+        if cls.is_throttled(events):
+            parallelism = parallelism // 2
+        elif ratios and median(ratios) >= SLOWDOWN_RATIO:
+            parallelism -= max(1, parallelism // 4)
+        elif not TerraformPlanParser.get_diagnostics(events):
+            parallelism += 1
+
+        for resource_type, latency in latencies.items():
+            if resource_type in usual:
+                usual[resource_type] += LATENCY_SMOOTHING * (
+                    latency - usual[resource_type]
+                )
+            else:
+                usual[resource_type] = latency
+        project.resource_latency = usual
+        project.parallelism = cls.clamp(project, parallelism)
+        db.session.commit()
+        return project.parallelism
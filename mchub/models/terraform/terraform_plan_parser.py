@@ -1,12 +1,167 @@
+import json
+import re
+import sys
+
+# Actions of the machine-readable UI mapped to the actions of the json plan representation
+PLANNED_CHANGE_ACTIONS = {
+    "create": ["create"],
+    "read": ["read"],
+    "update": ["update"],
+    "replace": ["delete", "create"],
+    "delete": ["delete"],
+}
+APPLY_HOOKS = ("apply_start", "apply_progress", "apply_complete", "apply_errored")
+# Lines of the human-readable output of terraform apply, following the resource address
+APPLY_OUTPUT_PATTERN = re.compile(
+    r": (Creating\.\.\.|Destroying\.\.\.|Modifying\.\.\."
+    r"|Creation complete|Destruction complete|Modifications complete)"
+)
+APPLY_OUTPUT_EVENTS = {
+    "Creating...": "creation_running",
+    "Destroying...": "destruction_running",
+    "Modifying...": "modification_running",
+    "Creation complete": "creation_complete",
+    "Destruction complete": "destruction_complete",
+    "Modifications complete": "modification_complete",
+}
+# Whitespace and color codes preceding the resource address on a line
+LINE_PREFIX_PATTERN = re.compile(r"(?:\s|\x1b\[[0-9;]*m)*")
+
+
 class TerraformPlanParser:
     """
     Class in charge of parsing the json representation outputted by terraform plan
-    and parsing the progress outputted by terraform apply. 
+    and parsing the progress outputted by terraform apply.
 
     Relevant Terraform documentation:
     https://www.terraform.io/docs/internals/json-format.html#change-representation
+    https://www.terraform.io/internals/machine-readable-ui
     """
 
+    @staticmethod
+    def is_json_log(terraform_output: str):
+        """
+        :return: True if the output was produced by terraform with the `-json` flag.
+        """
+        return terraform_output.lstrip().startswith("{")
+
+    @staticmethod
+    def parse_json_log(terraform_output: str):
+        """
+        Parses the machine-readable output of terraform (`-json`), one JSON message per line.
+        Lines that are not JSON messages, like a line terraform is still writing, are skipped.
+
+        :return: The list of messages, in the order terraform emitted them.
+        """
+        return list(TerraformPlanParser.iter_json_log(terraform_output.splitlines()))
+
+    @staticmethod
+    def iter_json_log(lines):
+        """
+        Parses the machine-readable output of terraform line by line, e.g. from the file
+        of the log, so that the whole output is never held in memory.
+
+        :return: A generator of the messages, in the order terraform emitted them.
+        """
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(event, dict):
+                yield event
+
+    @staticmethod
+    def get_planned_changes(events):
+        """
+        Builds the plan from the `planned_change` messages of `terraform plan -json`,
+        in the same shape as the resource changes of `terraform show -json`.
+
+        :return: The plan, for example:
+
+        {
+            "resource_changes": [
+                {
+                    "address": "module.openstack.openstack_networking_floatingip_v2.fip[0]",
+                    "type": "openstack_networking_floatingip_v2",
+                    "change": {"actions": ["create"]},
+                },
+                ...
+            ],
+            "change_summary": {"add": 1, "change": 0, "remove": 0, "operation": "plan"},
+        }
+        """
+        resource_changes = []
+        change_summary = None
+        for event in events:
+            if event.get("type") == "planned_change":
+                change = event["change"]
+                resource_changes.append(
+                    {
+                        "address": change["resource"]["addr"],
+                        # Interned, so that every type is pickled once with the plan
+                        "type": sys.intern(change["resource"]["resource_type"]),
+                        "change": {
+                            "actions": PLANNED_CHANGE_ACTIONS.get(
+                                change["action"], ["no-op"]
+                            )
+                        },
+                    }
+                )
+            elif event.get("type") == "change_summary":
+                change_summary = event["changes"]
+        return {"resource_changes": resource_changes, "change_summary": change_summary}
+
+    @staticmethod
+    def get_diagnostics(events, severity="error"):
+        """
+        :return: The diagnostics of the given severity, for example:
+        [
+            {
+                "summary": "Error creating OpenStack server",
+                "detail": "Quota exceeded for cores",
+                "address": "module.openstack.openstack_compute_instance_v2.instances[\"mgmt1\"]",
+            },
+            ...
+        ]
+        """
+        return [
+            {
+                "summary": event["diagnostic"].get("summary"),
+                "detail": event["diagnostic"].get("detail"),
+                "address": event["diagnostic"].get("address"),
+            }
+            for event in events
+            if event.get("type") == "diagnostic"
+            and event["diagnostic"].get("severity") == severity
+        ]
+
+    @staticmethod
+    def get_drifted_resources(events):
+        """
+        Lists the resources changed outside of terraform from the `resource_drift` messages of
+        `terraform plan -refresh-only -json`.
+
+        :return: The drifted resources, for example:
+        [
+            {
+                "address": "module.openstack.openstack_compute_instance_v2.instances[\"node1\"]",
+                "type": "openstack_compute_instance_v2",
+                "action": "delete",
+            },
+            ...
+        ]
+        """
+        return [
+            {
+                "address": event["change"]["resource"]["addr"],
+                "type": event["change"]["resource"].get("resource_type"),
+                "action": event["change"]["action"],
+            }
+            for event in events
+            if event.get("type") == "resource_drift"
+        ]
+
     @staticmethod
     def get_resources_changes(plan):
         """
@@ -38,9 +193,9 @@ class TerraformPlanParser:
 
     @staticmethod
     def get_done_changes(initial_plan, terraform_apply_output: str):
-        """ 
+        """
         Computes the difference between an initial Terraform plan and the output from terraform apply and determines
-        which resource changes are "queued", "running" or "done". 
+        which resource changes are "queued", "running" or "done".
 
         Note:
         When the initial change action is ["read"] for a resource, Terraform removes the resource change from
@@ -58,21 +213,160 @@ class TerraformPlanParser:
             ...
         ]
         """
+        index = ApplyOutputIndex()
+        index.add(terraform_apply_output)
+        return index.get_changes(initial_plan)
+
+    @staticmethod
+    def get_applied_changes(initial_plan, events):
+        """
+        Determines which resource changes of the initial Terraform plan are "queued", "running",
+        "done" or in "error" from the messages of `terraform apply -json` (apply_start,
+        apply_progress, apply_complete and apply_errored). The time spent on each resource is
+        reported in "elapsed_seconds" and the error of a failed resource in "error".
+
+        :param initial_plan: The initial Terraform plan.
+        :param events: The messages of terraform apply, as returned by parse_json_log.
+        :return: The resource changes, with a "progress" attribute, for instance:
+        [
+            {
+                "address": "module.openstack.openstack_networking_floatingip_v2.fip[0]",
+                "type": "openstack_networking_floatingip_v2",
+                "change": {"actions": ["create"], "progress": "done", "elapsed_seconds": 2},
+            },
+            ...
+        ]
+        """
+        progress = ApplyProgress()
+        for event in events:
+            progress.add(event)
+        return progress.get_changes(initial_plan)
+
+
+class ApplyProgress:
+    """
+    ApplyProgress sums up the messages of `terraform apply -json` resource by resource, as
+    they are read: the actions started, completed and errored, the time spent on each
+    action and the error diagnostics. The progress of the plan is then derived from this
+    summary without going through the messages again.
+    """
+
+    __slots__ = ["started", "completed", "errored", "elapsed", "errors"]
+
+    def __init__(self):
+        self.started = {}
+        self.completed = {}
+        self.errored = set()
+        self.elapsed = {}
+        self.errors = {}
+
+    def add(self, event):
+        if event.get("type") == "diagnostic":
+            diagnostic = event["diagnostic"]
+            if diagnostic.get("severity") == "error" and diagnostic.get("address"):
+                self.errors[diagnostic["address"]] = {
+                    "summary": diagnostic.get("summary"),
+                    "detail": diagnostic.get("detail"),
+                }
+            return
+        if event.get("type") not in APPLY_HOOKS:
+            return
+        hook = event["hook"]
+        address = hook["resource"]["addr"]
+        action = hook["action"]
+        self.started.setdefault(address, set()).add(action)
+        if "elapsed_seconds" in hook:
+            self.elapsed.setdefault(address, {})[action] = hook["elapsed_seconds"]
+        if event["type"] == "apply_complete":
+            self.completed.setdefault(address, set()).add(action)
+        elif event["type"] == "apply_errored":
+            self.errored.add(address)
+
+    def get_changes(self, initial_plan):
+        """
+        :return: The resource changes of the initial plan, with their progress, as
+                 returned by TerraformPlanParser.get_applied_changes.
+        """
+        applied_resources_changes = TerraformPlanParser.get_resources_changes(
+            initial_plan
+        )
+        for applied_resource_change in applied_resources_changes:
+            address = applied_resource_change["address"]
+            change = applied_resource_change["change"]
+            done_actions = self.completed.get(address, set())
+            if change["actions"] == ["no-op"] or (
+                set(change["actions"]) <= done_actions or "replace" in done_actions
+            ):
+                progress = "done"
+            elif address in self.errored:
+                progress = "error"
+            elif address in self.started:
+                progress = "running"
+            else:
+                progress = "queued"
+            change["progress"] = progress
+            if address in self.elapsed:
+                change["elapsed_seconds"] = sum(self.elapsed[address].values())
+            if address in self.errors:
+                change["error"] = self.errors[address]
+        return applied_resources_changes
+
+
+class ApplyOutputIndex:
+    """
+    ApplyOutputIndex indexes the human-readable output of terraform apply, as printed
+    when terraform runs without `-json`, by resource address. The output is scanned once
+    for the lines reporting that an action started or completed, and the first position
+    of each of these lines is kept for the address that precedes it. The progress of
+    every resource of the plan is then looked up in the index, rather than searched for
+    in the whole output resource by resource.
+
+    A resource address is found wherever the output holds it followed by the action, as
+    with a plain text search: at the start of the line, after a space, and after a dot
+    for the tail of a longer address.
+    """
+
+    __slots__ = ["positions", "length"]
+
+    def __init__(self):
+        # {address: {event: position of the first line reporting the event}}
+        self.positions = {}
+        self.length = 0
+
+    def add(self, terraform_apply_output: str):
+        """
+        Indexes output appended to the output indexed so far.
+        """
+        positions = self.positions
+        for match in APPLY_OUTPUT_PATTERN.finditer(terraform_apply_output):
+            line_start = terraform_apply_output.rfind("\n", 0, match.start()) + 1
+            line_start = LINE_PREFIX_PATTERN.match(
+                terraform_apply_output, line_start, match.start()
+            ).end()
+            address = terraform_apply_output[line_start : match.start()]
+            if not address:
+                continue
+            event = APPLY_OUTPUT_EVENTS[match.group(1)]
+            position = self.length + line_start
+            positions.setdefault(address, {}).setdefault(event, position)
+            for offset, character in enumerate(address):
+                if character in ". " and offset + 1 < len(address):
+                    positions.setdefault(address[offset + 1 :], {}).setdefault(
+                        event, position + offset + 1
+                    )
+        self.length += len(terraform_apply_output)
+
+    def get_changes(self, initial_plan):
+        """
+        :return: The resource changes of the initial plan, with their progress, as
+                 returned by TerraformPlanParser.get_done_changes.
+        """
         done_resources_changes = TerraformPlanParser.get_resources_changes(initial_plan)
         for done_resource_change in done_resources_changes:
-            resource_address = done_resource_change["address"]
-
-            search_queries = {
-                "creation_running": f"{resource_address}: Creating...",
-                "destruction_running": f"{resource_address}: Destroying...",
-                "modification_running": f"{resource_address}: Modifying...",
-                "creation_complete": f"{resource_address}: Creation complete",
-                "destruction_complete": f"{resource_address}: Destruction complete",
-                "modification_complete": f"{resource_address}: Modifications complete",
-            }
+            positions = self.positions.get(done_resource_change["address"], {})
             search_results = {
-                query_name: terraform_apply_output.find(query_text)
-                for (query_name, query_text) in search_queries.items()
+                event: positions.get(event, -1)
+                for event in APPLY_OUTPUT_EVENTS.values()
             }
 
             progress = "queued"
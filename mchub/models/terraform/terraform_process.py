@@ -0,0 +1,592 @@
+import asyncio
+import logging
+import os
+import resource
+import signal
+import subprocess
+
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from subprocess import PIPE, STDOUT, CalledProcessError, Popen
+from threading import Lock, Thread
+from time import monotonic
+from uuid import uuid4
+
+from ...configuration import get_config
+
+# Seconds between two checks of the cancellation of a terraform command
+CANCEL_POLL_INTERVAL = 1
+# Seconds left to terraform to exit after a forced interruption, before it is killed
+KILL_TIMEOUT = 10
+# Seconds between two checks of the free memory while a terraform command waits to start
+ADMISSION_POLL_INTERVAL = 5
+# Niceness of terraform when its CPU usage cannot be limited by a cgroup
+TERRAFORM_NICENESS = 10
+
+MEMINFO_PATH = "/proc/meminfo"
+SELF_CGROUP_PATH = "/proc/self/cgroup"
+CGROUP_ROOT = "/sys/fs/cgroup"
+# Period of the CPU bandwidth limit of the cgroups, in microseconds
+CPU_PERIOD = 100000
+# Bytes read at once from the output of a terraform command
+OUTPUT_CHUNK_SIZE = 65536
+# Holds a terraform command until its resources are limited: the command is executed,
+# with /dev/null as its standard input, once the standard input of the launcher is closed
+LAUNCHER = ["/bin/sh", "-c", 'read -r _; exec "$@" </dev/null', "mchub-launcher"]
+
+
+class TerraformCancelledError(CalledProcessError):
+    """
+    Raised when a terraform command exits after being interrupted by a cancellation.
+    """
+
+
+class TerraformTimeoutError(CalledProcessError):
+    """
+    Raised when a terraform command exits after being interrupted by its timeout.
+    """
+
+
+def read_file(filename):
+    try:
+        with open(filename) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def get_available_memory():
+    """
+    :return: The number of bytes that can be allocated without swapping, within the memory
+             limit of the cgroup of MC Hub, if any (e.g. the limit of its container).
+    """
+    available = None
+    for line in (read_file(MEMINFO_PATH) or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            available = int(line.split()[1]) * 1024
+    try:
+        cgroup = read_file(SELF_CGROUP_PATH).split("::", 1)[1]
+        limit = read_file(f"{CGROUP_ROOT}{cgroup}/memory.max")
+        usage = read_file(f"{CGROUP_ROOT}{cgroup}/memory.current")
+        if limit not in (None, "max") and usage is not None:
+            remaining = int(limit) - int(usage)
+            available = remaining if available is None else min(available, remaining)
+    except (AttributeError, IndexError, ValueError):
+        pass
+    return available
+
+
+class ResourceLimits:
+    """
+    ResourceLimits confines a terraform process and the providers it starts.
+
+    When `terraform_cgroup` is the path of a cgroup v2 delegated to MC Hub, each process
+    runs in its own sub-group whose memory.max and cpu.max are `terraform_memory_limit`
+    and `terraform_cpu_limit`, and the peak memory of the sub-group is reported. Otherwise,
+    the data segment of each process is limited with setrlimit and the niceness of
+    terraform is raised, and the peak RSS of its largest process is reported.
+    """
+
+    __slots__ = ["memory", "cpus", "cgroup"]
+
+    def __init__(self):
+        config = get_config()
+        self.memory = config["terraform_memory_limit"] * 1024 * 1024
+        self.cpus = config["terraform_cpu_limit"]
+        self.cgroup = None
+        if config["terraform_cgroup"]:
+            self.cgroup = os.path.join(
+                config["terraform_cgroup"], f"terraform-{uuid4().hex[:12]}"
+            )
+
+    def prepare(self):
+        """
+        Creates the cgroup of the process before it starts.
+        """
+        if self.cgroup is None:
+            return
+        try:
+            os.mkdir(self.cgroup)
+            if self.memory:
+                with open(os.path.join(self.cgroup, "memory.max"), "w") as file:
+                    file.write(str(self.memory))
+            if self.cpus:
+                with open(os.path.join(self.cgroup, "cpu.max"), "w") as file:
+                    file.write(f"{int(self.cpus * CPU_PERIOD)} {CPU_PERIOD}")
+        except OSError as error:
+            logging.warning(
+                f"Could not confine terraform to cgroup {self.cgroup} - {error}"
+            )
+            self.release()
+
+    def apply(self, pid):
+        """
+        Confines the process while the launcher holds it, hence before it runs terraform
+        and terraform starts the providers. A warning is logged when the process could not
+        be confined.
+        """
+        if self.cgroup is not None:
+            try:
+                with open(os.path.join(self.cgroup, "cgroup.procs"), "w") as file:
+                    file.write(str(pid))
+                return
+            except OSError as error:
+                logging.warning(
+                    f"Could not move terraform to cgroup {self.cgroup} - {error}"
+                )
+                self.release()
+        try:
+            if self.memory:
+                resource.prlimit(pid, resource.RLIMIT_DATA, (self.memory, self.memory))
+            if self.cpus:
+                os.setpriority(os.PRIO_PROCESS, pid, TERRAFORM_NICENESS)
+        except (OSError, ValueError) as error:
+            logging.warning(f"Could not limit the resources of terraform - {error}")
+
+    def get_peak_memory(self, rusage):
+        """
+        :param rusage: The resource usage of the process, None when it was reaped by
+                       another waiter.
+        """
+        if self.cgroup is not None:
+            peak = read_file(os.path.join(self.cgroup, "memory.peak"))
+            if peak is not None:
+                return int(peak)
+        if rusage is None:
+            return 0
+        # ru_maxrss is in kilobytes on Linux
+        return rusage.ru_maxrss * 1024
+
+    def release(self):
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                pass
+            self.cgroup = None
+
+
+def interrupt(process: Popen, interrupted):
+    """
+    Escalates the interruption of a cancelled terraform command: terraform stops gracefully
+    on the first SIGINT, saving the state of the resources it changed, and aborts on the
+    second one, sent after `cancel_timeout` seconds. The process is killed if it is still
+    running `KILL_TIMEOUT` seconds later.
+
+    The signals are sent with os.kill, as Popen.send_signal would reap the process and
+    lose its resource usage.
+
+    :param interrupted: The times at which the process was interrupted so far.
+    """
+    elapsed = monotonic() - interrupted[-1] if interrupted else None
+    if not interrupted or (
+        len(interrupted) == 1 and elapsed >= get_config()["cancel_timeout"]
+    ):
+        os.kill(process.pid, signal.SIGINT)
+        interrupted.append(monotonic())
+    elif len(interrupted) == 2 and elapsed >= KILL_TIMEOUT:
+        os.kill(process.pid, signal.SIGKILL)
+        interrupted.append(monotonic())
+
+
+def write_output(target, chunk):
+    # Text files opened by the callers are written through their binary buffer
+    target = getattr(target, "buffer", target)
+    target.write(chunk)
+    target.flush()
+
+
+class TerraformRun:
+    """
+    TerraformRun is a terraform command started by the TerraformSupervisor. Its future is
+    resolved with the run once the command exited, so that a caller either waits for it or
+    adds a completion callback to it.
+    """
+
+    __slots__ = [
+        "args",
+        "future",
+        "returncode",
+        "stdout",
+        "stderr",
+        "peak_memory",
+        "interrupted",
+        "timed_out",
+        "cancel_requested",
+        "cancel_event",
+    ]
+
+    def __init__(self, args):
+        self.args = args
+        self.future = None
+        self.returncode = None
+        self.stdout = None
+        self.stderr = None
+        self.peak_memory = 0
+        self.interrupted = False
+        self.timed_out = False
+        self.cancel_requested = False
+        self.cancel_event = None
+
+    def get_cancel_event(self):
+        # The event is bound to the loop of the supervisor, hence created from its thread
+        if self.cancel_event is None:
+            self.cancel_event = asyncio.Event()
+            if self.cancel_requested:
+                self.cancel_event.set()
+        return self.cancel_event
+
+    def request_cancel(self):
+        self.cancel_requested = True
+        self.get_cancel_event().set()
+
+    def cancel(self):
+        """
+        Requests the interruption of the command. Can be called from any thread.
+        """
+        TerraformSupervisor.get_loop().call_soon_threadsafe(self.request_cancel)
+
+    def wait(self, timeout=None):
+        """
+        :return: True if the command exited within `timeout` seconds.
+        """
+        done, _ = futures.wait([self.future], timeout)
+        return bool(done)
+
+    def result(self, *, job=None, check=False):
+        """
+        Records the peak memory of the exited command with the job and returns its outcome
+        like `subprocess.run`.
+
+        :raise TerraformCancelledError: When check is True and the command was cancelled.
+        :raise TerraformTimeoutError: When check is True and the command timed out.
+        """
+        self.future.result()
+        logging.debug(
+            f"{' '.join(self.args[:2])} peak memory: {self.peak_memory // 2**20} MB"
+        )
+        if job is not None:
+            job.record_peak_memory(self.peak_memory)
+        if check and self.returncode:
+            if self.timed_out:
+                error = TerraformTimeoutError
+            elif self.interrupted:
+                error = TerraformCancelledError
+            else:
+                error = CalledProcessError
+            raise error(
+                self.returncode, self.args, output=self.stdout, stderr=self.stderr
+            )
+        return subprocess.CompletedProcess(
+            self.args, self.returncode, self.stdout, self.stderr
+        )
+
+
+class TerraformSupervisor:
+    """
+    TerraformSupervisor runs every terraform command of the process from a single asyncio
+    event loop, running in a thread of its own.
+
+    The loop delays each command until enough memory is free, starts it within the resource
+    limits, streams its output, and waits for it to exit through a pidfd. It interrupts the
+    commands that are cancelled or that run longer than `terraform_timeout` seconds, then
+    resolves their future. The number of threads does not grow with the number of commands
+    running: a caller waits on the future of its command, or adds a completion callback to it
+    like the ApplyScheduler does.
+
+    The `cancelled` checks of the commands may query the database, hence they run on a
+    single worker thread rather than in the loop.
+
+    Each command starts through a launcher, which waits for its resources to be limited
+    before executing terraform: nothing runs in the forked child before the exec.
+    asyncio.create_subprocess_exec is not used, as its child watcher would reap the commands
+    and lose their resource usage.
+
+    The loop reaps the commands with os.wait4 to get their resource usage. Under the gevent
+    workers of gunicorn, whose SIGCHLD watcher may reap a command first, the exit code is
+    taken from the Popen instead and the peak memory is only known with a cgroup.
+    """
+
+    _loop = None
+    _checker = None
+    _lock = Lock()
+
+    @classmethod
+    def get_loop(cls):
+        with cls._lock:
+            if cls._loop is None:
+                loop = asyncio.new_event_loop()
+                Thread(
+                    target=loop.run_forever, name="mchub-supervisor", daemon=True
+                ).start()
+                cls._checker = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="mchub-supervisor-check"
+                )
+                cls._loop = loop
+        return cls._loop
+
+    @classmethod
+    def start(
+        cls,
+        args,
+        *,
+        cancelled=None,
+        on_start=None,
+        on_output=None,
+        timeout=None,
+        capture_output=False,
+        **kwargs,
+    ):
+        """
+        Starts a terraform command, with the keyword arguments of `subprocess.Popen`.
+
+        :param cancelled: Called every `CANCEL_POLL_INTERVAL` seconds, from the worker
+                          thread of the supervisor. The command is interrupted once it
+                          returns True.
+        :param on_start: Called with the process once it started and its resources are limited.
+        :param on_output: Called with each chunk of the output of the command, which is
+                          then streamed through the supervisor to `stdout`, a file object.
+        :param timeout: The number of seconds after which the command is interrupted.
+                        Defaults to `terraform_timeout`, `0` meaning no timeout.
+        :return: The TerraformRun of the command.
+        """
+        terraform_run = TerraformRun(list(args))
+        if timeout is None:
+            timeout = get_config()["terraform_timeout"]
+        terraform_run.future = asyncio.run_coroutine_threadsafe(
+            cls.supervise(
+                terraform_run,
+                cancelled,
+                on_start,
+                on_output,
+                timeout,
+                capture_output,
+                kwargs,
+            ),
+            cls.get_loop(),
+        )
+        return terraform_run
+
+    @classmethod
+    async def is_cancelled(cls, terraform_run: TerraformRun, cancelled):
+        if not terraform_run.cancel_requested and cancelled is not None:
+            if await asyncio.get_running_loop().run_in_executor(
+                cls._checker, cancelled
+            ):
+                terraform_run.request_cancel()
+        return terraform_run.cancel_requested
+
+    @classmethod
+    async def admit(cls, terraform_run: TerraformRun, cancelled):
+        """
+        Waits until the free memory of the host is above `terraform_min_free_memory`
+        before the command starts.
+
+        :raise TerraformCancelledError: When the command is cancelled while it waits.
+        """
+        threshold = get_config()["terraform_min_free_memory"] * 1024 * 1024
+        waiting = None
+        while threshold:
+            available = get_available_memory()
+            if available is None or available >= threshold:
+                break
+            if await cls.is_cancelled(terraform_run, cancelled):
+                raise TerraformCancelledError(-signal.SIGINT, terraform_run.args)
+            if waiting is None:
+                waiting = monotonic()
+                logging.warning(
+                    f"Delaying terraform, {available // 2**20} MB of free memory left"
+                )
+            try:
+                await asyncio.wait_for(
+                    terraform_run.get_cancel_event().wait(), ADMISSION_POLL_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+        if waiting is not None:
+            logging.info(
+                f"Started terraform after waiting {monotonic() - waiting:.0f}s"
+            )
+
+    @staticmethod
+    async def pump(pipe, target, chunks, on_output):
+        """
+        Copies the output of the command to its target as it is written.
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe
+        )
+        try:
+            while chunk := await reader.read(OUTPUT_CHUNK_SIZE):
+                if target is not None:
+                    write_output(target, chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+                if on_output is not None:
+                    on_output(chunk)
+        finally:
+            transport.close()
+
+    @classmethod
+    async def supervise(
+        cls,
+        terraform_run: TerraformRun,
+        cancelled,
+        on_start,
+        on_output,
+        timeout,
+        capture_output,
+        kwargs,
+    ):
+        await cls.admit(terraform_run, cancelled)
+
+        outputs = []
+        if capture_output or on_output is not None:
+            stdout, stderr = kwargs.get("stdout"), kwargs.get("stderr")
+            if capture_output:
+                stdout = stderr = None
+            kwargs["stdout"] = PIPE
+            kwargs["stderr"] = STDOUT if stderr is stdout is not None else PIPE
+            outputs = [("stdout", stdout), ("stderr", stderr)]
+            if kwargs["stderr"] == STDOUT:
+                outputs.pop()
+
+        loop = asyncio.get_running_loop()
+        limits = ResourceLimits()
+        limits.prepare()
+        # Forking may take a while for a large process, hence it is left to a worker thread
+        process = await loop.run_in_executor(
+            None,
+            partial(Popen, [*LAUNCHER, *terraform_run.args], stdin=PIPE, **kwargs),
+        )
+        exited = asyncio.Event()
+        pidfd = None
+        pumps = []
+        try:
+            try:
+                pidfd = os.pidfd_open(process.pid)
+                loop.add_reader(pidfd, exited.set)
+            except (AttributeError, OSError):
+                # Without pidfd, the exit of the process is polled
+                pidfd = None
+            try:
+                limits.apply(process.pid)
+            finally:
+                # Lets the launcher execute terraform
+                process.stdin.close()
+            if on_start is not None:
+                on_start(process)
+
+            captured = {}
+            for name, target in outputs:
+                captured[name] = [] if capture_output else None
+                pumps.append(
+                    asyncio.create_task(
+                        cls.pump(
+                            getattr(process, name), target, captured[name], on_output
+                        )
+                    )
+                )
+
+            deadline = monotonic() + timeout if timeout else None
+            next_check = monotonic()
+            interrupted = []
+            interval = min(0.05, CANCEL_POLL_INTERVAL)
+            while True:
+                # The process is only reaped once its pidfd is readable, it is polled
+                # without pidfd
+                if pidfd is None or exited.is_set():
+                    try:
+                        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                    except ChildProcessError:
+                        # Reaped by another waiter, such as the SIGCHLD watcher installed
+                        # by gevent.monkey.patch_all(), which records the exit code in the
+                        # Popen
+                        rusage = None
+                        if process.returncode is None:
+                            await loop.run_in_executor(None, process.wait)
+                        break
+                    if pid:
+                        process.returncode = os.waitstatus_to_exitcode(status)
+                        break
+                if deadline is not None and not terraform_run.timed_out:
+                    if monotonic() >= deadline:
+                        logging.warning(
+                            f"{' '.join(terraform_run.args[:2])} timed out after {timeout}s"
+                        )
+                        terraform_run.timed_out = True
+                if terraform_run.timed_out or terraform_run.cancel_requested:
+                    interrupt(process, interrupted)
+                elif monotonic() >= next_check:
+                    next_check = monotonic() + CANCEL_POLL_INTERVAL
+                    if await cls.is_cancelled(terraform_run, cancelled):
+                        interrupt(process, interrupted)
+                try:
+                    await asyncio.wait_for(exited.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+                interval = min(interval * 2, CANCEL_POLL_INTERVAL)
+
+            terraform_run.returncode = process.returncode
+            terraform_run.interrupted = bool(interrupted)
+            terraform_run.peak_memory = limits.get_peak_memory(rusage)
+            if pumps:
+                # Providers left behind by a killed terraform may hold the pipes open
+                await asyncio.wait(pumps, timeout=KILL_TIMEOUT)
+            if capture_output:
+                terraform_run.stdout = b"".join(captured["stdout"])
+                terraform_run.stderr = b"".join(captured.get("stderr", []))
+        finally:
+            for task in pumps:
+                task.cancel()
+            if pidfd is not None:
+                loop.remove_reader(pidfd)
+                os.close(pidfd)
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                if pipe is not None:
+                    pipe.close()
+            limits.release()
+        return terraform_run
+
+
+def run(
+    args,
+    *,
+    job=None,
+    on_start=None,
+    check=False,
+    capture_output=False,
+    timeout=None,
+    **kwargs,
+):
+    """
+    Runs a terraform command like `subprocess.run`, through the TerraformSupervisor.
+
+    :param job: The job running the command. The command is interrupted when the
+                cancellation of the job is requested, and its peak memory is recorded
+                with the job.
+    :param on_start: Called with the process once it started and its resources are limited.
+    :raise TerraformCancelledError: When check is True and the command was cancelled.
+    :raise TerraformTimeoutError: When check is True and the command timed out.
+    """
+    terraform_run = TerraformSupervisor.start(
+        args,
+        on_start=on_start,
+        capture_output=capture_output,
+        timeout=timeout,
+        **kwargs,
+    )
+    # The database session of the job belongs to the calling thread,
+    # hence the cancellation is checked while waiting for the command
+    cancelled = job.is_cancel_requested if job is not None else None
+    while not terraform_run.wait(CANCEL_POLL_INTERVAL):
+        if cancelled is not None and cancelled():
+            terraform_run.cancel()
+            cancelled = None
+    return terraform_run.result(job=job, check=check)
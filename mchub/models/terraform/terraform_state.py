@@ -26,6 +26,22 @@ FREEIPA_PASSWD_PARSER = parse(
 )
 
 
+def get_address(resource, instance):
+    """
+    :return: The terraform address of an instance of a resource of the state,
+             e.g. `module.openstack.openstack_compute_instance_v2.instances["node1"]`.
+    """
+    address = f"{resource['type']}.{resource['name']}"
+    if resource.get("module"):
+        address = f"{resource['module']}.{address}"
+    index_key = instance.get("index_key")
+    if isinstance(index_key, str):
+        address += f'["{index_key}"]'
+    elif index_key is not None:
+        address += f"[{index_key}]"
+    return address
+
+
 class TerraformState:
     """
     TerraformState holds the state file of a cluster, i.e. the terraform.tfstate file.
@@ -39,6 +55,7 @@ class TerraformState:
         "volume_size",
         "image",
         "freeipa_passwd",
+        "addresses",
     ]
 
     def __init__(self, tf_state: object, cloud="openstack"):
@@ -62,3 +79,10 @@ class TerraformState:
             self.freeipa_passwd = FREEIPA_PASSWD_PARSER.find(tf_state)[0].value
         except:
             self.freeipa_passwd = None
+        # The addresses of the managed resources, to target the resources of instances
+        self.addresses = [
+            get_address(resource, instance)
+            for resource in tf_state.get("resources", [])
+            if resource.get("mode") == "managed"
+            for instance in resource.get("instances", [])
+        ]
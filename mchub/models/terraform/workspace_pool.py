@@ -0,0 +1,184 @@
+import fcntl
+import json
+import logging
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, makedirs, path, rename
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from uuid import uuid4
+
+from .terraform_cache import TerraformCache
+from .terraform_process import run
+
+from ...configuration import get_config
+from ...configuration import env
+from ...configuration.magic_castle import (
+    MAIN_TERRAFORM_FILENAME,
+    TERRAFORM_REQUIRED_VERSION,
+)
+
+POOL_DIRNAME = ".pool"
+
+
+class WorkspacePool:
+    """
+    WorkspacePool keeps cluster directories ready to plan: the module links are created
+    and terraform is initialized. Creating a cluster renames a ready workspace to the
+    cluster's directory, then only main.tf.json has to be written.
+
+    The pool holds `workspace_pool_size` workspaces per combination of cloud provider and
+    DNS module. It lives in the clusters directory, since a rename is atomic only within
+    a filesystem, and is refilled in the background each time a workspace is taken.
+    """
+
+    _executor = None
+    _lock = Lock()
+    hits = Counter()
+    misses = Counter()
+
+    @staticmethod
+    def size():
+        return get_config()["workspace_pool_size"]
+
+    @staticmethod
+    def get_path(modules=None):
+        pool_path = path.join(env.CLUSTERS_PATH, POOL_DIRNAME)
+        if modules is None:
+            return pool_path
+        return path.join(pool_path, TerraformCache.get_key(modules))
+
+    @classmethod
+    def get_ready(cls, modules):
+        """
+        :return: The names of the ready workspaces. Workspaces being built start with a dot.
+        """
+        try:
+            return sorted(
+                name
+                for name in listdir(cls.get_path(modules))
+                if not name.startswith(".")
+            )
+        except FileNotFoundError:
+            return []
+
+    @classmethod
+    def take(cls, cluster_path, provider, dns_module=None):
+        """
+        Moves a ready workspace to the cluster's directory.
+
+        :return: True if a workspace was taken, False if the pool is empty or disabled.
+        """
+        if cls.size() == 0 or path.exists(cluster_path):
+            return False
+        modules = TerraformCache.get_sources(provider, dns_module)
+        key = TerraformCache.get_key(modules)
+        taken = False
+        for name in cls.get_ready(modules):
+            try:
+                rename(path.join(cls.get_path(modules), name), cluster_path)
+            except OSError:
+                # Taken by another process in the meantime
+                continue
+            taken = True
+            break
+        if taken:
+            cls.hits[key] += 1
+        else:
+            cls.misses[key] += 1
+        cls.refill_async(modules)
+        return taken
+
+    @classmethod
+    def build(cls, modules):
+        """
+        Creates a ready workspace in the pool of the given module sources.
+        """
+        pool_path = cls.get_path(modules)
+        workspace = mkdtemp(dir=pool_path, prefix=".building-")
+        try:
+            with open(path.join(workspace, MAIN_TERRAFORM_FILENAME), "w") as file:
+                json.dump(
+                    {
+                        "terraform": {"required_version": TERRAFORM_REQUIRED_VERSION},
+                        "module": {
+                            name: {"source": source} for name, source in modules.items()
+                        },
+                    },
+                    file,
+                )
+            TerraformCache.link_local_modules(workspace, modules)
+            if not TerraformCache.populate(workspace):
+                run(
+                    ["terraform", "init", "-no-color", "-input=false"],
+                    cwd=workspace,
+                    capture_output=True,
+                    check=True,
+                )
+                TerraformCache.mark_initialized(workspace)
+            rename(workspace, path.join(pool_path, uuid4().hex))
+        except BaseException:
+            rmtree(workspace, ignore_errors=True)
+            raise
+
+    @classmethod
+    def refill(cls, modules):
+        """
+        Builds workspaces until the pool of the given module sources is full.
+        Processes sharing the clusters directory wait for each other instead of overfilling.
+        """
+        pool_path = cls.get_path(modules)
+        makedirs(pool_path, exist_ok=True)
+        with open(f"{pool_path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for _ in range(cls.size() - len(cls.get_ready(modules))):
+                cls.build(modules)
+
+    @classmethod
+    def refill_async(cls, modules):
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="mchub-pool"
+                )
+        cls._executor.submit(cls.refill_safely, modules)
+
+    @classmethod
+    def refill_safely(cls, modules):
+        try:
+            cls.refill(modules)
+        except Exception as error:
+            logging.error(f"Could not refill the workspace pool - {error}")
+
+    @classmethod
+    def prewarm(cls):
+        """
+        Fills the pools of every cloud provider and DNS module of configuration.json.
+        """
+        if cls.size() == 0:
+            return
+        for provider, dns_module in TerraformCache.get_combinations():
+            cls.refill_safely(TerraformCache.get_sources(provider, dns_module))
+
+    @classmethod
+    def metrics(cls):
+        """
+        :return: The number of ready workspaces, the target size and the number of clusters
+                 created with (hits) and without (misses) a ready workspace by this process,
+                 for each pool.
+        """
+        metrics = {}
+        for provider, dns_module in TerraformCache.get_combinations():
+            modules = TerraformCache.get_sources(provider, dns_module)
+            key = TerraformCache.get_key(modules)
+            metrics[key] = {
+                "provider": provider,
+                "dns_module": dns_module,
+                "ready": len(cls.get_ready(modules)),
+                "size": cls.size(),
+                "hits": cls.hits[key],
+                "misses": cls.misses[key],
+            }
+        return metrics
@@ -34,7 +34,10 @@ class TokenSuperUser:
 
     @property
     def magic_castles(self):
-        return [MagicCastle(orm) for orm in MagicCastleORM.query.all()]
+        return [
+            MagicCastle(orm)
+            for orm in MagicCastleORM.query.filter_by(warm_pool_id=None).all()
+        ]
 
 
 class User:
@@ -57,6 +60,8 @@ class User:
             MagicCastle(orm=mc_orm)
             for project in self.projects
             for mc_orm in project.magic_castles
+            # The clusters of the warm pools are handed over on creation
+            if mc_orm.warm_pool_id is None
         ]
 
 
@@ -0,0 +1,299 @@
+import logging
+import re
+
+from copy import deepcopy
+from uuid import uuid4
+
+from flask import current_app
+from marshmallow import ValidationError
+
+from ...database import db
+from ...exceptions.invalid_usage_exception import InvalidUsageException
+
+# Suffix of the cluster names of a pool, e.g. workshop-3f9a1c
+CLUSTER_SUFFIX_LENGTH = 6
+# The cluster name must have room for the suffix within RFC 1035's 63 characters
+WARM_POOL_NAME_PATTERN = re.compile(r"^[a-z]([a-z0-9-]{0,54}[a-z0-9])?$")
+# Keys of a cluster configuration chosen when a cluster is handed over, not by the pool
+HANDOVER_KEYS = ("cloud", "cluster_name", "expiration_date")
+
+
+class WarmPoolORM(db.Model):
+    __tablename__ = "warm_pool"
+    __table_args__ = (db.UniqueConstraint("project_id", "name"),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    config = db.Column(db.PickleType())
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    misses = db.Column(db.Integer, nullable=False, default=0)
+    refills = db.Column(db.Integer, nullable=False, default=0)
+    project_id = db.Column(db.Integer, db.ForeignKey("project.id"), nullable=False)
+    project = db.relationship(
+        "Project",
+        backref=db.backref("warm_pools", cascade="all, delete-orphan"),
+        uselist=False,
+    )
+
+
+class WarmPool:
+    """
+    WarmPool keeps `size` clusters of a project built from the same configuration, the
+    template of the pool, applied and provisioned ahead of the requests of users.
+
+    The clusters of a pool are named after the pool with a random suffix, and are hidden
+    from the cluster lists. Once planned, they are applied right away, after every other
+    apply (see JobPriority.WARM_POOL). Creating a cluster from the pool hands over one of
+    its provisioned clusters: the cluster leaves the pool, keeping its name, and gets the
+    expiration date of the request. The pool is then refilled in the background.
+    A request served by the pool is a hit, a request made while no cluster of the pool
+    was provisioned is a miss, and every cluster started to refill the pool is a refill.
+
+    Clusters of the pool whose plan, build or provisioning failed leave the pool, so that
+    the admins of the project can destroy them, and are replaced.
+    """
+
+    __slots__ = ["orm"]
+
+    def __init__(self, orm):
+        self.orm = orm
+
+    @property
+    def id(self):
+        return self.orm.id
+
+    @property
+    def name(self):
+        return self.orm.name
+
+    @property
+    def size(self):
+        return self.orm.size
+
+    @property
+    def project(self):
+        return self.orm.project
+
+    @classmethod
+    def get(cls, project, name):
+        orm = WarmPoolORM.query.filter_by(project_id=project.id, name=name).first()
+        return cls(orm) if orm is not None else None
+
+    @classmethod
+    def all(cls, projects):
+        project_ids = [project.id for project in projects]
+        return [
+            cls(orm)
+            for orm in WarmPoolORM.query.filter(WarmPoolORM.project_id.in_(project_ids))
+            .order_by(WarmPoolORM.project_id, WarmPoolORM.name)
+            .all()
+        ]
+
+    @classmethod
+    def configure(cls, project, name, size, config):
+        """
+        Creates or updates the pool of the project, then refills it.
+
+        :param config: The configuration of the clusters, without their name and cloud.
+        :return: The pool.
+        """
+        from ..magic_castle.magic_castle_configuration import MagicCastleConfiguration
+
+        if type(name) is not str or not WARM_POOL_NAME_PATTERN.match(name):
+            raise InvalidUsageException(
+                "The name of a warm pool must be a valid cluster name "
+                "of at most 56 characters"
+            )
+        if type(size) is not int or size < 0:
+            raise InvalidUsageException("size must be a positive integer")
+        if not isinstance(config, dict):
+            raise InvalidUsageException("config must be a cluster configuration")
+        config = {
+            key: value for key, value in config.items() if key not in HANDOVER_KEYS
+        }
+        try:
+            MagicCastleConfiguration(
+                project.provider, {**deepcopy(config), "cluster_name": name}
+            )
+        except ValidationError as err:
+            raise InvalidUsageException(
+                f"The magic castle configuration could not be parsed.\nError: {err.messages}"
+            )
+
+        warm_pool = cls.get(project, name)
+        if warm_pool is None:
+            warm_pool = cls(WarmPoolORM(name=name, project=project))
+            db.session.add(warm_pool.orm)
+        warm_pool.orm.size = size
+        warm_pool.orm.config = config
+        db.session.commit()
+        warm_pool.refill()
+        return warm_pool
+
+    def get_members(self):
+        """
+        :return: The clusters of the pool, oldest first.
+        """
+        from ..magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+        return [
+            MagicCastle(orm)
+            for orm in MagicCastleORM.query.filter_by(warm_pool_id=self.id)
+            .order_by(MagicCastleORM.id)
+            .all()
+        ]
+
+    def get_configuration(self, data=None):
+        """
+        :param data: The cloud, cluster name and expiration date of the cluster, the
+                     cluster name being generated when missing.
+        :return: The configuration of a cluster built from the template of the pool.
+        """
+        data = data or {}
+        return {
+            **deepcopy(self.orm.config),
+            "cluster_name": data.get("cluster_name")
+            or f"{self.name}-{uuid4().hex[:CLUSTER_SUFFIX_LENGTH]}",
+            "cloud": {"id": self.orm.project_id},
+            "expiration_date": data.get("expiration_date"),
+        }
+
+    def count(self, counter):
+        WarmPoolORM.query.filter_by(id=self.id).update(
+            {counter: getattr(WarmPoolORM, counter) + 1}, synchronize_session=False
+        )
+        db.session.commit()
+        db.session.refresh(self.orm)
+
+    def take(self, expiration_date=None):
+        """
+        Hands over a provisioned cluster of the pool. A cluster is claimed with a
+        conditional update, hence it is handed over once across every MC Hub process.
+
+        :return: The cluster, or None if no cluster of the pool is provisioned.
+        """
+        from ..magic_castle.magic_castle import MagicCastleORM
+        from ..magic_castle.cluster_status_code import ClusterStatusCode
+        from ..magic_castle.plan_type import PlanType
+
+        for magic_castle in self.get_members():
+            if (
+                magic_castle.plan_type != PlanType.NONE
+                or magic_castle.status != ClusterStatusCode.PROVISIONING_SUCCESS
+            ):
+                continue
+            claimed = MagicCastleORM.query.filter(
+                MagicCastleORM.id == magic_castle.orm.id,
+                MagicCastleORM.warm_pool_id == self.id,
+            ).update(
+                {"warm_pool_id": None, "expiration_date": expiration_date},
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if claimed == 1:
+                db.session.refresh(magic_castle.orm)
+                self.count("hits")
+                logging.info(f"Handed over {magic_castle.hostname} from {self.name}")
+                return magic_castle
+        self.count("misses")
+        return None
+
+    def refill(self):
+        """
+        Releases the failed clusters of the pool, then starts building the clusters
+        missing from the pool.
+
+        :return: The jobs in charge of planning the new clusters.
+        """
+        from ..magic_castle.magic_castle import MagicCastle
+        from ..magic_castle.cluster_status_code import ClusterStatusCode
+
+        members = []
+        for magic_castle in self.get_members():
+            if magic_castle.status in (
+                ClusterStatusCode.PLAN_ERROR,
+                ClusterStatusCode.BUILD_ERROR,
+                ClusterStatusCode.PROVISIONING_ERROR,
+                ClusterStatusCode.DESTROY_ERROR,
+            ):
+                logging.warning(
+                    f"Released {magic_castle.hostname} from {self.name}, "
+                    f"status: {magic_castle.status}"
+                )
+                magic_castle.orm.warm_pool_id = None
+            else:
+                members.append(magic_castle)
+        db.session.commit()
+
+        jobs = []
+        for _ in range(self.size - len(members)):
+            magic_castle = MagicCastle()
+            magic_castle.orm.warm_pool_id = self.id
+            jobs.append(magic_castle.plan_creation(self.get_configuration()))
+            self.count("refills")
+        return jobs
+
+    def refill_async(self):
+        """
+        Refills the pool in a worker of the job queue, once the request is answered.
+        """
+        from ..job.job_queue import JobQueue
+
+        app = current_app._get_current_object()
+        JobQueue.executor().submit(WarmPool.run_refill, app, self.id)
+
+    @staticmethod
+    def run_refill(app, warm_pool_id):
+        with app.app_context():
+            WarmPool.refill_safely(warm_pool_id)
+
+    @staticmethod
+    def refill_safely(warm_pool_id):
+        """
+        Refills the pool, unless it was deleted in the meantime. Errors are logged, as the
+        pool is refilled again by the next request it serves.
+        """
+        try:
+            orm = WarmPoolORM.query.get(warm_pool_id)
+            if orm is not None:
+                WarmPool(orm).refill()
+        except Exception as error:
+            logging.exception(f"Could not refill warm pool {warm_pool_id} - {error}")
+            db.session.rollback()
+
+    def delete(self):
+        """
+        Deletes the pool. Its clusters are kept, as regular clusters of the project.
+        """
+        for magic_castle in self.get_members():
+            magic_castle.orm.warm_pool_id = None
+        db.session.delete(self.orm)
+        db.session.commit()
+
+    @property
+    def state(self):
+        from ..magic_castle.cluster_status_code import ClusterStatusCode
+
+        members = self.get_members()
+        ready = sum(
+            member.orm.status == ClusterStatusCode.PROVISIONING_SUCCESS
+            for member in members
+        )
+        return {
+            "name": self.name,
+            "cloud": {"name": self.project.name, "id": self.project.id},
+            "size": self.size,
+            "config": self.orm.config,
+            "ready": ready,
+            "building": len(members) - ready,
+            "hits": self.orm.hits,
+            "misses": self.orm.misses,
+            "refills": self.orm.refills,
+        }
+
+    @classmethod
+    def metrics(cls, projects):
+        return [
+            {key: value for key, value in warm_pool.state.items() if key != "config"}
+            for warm_pool in cls.all(projects)
+        ]
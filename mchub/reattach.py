@@ -0,0 +1,51 @@
+"""Waits for the terraform applies which kept running through a restart of MC Hub
+and saves their outcome, as the applies would have if MC Hub had not restarted.
+Started by `python -m mchub.schema_update --clean` with the ids of the apply jobs.
+"""
+
+import argparse
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import create_app
+from .models.job.apply_scheduler import ApplyScheduler
+from .models.job.job import Job
+from .models.job.job_queue import JobQueue
+
+logging.basicConfig(level=logging.INFO)
+
+
+def reattach(app, job_id):
+    """
+    Waits for the apply of the job and saves its outcome. Then, as the ApplyScheduler
+    does once an apply completes, starts the applies queued behind it, since the
+    reattached applies count as running toward the concurrency limits.
+    """
+    with app.app_context():
+        try:
+            job = Job.get(job_id)
+            if job is not None:
+                JobQueue.perform(job)
+        except Exception as error:
+            logging.exception(f"Could not reattach to apply job {job_id} - {error}")
+        finally:
+            ApplyScheduler.dispatch()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reattach to the terraform applies of the given jobs"
+    )
+    parser.add_argument("job_ids", nargs="+", type=int)
+    arguments = parser.parse_args()
+
+    app = create_app()
+    # The applies are waited for concurrently, each one completing on its own
+    with ThreadPoolExecutor(
+        max_workers=len(arguments.job_ids), thread_name_prefix="mchub-reattach"
+    ) as executor:
+        for job_id in arguments.job_ids:
+            executor.submit(reattach, app, job_id)
+    # The applies started behind the reattached ones complete in this process
+    ApplyScheduler.wait()
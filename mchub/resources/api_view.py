@@ -1,15 +1,18 @@
+import hashlib
 import json
 import re
 
 from getpass import getuser
 
-from flask import request
+from flask import Response, request
 from flask.views import MethodView
+from werkzeug.http import quote_etag
 from flask import make_response
 
 from ..configuration import get_config
 from ..database import db
 from ..models.auth_type import AuthType
+from ..models.idempotency.idempotency_key import IdempotencyKey
 from ..models.user import LocalUser, SAMLUser, UserORM, TokenSuperUser
 from ..exceptions.invalid_usage_exception import (
     UnauthenticatedException,
@@ -20,7 +23,44 @@ from ..exceptions.server_exception import ServerException
 
 AUTH_HEADER_PAT = re.compile(r"token\s+(.+)", re.IGNORECASE)
 
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENT_METHODS = {"POST", "DELETE"}
+
 DEFAULT_RESPONSE_CODE = 200
+NOT_MODIFIED_RESPONSE_CODE = 304
+
+
+def get_etag(*versions):
+    """
+    :param versions: The values the response is derived from, serializable to JSON.
+    :return: A strong ETag, the same for equal versions.
+    """
+    return hashlib.sha1(
+        json.dumps(versions, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_etag_headers(etag):
+    """
+    :return: The headers of a response tagged with etag, which clients must revalidate
+             with an `If-None-Match` header before using their cached copy.
+    """
+    return {"ETag": quote_etag(etag), "Cache-Control": "no-cache"}
+
+
+def not_modified(etag):
+    """
+    Route handlers call not_modified before computing the response of a conditional
+    GET request, to skip it when the client already has this version of the response.
+
+    :return: An empty 304 response if the `If-None-Match` header of the request holds
+             etag, otherwise None.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return Response(
+            status=NOT_MODIFIED_RESPONSE_CODE, headers=get_etag_headers(etag)
+        )
+    return None
 
 
 def output_json(route_handler):
@@ -34,11 +74,18 @@ def output_json(route_handler):
 
     def decorator(*args, **kwargs):
         response = route_handler(*args, **kwargs)
-        if type(response) == tuple:
+        if isinstance(response, Response):
+            # Streamed responses, like the server-sent events
+            return response
+        headers = {"Content-Type": "application/json"}
+        if type(response) == tuple and len(response) == 3:
+            # Responses with additional headers, like the ETag
+            data, response_code, extra_headers = response
+            headers.update(extra_headers)
+        elif type(response) == tuple:
             data, response_code = response
         else:
             data, response_code = response, DEFAULT_RESPONSE_CODE
-        headers = {"Content-Type": "application/json"}
         return make_response(json.dumps(data), response_code, headers)
 
     return decorator
@@ -122,12 +169,61 @@ def compute_current_user(route_handler):
     return decorator
 
 
+def idempotent(route_handler):
+    """
+    Creates a decorator that replays the response of a POST or DELETE request repeated
+    with the same `Idempotency-Key` header, instead of handling the request again.
+
+    :param route_handler: The Flask route handler function, taking the current user.
+    :return: The decorator that handles the idempotency keys.
+    """
+
+    def decorator(user, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if not key or request.method not in IDEMPOTENT_METHODS:
+            return route_handler(user, *args, **kwargs)
+        if len(key) > 255:
+            raise InvalidUsageException(f"{IDEMPOTENCY_KEY_HEADER} is too long")
+
+        orm = getattr(user, "orm", None)
+        scope = orm.scoped_id if orm is not None else "token"
+        fingerprint = IdempotencyKey.get_fingerprint(
+            request.method, request.path, request.get_data()
+        )
+        reserved, original = IdempotencyKey.reserve(scope, key, fingerprint)
+        if original is not None:
+            if original.fingerprint != fingerprint:
+                raise InvalidUsageException(
+                    f"This {IDEMPOTENCY_KEY_HEADER} was used for another request", 422
+                )
+            if not original.completed:
+                raise InvalidUsageException(
+                    f"A request with this {IDEMPOTENCY_KEY_HEADER} is in progress", 409
+                )
+            return original.response
+
+        try:
+            response = route_handler(user, *args, **kwargs)
+        except BaseException:
+            reserved.release()
+            raise
+        if type(response) == tuple:
+            data, response_code = response
+        else:
+            data, response_code = response, DEFAULT_RESPONSE_CODE
+        reserved.complete(data, response_code)
+        return data, response_code
+
+    return decorator
+
+
 class ApiView(MethodView):
     """
     Configures all child classes to use the default decorators on all route handlers.
     """
 
     decorators = [
+        idempotent,
         compute_current_user,
         handle_exceptions,
         output_json,
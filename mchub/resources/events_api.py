@@ -0,0 +1,142 @@
+import json
+
+from time import monotonic, sleep
+
+from flask import Response, stream_with_context
+
+from .api_view import ApiView
+from .progress_api import ProgressAPI
+from ..database import db
+from ..models.events.cluster_events import ClusterEvents
+from ..models.magic_castle.cluster_status_code import ClusterStatusCode
+from ..models.magic_castle.magic_castle import MagicCastleORM, MagicCastle
+from ..models.user import User
+
+# Seconds between two comments sent on an idle stream, so that proxies keep it open
+KEEPALIVE_INTERVAL = 15
+# Seconds between two checks of the clusters being provisioned, which notify nothing
+PROVISIONING_CHECK_INTERVAL = 5
+# Minimum number of seconds between two updates, the notifications received in the
+# meantime are sent as a single update
+MIN_UPDATE_INTERVAL = 0.5
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def wait(subscription, provisioning, last_update):
+    """
+    Waits for the next notifications of the subscription. The clusters being
+    provisioned are checked periodically, since their provisioning notifies nothing.
+
+    :return: The hostnames of the clusters notified, or None to send a keepalive.
+    """
+    timeout = PROVISIONING_CHECK_INTERVAL if provisioning else KEEPALIVE_INTERVAL
+    changed = subscription.wait(timeout)
+    if not changed and not provisioning:
+        return None
+    delay = last_update + MIN_UPDATE_INTERVAL - monotonic()
+    if delay > 0:
+        sleep(delay)
+        changed.update(subscription.wait(0))
+    return changed
+
+
+def stream_cluster(hostname, project_ids):
+    """
+    Sends the state of the cluster, as returned by the status route, in a `status`
+    event. When only the progress of resources changed, sends these resources in a
+    `progress` event instead. The stream ends once the cluster is not found.
+    """
+    subscription = ClusterEvents.subscribe(hostname)
+    try:
+        state, progress = None, {}
+        while True:
+            last_update = monotonic()
+            new_state = ProgressAPI.get_state(hostname, project_ids)
+            # Nothing is held while waiting for the next notification
+            db.session.remove()
+            changes = new_state.pop("progress", None)
+            new_progress = {change["address"]: change for change in changes or ()}
+            if new_state != state or new_progress.keys() != progress.keys():
+                yield format_event("status", {**new_state, "progress": changes})
+            elif new_progress != progress:
+                yield format_event(
+                    "progress",
+                    [
+                        change
+                        for address, change in new_progress.items()
+                        if progress[address] != change
+                    ],
+                )
+            state, progress = new_state, new_progress
+            if state["status"] == ClusterStatusCode.NOT_FOUND:
+                return
+            provisioning = state["status"] == ClusterStatusCode.PROVISIONING_RUNNING
+            while wait(subscription, provisioning, last_update) is None:
+                yield ": keepalive\n\n"
+    finally:
+        ClusterEvents.unsubscribe(subscription)
+
+
+def stream_clusters(user: User):
+    """
+    Sends a `status` event with the hostname and the status of every cluster of the
+    user whose status changed, including the clusters created and deleted.
+    """
+    subscription = ClusterEvents.subscribe()
+    try:
+        project_ids = {project.id for project in user.projects}
+        statuses = {
+            magic_castle.hostname: magic_castle.status
+            for magic_castle in user.magic_castles
+        }
+        db.session.remove()
+        last_update = monotonic()
+        while True:
+            provisioning = {
+                hostname
+                for hostname, status in statuses.items()
+                if status == ClusterStatusCode.PROVISIONING_RUNNING
+            }
+            changed = wait(subscription, provisioning, last_update)
+            if changed is None:
+                yield ": keepalive\n\n"
+                continue
+            last_update = monotonic()
+            for hostname in sorted(changed | provisioning):
+                orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
+                if (
+                    orm is not None
+                    and orm.project_id in project_ids
+                    # The clusters of the warm pools are hidden until handed over
+                    and orm.warm_pool_id is None
+                ):
+                    status = MagicCastle(orm).status
+                else:
+                    status = ClusterStatusCode.NOT_FOUND
+                if status == statuses.get(hostname, ClusterStatusCode.NOT_FOUND):
+                    continue
+                if status == ClusterStatusCode.NOT_FOUND:
+                    del statuses[hostname]
+                else:
+                    statuses[hostname] = status
+                yield format_event("status", {"hostname": hostname, "status": status})
+            db.session.remove()
+    finally:
+        ClusterEvents.unsubscribe(subscription)
+
+
+class EventsAPI(ApiView):
+    def get(self, user: User, hostname=None):
+        if hostname is None:
+            stream = stream_clusters(user)
+        else:
+            stream = stream_cluster(hostname, {project.id for project in user.projects})
+        return Response(
+            stream_with_context(stream),
+            mimetype="text/event-stream",
+            # Sent as they are written, through proxies as well
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
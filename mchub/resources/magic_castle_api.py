@@ -1,13 +1,40 @@
-from operator import imod
 from flask import request
-from .api_view import ApiView
+from .api_view import (
+    ApiView,
+    DEFAULT_RESPONSE_CODE,
+    get_etag,
+    get_etag_headers,
+    not_modified,
+)
 from ..exceptions.invalid_usage_exception import (
     ClusterNotFoundException,
     InvalidUsageException,
 )
 from ..models.cloud.project import Project
 from ..models.user import User
+from ..models.job.job_status_code import JobStatusCode
+from ..models.magic_castle.cluster_status_code import ClusterStatusCode
 from ..models.magic_castle.magic_castle import MagicCastleORM, MagicCastle
+from ..models.warm_pool.warm_pool import WarmPool
+
+
+def get_project(user: User, json_data):
+    """
+    :return: The project of the cloud of the request, or None when the request has no
+             cloud id or the project does not exist.
+    :raise InvalidUsageException: When the cloud is malformed or the project belongs
+                                  to other users.
+    """
+    cloud = json_data.get("cloud")
+    if cloud is None:
+        return None
+    if not isinstance(cloud, dict):
+        raise InvalidUsageException("Invalid project id")
+    project_id = cloud.get("id")
+    project = Project.query.get(project_id) if project_id is not None else None
+    if project and project not in user.projects:
+        raise InvalidUsageException("Invalid project id")
+    return project
 
 
 class MagicCastleAPI(ApiView):
@@ -15,34 +42,89 @@ class MagicCastleAPI(ApiView):
         if hostname:
             orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
             if orm and orm.project in user.projects:
-                return MagicCastle(orm).state
+                magic_castle = MagicCastle(orm)
             else:
                 raise ClusterNotFoundException
+            if orm.status == ClusterStatusCode.PROVISIONING_RUNNING:
+                # The status is only known once the cluster is checked, with the state
+                return magic_castle.state
+            etag = get_etag(orm.version, magic_castle.age, magic_castle.project.name)
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            return magic_castle.state, DEFAULT_RESPONSE_CODE, get_etag_headers(etag)
         else:
             return [mc.state for mc in user.magic_castles]
 
-    def post(self, user: User, hostname, apply=False):
-        if apply:
+    def post(self, user: User, hostname, apply=False, cancel=False, preview=False):
+        if preview:
             orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
             if orm and orm.project in user.projects:
                 magic_castle = MagicCastle(orm)
             else:
                 raise ClusterNotFoundException
-            magic_castle.apply()
-            return {}
+            json_data = request.get_json()
+            if not json_data:
+                raise InvalidUsageException("No json data was provided")
+            get_project(user, json_data)
+            return magic_castle.preview(json_data)
+        elif cancel:
+            orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
+            if orm and orm.project in user.projects:
+                magic_castle = MagicCastle(orm)
+            else:
+                raise ClusterNotFoundException
+            job = magic_castle.cancel()
+            if job.status == JobStatusCode.CANCELLED:
+                return {"job_id": job.id, "status": job.status}
+            # The worker running the job interrupts terraform
+            return {"job_id": job.id, "status": job.status}, 202
+        elif apply:
+            orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
+            if orm and orm.project in user.projects:
+                magic_castle = MagicCastle(orm)
+            else:
+                raise ClusterNotFoundException
+            job = magic_castle.apply(culling=request.args.get("priority") == "culling")
+            return {"job_id": job.id}, 202
         else:
             json_data = request.get_json()
             if not json_data:
                 raise InvalidUsageException("No json data was provided")
 
-            cloud = json_data.get("cloud", {"id": None})
-            project = Project.query.get(cloud["id"])
-            if project and project not in user.projects:
-                raise InvalidUsageException("Invalid project id")
+            project = get_project(user, json_data)
+            if "warm_pool" in json_data:
+                warm_pool = (
+                    WarmPool.get(project, json_data["warm_pool"]) if project else None
+                )
+                if warm_pool is None:
+                    raise InvalidUsageException("Invalid warm pool")
+                magic_castle = warm_pool.take(json_data.get("expiration_date"))
+                if magic_castle is not None:
+                    response = {
+                        "hostname": magic_castle.hostname,
+                        "warm_pool": "hit",
+                    }, 201
+                else:
+                    # Without a provisioned cluster, one is built from the template of the pool
+                    magic_castle = MagicCastle()
+                    job = magic_castle.plan_creation(
+                        warm_pool.get_configuration(json_data)
+                    )
+                    response = {
+                        "job_id": job.id,
+                        "hostname": magic_castle.hostname,
+                        "warm_pool": "miss",
+                    }, 202
+                # A failed refill never loses the cluster handed over
+                warm_pool.refill_async()
+                return response
 
+            if project is None:
+                raise InvalidUsageException("Invalid project id")
             magic_castle = MagicCastle()
-            magic_castle.plan_creation(json_data)
-            return {}
+            job = magic_castle.plan_creation(json_data)
+            return {"job_id": job.id}, 202
 
     def put(self, user: User, hostname):
         orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
@@ -53,8 +135,10 @@ class MagicCastleAPI(ApiView):
         json_data = request.get_json()
         if not json_data:
             raise InvalidUsageException("No json data was provided")
-        magic_castle.plan_modification(json_data)
-        return {}
+        job = magic_castle.plan_modification(json_data)
+        if job is None:
+            return {}
+        return {"job_id": job.id, "plan_mode": magic_castle.plan_mode}, 202
 
     def delete(self, user: User, hostname):
         orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
@@ -62,5 +146,7 @@ class MagicCastleAPI(ApiView):
             magic_castle = MagicCastle(orm)
         else:
             raise ClusterNotFoundException
-        magic_castle.plan_destruction()
-        return {}
+        job = magic_castle.plan_destruction()
+        if job is None:
+            return {}
+        return {"job_id": job.id}, 202
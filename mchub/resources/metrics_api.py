@@ -0,0 +1,12 @@
+from .api_view import ApiView
+from ..models.user import User
+from ..models.terraform.workspace_pool import WorkspacePool
+from ..models.warm_pool.warm_pool import WarmPool
+
+
+class MetricsAPI(ApiView):
+    def get(self, user: User):
+        return {
+            "workspace_pool": WorkspacePool.metrics(),
+            "warm_pools": WarmPool.metrics(user.projects),
+        }
@@ -1,25 +1,173 @@
-from .api_view import ApiView
+from collections import Counter
+
+from flask import request
+from sqlalchemy.orm import load_only
+
+from .api_view import (
+    ApiView,
+    DEFAULT_RESPONSE_CODE,
+    get_etag,
+    get_etag_headers,
+    not_modified,
+)
+from ..database import db
 from ..exceptions.invalid_usage_exception import InvalidUsageException
 from ..models.magic_castle.cluster_status_code import ClusterStatusCode
+from ..models.magic_castle.plan_type import PlanType
 from ..models.user import User
+from ..models.job.job import Job
+from ..models.job.job_type import JobType
+from ..models.job.job_status_code import JobStatusCode
+from ..models.job.apply_scheduler import ApplyScheduler
 from ..models.magic_castle.magic_castle import MagicCastleORM, MagicCastle
+from ..models.puppet.provisioning_manager import ProvisioningManager
 
 
 class ProgressAPI(ApiView):
-    def get(self, user: User, hostname):
+    def get(self, user: User, hostname=None):
+        project_ids = {project.id for project in user.projects}
+        if hostname is None:
+            hostnames = request.args.getlist("hostname") or None
+            rows = self.get_clusters(hostnames, project_ids)
+            etag = get_etag(
+                hostnames,
+                [
+                    [orm.hostname, orm.status, MagicCastle(orm).get_change_version()]
+                    for orm, _ in rows
+                ],
+            )
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            states = self.get_states(rows, hostnames)
+            return states, DEFAULT_RESPONSE_CODE, get_etag_headers(etag)
+
+        magic_castle, state = self.get_summary(hostname, project_ids)
+        if magic_castle is None:
+            return state
+        # The progress is only computed when the cluster changed since the last request
+        etag = get_etag(state, magic_castle.get_change_version())
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        state = self.add_progress(magic_castle, state)
+        return state, DEFAULT_RESPONSE_CODE, get_etag_headers(etag)
+
+    @classmethod
+    def get_state(cls, hostname, project_ids):
+        """
+        :param project_ids: The ids of the projects of the user.
+        :return: The status of the cluster, the progress of its plan and its latest job.
+        """
+        magic_castle, response = cls.get_summary(hostname, project_ids)
+        if magic_castle is None:
+            return response
+        return cls.add_progress(magic_castle, response)
+
+    @staticmethod
+    def get_summary(hostname, project_ids):
+        """
+        :param project_ids: The ids of the projects of the user.
+        :return: The cluster, or None if it was not found, and its state without the
+                 progress of its plan, which is the costly part.
+        """
         orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
-        if orm and orm.project in user.projects:
+        if orm and orm.project_id in project_ids:
             magic_castle = MagicCastle(orm)
         else:
-            return {"status": ClusterStatusCode.NOT_FOUND}
+            return None, {"status": ClusterStatusCode.NOT_FOUND}
         status = magic_castle.status
-        progress = magic_castle.get_progress()
         stateful = magic_castle.tf_state is not None
-        if progress is None:
-            return {"status": status, "stateful": stateful}
-        else:
-            return {
-                "status": status,
-                "stateful": stateful,
-                "progress": progress,
-            }
+        response = {"status": status, "stateful": stateful}
+        if magic_castle.plan_type != PlanType.NONE:
+            response["plan_mode"] = magic_castle.plan_mode
+        job = Job.latest(hostname)
+        if job is not None:
+            response["job"] = job.state
+            if job.type == JobType.APPLY and job.status == JobStatusCode.QUEUED:
+                response["job"]["queue"] = ApplyScheduler.position(job)
+        return magic_castle, response
+
+    @staticmethod
+    def add_progress(magic_castle, response):
+        progress = magic_castle.get_progress()
+        if progress is not None:
+            response["progress"] = progress
+        return response
+
+    @staticmethod
+    def get_clusters(hostnames, project_ids):
+        """
+        Fetches the clusters of the user with a single query, checking the clusters being
+        provisioned concurrently.
+
+        :param hostnames: The clusters requested, or None for every cluster of the user.
+        :param project_ids: The ids of the projects of the user.
+        :return: The rows of the clusters, with the "stateful" flag.
+        """
+        query = db.session.query(
+            MagicCastleORM, MagicCastleORM.tf_state.isnot(None).label("stateful")
+        ).options(
+            load_only(
+                MagicCastleORM.hostname,
+                MagicCastleORM.status,
+                MagicCastleORM.created,
+                MagicCastleORM.version,
+            )
+        )
+        query = query.filter(
+            MagicCastleORM.project_id.in_(project_ids),
+            # The clusters of the warm pools are hidden until handed over
+            MagicCastleORM.warm_pool_id.is_(None),
+        )
+        if hostnames is not None:
+            query = query.filter(MagicCastleORM.hostname.in_(hostnames))
+        rows = query.all()
+
+        provisioning = {
+            orm.hostname: orm
+            for orm, _ in rows
+            if orm.status == ClusterStatusCode.PROVISIONING_RUNNING
+        }
+        if provisioning:
+            online = ProvisioningManager.check_all_online(provisioning)
+            for hostname, orm in provisioning.items():
+                MagicCastle(orm).update_provisioning_status(online[hostname])
+        return rows
+
+    @staticmethod
+    def get_states(rows, hostnames):
+        """
+        Gets the status of many clusters at once, for the list of clusters. The plans of
+        the clusters being built or destroyed are loaded with a single query.
+
+        :param rows: The clusters and their "stateful" flag, as returned by get_clusters.
+        :param hostnames: The clusters requested, or None for every cluster of the user.
+        :return: {hostname: {"status", "stateful" and, for the clusters being built or
+                 destroyed, "progress": the number of resources per progress}}
+        """
+        states = {
+            orm.hostname: {"status": orm.status, "stateful": stateful}
+            for orm, stateful in rows
+        }
+        applying = [
+            orm
+            for orm, _ in rows
+            if orm.status
+            in (ClusterStatusCode.BUILD_RUNNING, ClusterStatusCode.DESTROY_RUNNING)
+        ]
+        if applying:
+            # Loads the plans into the clusters already fetched
+            MagicCastleORM.query.options(load_only(MagicCastleORM.plan)).filter(
+                MagicCastleORM.id.in_([orm.id for orm in applying])
+            ).all()
+            for orm in applying:
+                progress = MagicCastle(orm).get_progress()
+                if progress is not None:
+                    states[orm.hostname]["progress"] = dict(
+                        Counter(change["change"]["progress"] for change in progress)
+                    )
+
+        for hostname in hostnames or ():
+            states.setdefault(hostname, {"status": ClusterStatusCode.NOT_FOUND})
+        return states
@@ -2,9 +2,11 @@ from flask import request
 from sqlalchemy import inspect
 
 from .api_view import ApiView
+from ..configuration import get_config
 from ..database import db
 from ..models.user import User, UserORM
 from ..models.cloud.project import Project, Provider, ENV_VALIDATORS
+from ..models.terraform.terraform_parallelism import TerraformParallelism
 from ..exceptions.invalid_usage_exception import (
     InvalidUsageException,
 )
@@ -25,6 +27,11 @@ class ProjectAPI(ApiView):
                 "members": [member.scoped_id for member in project.members]
                 if project.admin_id == user.orm.id
                 else [],
+                "parallelism": {
+                    "current": TerraformParallelism.choose(project),
+                    "min": project.min_parallelism,
+                    "max": project.max_parallelism,
+                },
             }
         else:
             return [
@@ -85,6 +92,28 @@ class ProjectAPI(ApiView):
         add_members = data.get("add", [])
         del_members = data.get("del", [])
 
+        bounds = {
+            bound: data.get(bound, getattr(project, bound))
+            for bound in ("min_parallelism", "max_parallelism")
+        }
+        for bound, value in bounds.items():
+            if value is not None and (
+                type(value) is not int
+                or not 1 <= value <= get_config()["max_parallelism"]
+            ):
+                raise InvalidUsageException(
+                    f"{bound} must be between 1 and {get_config()['max_parallelism']}"
+                )
+        if (
+            None not in bounds.values()
+            and bounds["min_parallelism"] > bounds["max_parallelism"]
+        ):
+            raise InvalidUsageException(
+                "min_parallelism cannot be greater than max_parallelism"
+            )
+        project.min_parallelism = bounds["min_parallelism"]
+        project.max_parallelism = bounds["max_parallelism"]
+
         default_domain = user.domain
 
         for username in add_members:
@@ -0,0 +1,44 @@
+from flask import request
+
+from .api_view import ApiView
+from ..models.cloud.project import Project
+from ..models.user import User
+from ..models.warm_pool.warm_pool import WarmPool
+from ..exceptions.invalid_usage_exception import InvalidUsageException
+
+
+class WarmPoolAPI(ApiView):
+    @staticmethod
+    def get_project(user: User, id: int, admin=False):
+        project = Project.query.get(id)
+        if project is None or project not in user.projects:
+            raise InvalidUsageException("Invalid project id")
+        if admin and project.admin_id != user.orm.id:
+            raise InvalidUsageException(
+                "Cannot edit the warm pools of a project that you are not the admin of"
+            )
+        return project
+
+    def get(self, user: User, id: int):
+        project = self.get_project(user, id)
+        return [warm_pool.state for warm_pool in WarmPool.all([project])]
+
+    def put(self, user: User, id: int, name: str):
+        project = self.get_project(user, id, admin=True)
+        data = request.get_json()
+        if not data:
+            raise InvalidUsageException("No json data was provided")
+        try:
+            size = data["size"]
+            config = data["config"]
+        except KeyError as err:
+            raise InvalidUsageException(f"Missing required field {err}")
+        return WarmPool.configure(project, name, size, config).state
+
+    def delete(self, user: User, id: int, name: str):
+        project = self.get_project(user, id, admin=True)
+        warm_pool = WarmPool.get(project, name)
+        if warm_pool is None:
+            raise InvalidUsageException("Invalid warm pool")
+        warm_pool.delete()
+        return {}, 200
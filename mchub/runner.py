@@ -0,0 +1,45 @@
+"""Runs the plan and apply jobs queued by MC Hub. Start one or many runners, on one
+or many hosts sharing the database and CLUSTERS_PATH, and set `external_runners`
+to true in configuration.json so the web server leaves the jobs to them.
+
+Runners also queue and run the drift checks of the clusters. A runner started with
+`--job-types drift` takes a share of them alongside a web server that runs the jobs itself.
+"""
+
+import argparse
+import logging
+import signal
+
+from . import create_app
+from .models.job.job_runner import JobRunner
+from .models.job.job_type import JobType
+from .models.terraform.terraform_cache import TerraformCache
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Claim and run the terraform jobs queued in the MC Hub database"
+    )
+    parser.add_argument("--name", help="Name of the runner (default: hostname:pid)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lease-duration", type=int, help="Lease duration in seconds")
+    parser.add_argument("--poll-interval", type=float, default=2)
+    parser.add_argument(
+        "--job-types",
+        nargs="+",
+        choices=[job_type.value for job_type in JobType],
+        help="Types of jobs claimed by the runner (default: all)",
+    )
+    arguments = parser.parse_args()
+
+    runner = JobRunner(
+        name=arguments.name,
+        workers=arguments.workers,
+        lease_duration=arguments.lease_duration,
+        job_types=arguments.job_types and map(JobType, arguments.job_types),
+    )
+    TerraformCache.prewarm()
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: runner.stop())
+    runner.run(create_app(), poll_interval=arguments.poll_interval)
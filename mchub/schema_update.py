@@ -5,6 +5,7 @@ from os import path
 from . import create_app
 from .database import db
 from .database.cleanup_manager import CleanupManager
+from .database.schema_manager import SchemaManager
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -18,5 +19,10 @@ if __name__ == "__main__":
         if not path.exists(db.engine.url.database):
             print("Database does not exist. Creating...")
             db.create_all()
-        elif arguments.clean:
-            CleanupManager.clean_status()
+        else:
+            # Creates the tables and columns introduced since the database was created
+            db.create_all()
+            for column in SchemaManager.add_missing_columns():
+                print(f"Added column {column}")
+            if arguments.clean:
+                CleanupManager.clean_status()
@@ -58,7 +58,7 @@ def main(host="127.0.0.1", port=5000, interval=3600):
                     continue
 
                 try:
-                    post(apply_api, headers=headers)
+                    post(apply_api, headers=headers, params={"priority": "culling"})
                 except RequestException as e:
                     logging.error(
                         f"Error while deleting {cluster['hostname']} deletion - {e}"
@@ -80,6 +80,7 @@ EXISTING_CLUSTER_STATE = {
     "freeipa_passwd": "FAKE",
     "expiration_date": "2029-01-01",
     "age": "a moment",
+    "drift": None,
 }
 
 ALICE_HEADERS = {
@@ -323,6 +324,7 @@ CLUSTERS = {
         "status": "plan_running",
         "freeipa_passwd": None,
         "age": "a moment",
+        "drift": None,
     },
     "created.magic-castle.cloud": {
         **CLUSTERS_CONFIG["created.magic-castle.cloud"],
@@ -332,6 +334,7 @@ CLUSTERS = {
         "status": "created",
         "freeipa_passwd": None,
         "age": "a moment",
+        "drift": None,
     },
     "valid1.magic-castle.cloud": {
         **CLUSTERS_CONFIG["valid1.magic-castle.cloud"],
@@ -341,6 +344,7 @@ CLUSTERS = {
         "status": "provisioning_success",
         "freeipa_passwd": "FAKE",
         "age": "a moment",
+        "drift": None,
     },
     "empty-state.magic-castle.cloud": {
         **CLUSTERS_CONFIG["empty-state.magic-castle.cloud"],
@@ -350,6 +354,7 @@ CLUSTERS = {
         "status": "build_error",
         "freeipa_passwd": None,
         "age": "a moment",
+        "drift": None,
     },
     "missingfloatingips.mc.ca": {
         **CLUSTERS_CONFIG["missingfloatingips.mc.ca"],
@@ -359,6 +364,7 @@ CLUSTERS = {
         "status": "build_running",
         "freeipa_passwd": None,
         "age": "a moment",
+        "drift": None,
     },
     "missingnodes.mc.ca": {
         **CLUSTERS_CONFIG["missingnodes.mc.ca"],
@@ -368,6 +374,7 @@ CLUSTERS = {
         "status": "build_error",
         "freeipa_passwd": "FAKE",
         "age": "a moment",
+        "drift": None,
     },
     "noowner.magic-castle.cloud": {
         **CLUSTERS_CONFIG["noowner.magic-castle.cloud"],
@@ -377,6 +384,7 @@ CLUSTERS = {
         "status": "provisioning_success",
         "freeipa_passwd": "FAKE",
         "age": "a moment",
+        "drift": None,
     },
 }
 
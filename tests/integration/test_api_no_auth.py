@@ -1,7 +1,19 @@
-from ..test_helpers import client, app, generate_test_clusters, mock_clusters_path
+from ..test_helpers import (
+    MOCK_CLUSTERS_PATH,
+    client,
+    app,
+    generate_test_clusters,
+    mock_clusters_path,
+    inline_job_queue,
+    inline_applies,
+    fake_successful_subprocess_run,
+)
 from ..mocks.configuration.config_mock import (
     config_auth_none_mock as config_mock,
 )  # noqa;
+import json
+
+from os import path
 from subprocess import getoutput
 from getpass import getuser
 
@@ -16,8 +28,10 @@ from ..data import (
     CLUSTERS,
     PROGRESS_DATA,
     DEFAULT_TEMPLATE,
+    VALID_CLUSTER_CONFIGURATION,
 )
 
+
 # GET /api/users/me
 def test_get_current_user(client):
     res = client.get(f"/api/users/me")
@@ -103,6 +117,566 @@ def test_get_status_code(client):
     assert res.get_json()["status"] == "destroy_error"
 
 
+# GET /api/magic-castles/status
+def test_get_all_status(client, mocker):
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.database import db
+
+    res = client.get(f"/api/magic-castles/status")
+    assert res.status_code == 200
+    assert {
+        hostname: state["status"] for hostname, state in res.get_json().items()
+    } == {hostname: cluster["status"] for hostname, cluster in CLUSTERS.items()}
+    assert res.get_json()["missingfloatingips.mc.ca"] == {
+        "status": "build_running",
+        "stateful": False,
+        "progress": {"queued": 28, "done": 1},
+    }
+    assert res.get_json()[EXISTING_HOSTNAME]["stateful"]
+
+    orm = MagicCastleORM.query.filter_by(hostname=EXISTING_HOSTNAME).first()
+    orm.status = ClusterStatusCode.PROVISIONING_RUNNING
+    db.session.commit()
+    check_online = mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=True,
+    )
+    res = client.get(
+        f"/api/magic-castles/status?hostname={EXISTING_HOSTNAME}"
+        f"&hostname={NON_EXISTING_HOSTNAME}"
+    )
+    assert res.get_json() == {
+        EXISTING_HOSTNAME: {"status": "provisioning_success", "stateful": True},
+        NON_EXISTING_HOSTNAME: {"status": "not_found"},
+    }
+    check_online.assert_called_once_with(EXISTING_HOSTNAME)
+
+
+def test_get_status_not_modified(client, mocker):
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.database import db
+
+    url = "/api/magic-castles/missingfloatingips.mc.ca/status"
+    res = client.get(url)
+    etag = res.headers["ETag"]
+    assert res.get_json() == PROGRESS_DATA
+
+    get_progress = mocker.spy(MagicCastle, "get_progress")
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.headers["ETag"] == etag
+    assert res.data == b""
+    get_progress.assert_not_called()
+
+    # Terraform writes the apply log
+    log_path = path.join(
+        MOCK_CLUSTERS_PATH, "missingfloatingips.mc.ca", "terraform_apply.log"
+    )
+    with open(log_path, "a") as file:
+        file.write("\n")
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+    etag = res.headers["ETag"]
+
+    orm = MagicCastleORM.query.filter_by(hostname="missingfloatingips.mc.ca").first()
+    orm.status = ClusterStatusCode.BUILD_ERROR
+    db.session.commit()
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.get_json()["status"] == "build_error"
+
+
+def test_get_state_not_modified(client):
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.database import db
+
+    url = f"/api/magic-castles/{EXISTING_HOSTNAME}"
+    etag = client.get(url).headers["ETag"]
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+    orm = MagicCastleORM.query.filter_by(hostname=EXISTING_HOSTNAME).first()
+    orm.expiration_date = "2030-01-01"
+    db.session.commit()
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.get_json()["expiration_date"] == "2030-01-01"
+
+
+def test_get_all_status_not_modified(client):
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.database import db
+
+    etag = client.get("/api/magic-castles/status").headers["ETag"]
+    res = client.get("/api/magic-castles/status", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+    MagicCastleORM.query.filter_by(hostname=EXISTING_HOSTNAME).delete()
+    db.session.commit()
+    res = client.get("/api/magic-castles/status", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert EXISTING_HOSTNAME not in res.get_json()
+
+
+def read_event(chunks):
+    """
+    :return: The name and the data of the next event of the stream, skipping keepalives.
+    """
+    for chunk in chunks:
+        if not chunk.startswith(b":"):
+            event, data = chunk.decode().strip().split("\n")
+            return event[len("event: ") :], json.loads(data[len("data: ") :])
+
+
+# GET /api/magic-castles/<hostname>/events
+def test_get_events(client, mocker):
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.resources import events_api
+
+    mocker.patch.object(events_api, "MIN_UPDATE_INTERVAL", 0)
+    res = client.get("/api/magic-castles/missingfloatingips.mc.ca/events")
+    assert res.status_code == 200
+    assert res.mimetype == "text/event-stream"
+    chunks = iter(res.response)
+    try:
+        assert read_event(chunks) == ("status", PROGRESS_DATA)
+
+        # terraform reports progress in the apply log
+        with open(
+            path.join(
+                MOCK_CLUSTERS_PATH, "missingfloatingips.mc.ca", "terraform_apply.log"
+            ),
+            "a",
+        ) as file:
+            file.write(
+                "\nmodule.openstack.openstack_compute_secgroup_v2.secgroup: Creating...\n"
+            )
+        assert read_event(chunks) == (
+            "progress",
+            [
+                {
+                    "address": "module.openstack.openstack_compute_secgroup_v2.secgroup",
+                    "type": "openstack_compute_secgroup_v2",
+                    "change": {"actions": ["create"], "progress": "running"},
+                }
+            ],
+        )
+
+        orm = MagicCastleORM.query.filter_by(
+            hostname="missingfloatingips.mc.ca"
+        ).first()
+        MagicCastle(orm).status = ClusterStatusCode.BUILD_ERROR
+        event, state = read_event(chunks)
+        assert event == "status"
+        assert state["status"] == "build_error"
+        assert len(state["progress"]) == len(PROGRESS_DATA["progress"])
+
+        MagicCastle(
+            MagicCastleORM.query.filter_by(hostname="missingfloatingips.mc.ca").first()
+        ).delete()
+        assert read_event(chunks) == (
+            "status",
+            {"status": "not_found", "progress": None},
+        )
+        assert next(chunks, None) is None
+    finally:
+        res.close()
+
+
+def test_get_fleet_events(client, mocker):
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.resources import events_api
+
+    mocker.patch.object(events_api, "MIN_UPDATE_INTERVAL", 0)
+    mocker.patch.object(events_api, "KEEPALIVE_INTERVAL", 0.01)
+    res = client.get("/api/magic-castles/events")
+    assert res.status_code == 200
+    chunks = iter(res.response)
+    try:
+        assert next(chunks) == b": keepalive\n\n"
+
+        orm = MagicCastleORM.query.filter_by(hostname=EXISTING_HOSTNAME).first()
+        MagicCastle(orm).status = ClusterStatusCode.BUILD_ERROR
+        assert read_event(chunks) == (
+            "status",
+            {"hostname": EXISTING_HOSTNAME, "status": "build_error"},
+        )
+    finally:
+        res.close()
+
+    from mchub.models.events.cluster_events import ClusterEvents
+
+    assert ClusterEvents._subscriptions == {}
+
+
+# POST /api/magic-castles
+def test_create_plan_job(client, fake_successful_subprocess_run):
+    from copy import deepcopy
+
+    res = client.post(f"/api/magic-castles", json=deepcopy(VALID_CLUSTER_CONFIGURATION))
+    assert res.status_code == 202
+    job_id = res.get_json()["job_id"]
+
+    res = client.get(f"/api/magic-castles/a-123-45.magic-castle.cloud/status")
+    job = res.get_json()["job"]
+    assert job["id"] == job_id
+    assert job["type"] == "plan"
+    assert job["status"] == "success"
+    assert job["queued"] is not None
+    assert job["finished"] is not None
+
+
+def test_create_plan_idempotency_key(client, fake_successful_subprocess_run):
+    from copy import deepcopy
+    from mchub.models.idempotency.idempotency_key import IdempotencyKeyORM
+    from mchub.models.job.job import JobORM
+
+    headers = {"Idempotency-Key": "create-a-123-45"}
+    res = client.post(
+        f"/api/magic-castles",
+        json=deepcopy(VALID_CLUSTER_CONFIGURATION),
+        headers=headers,
+    )
+    assert res.status_code == 202
+    job_id = res.get_json()["job_id"]
+    job_count = JobORM.query.count()
+
+    # The retry gets the original response, instead of ClusterExistsException
+    res = client.post(
+        f"/api/magic-castles",
+        json=deepcopy(VALID_CLUSTER_CONFIGURATION),
+        headers=headers,
+    )
+    assert res.status_code == 202
+    assert res.get_json() == {"job_id": job_id}
+    assert JobORM.query.count() == job_count
+    assert IdempotencyKeyORM.query.one().job_id == job_id
+
+    # The same key cannot be used for another request
+    res = client.post(
+        f"/api/magic-castles/a-123-45.magic-castle.cloud/apply", headers=headers
+    )
+    assert res.status_code == 422
+
+    # Without a key, the duplicate is rejected
+    res = client.post(f"/api/magic-castles", json=deepcopy(VALID_CLUSTER_CONFIGURATION))
+    assert res.status_code == 400
+
+
+def test_idempotency_key_released_on_error(client, fake_successful_subprocess_run):
+    from mchub.models.idempotency.idempotency_key import IdempotencyKeyORM
+
+    headers = {"Idempotency-Key": "apply-before-plan"}
+    res = client.post(f"/api/magic-castles/{EXISTING_HOSTNAME}/apply", headers=headers)
+    assert res.status_code == 400
+    assert IdempotencyKeyORM.query.count() == 0
+
+
+# POST /api/magic-castles/<hostname>/apply
+def test_apply_job(client, inline_applies, fake_successful_subprocess_run):
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.models.job.job import JobORM
+    from mchub.models.job.job_status_code import JobStatusCode
+
+    res = client.post(f"/api/magic-castles/created.magic-castle.cloud/apply")
+    assert res.status_code == 202
+    job = JobORM.query.get(res.get_json()["job_id"])
+    assert job.status == JobStatusCode.SUCCESS
+    assert job.started is not None
+    assert job.parallelism == 10
+    orm = MagicCastleORM.query.filter_by(hostname="created.magic-castle.cloud").first()
+    assert orm.status == ClusterStatusCode.PROVISIONING_RUNNING
+    # The successful apply raises the parallelism of the project
+    assert orm.project.parallelism == 11
+
+
+def test_apply_job_queued(client, mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"max_concurrent_applies": 0})
+    res = client.post(f"/api/magic-castles/created.magic-castle.cloud/apply")
+    assert res.status_code == 202
+    res = client.get(f"/api/magic-castles/created.magic-castle.cloud/status")
+    job = res.get_json()["job"]
+    assert job["status"] == "queued"
+    assert job["priority"] == "interactive"
+    assert job["queue"] == {"position": 1, "depth": 1}
+
+
+# POST /api/magic-castles/<hostname>/preview
+def test_preview(client, mocker):
+    import json
+
+    from os import listdir, path
+    from subprocess import CompletedProcess
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from ..test_helpers import MOCK_CLUSTERS_PATH
+
+    events = [
+        {
+            "type": "planned_change",
+            "change": {
+                "resource": {
+                    "addr": 'module.openstack.openstack_compute_instance_v2.instances["node2"]',
+                    "resource_type": "openstack_compute_instance_v2",
+                },
+                "action": "create",
+            },
+        },
+        {
+            "type": "change_summary",
+            "changes": {"add": 1, "change": 0, "remove": 0, "operation": "plan"},
+        },
+    ]
+
+    def fake_run(process_args, *args, **kwargs):
+        stdout = "\n".join(json.dumps(event) for event in events).encode()
+        return CompletedProcess(process_args, 0, stdout, b"")
+
+    run = mocker.patch(
+        "mchub.models.magic_castle.magic_castle.run", side_effect=fake_run
+    )
+    orm = MagicCastleORM.query.filter_by(hostname=EXISTING_HOSTNAME).first()
+    status, config = orm.status, orm.config
+
+    res = client.post(
+        f"/api/magic-castles/{EXISTING_HOSTNAME}/preview",
+        json=EXISTING_CLUSTER_CONFIGURATION,
+    )
+    assert res.status_code == 200
+    assert res.get_json() == {
+        "resources": [
+            {
+                "address": 'module.openstack.openstack_compute_instance_v2.instances["node2"]',
+                "type": "openstack_compute_instance_v2",
+                "change": {"actions": ["create"]},
+            }
+        ],
+        "change_summary": {"add": 1, "change": 0, "remove": 0, "operation": "plan"},
+        "cached": False,
+    }
+    plan_runs = len([call for call in run.call_args_list if "plan" in call.args[0]])
+    assert plan_runs == 1
+
+    res = client.post(
+        f"/api/magic-castles/{EXISTING_HOSTNAME}/preview",
+        json=EXISTING_CLUSTER_CONFIGURATION,
+    )
+    assert res.get_json()["cached"] is True
+    assert len([call for call in run.call_args_list if "plan" in call.args[0]]) == 1
+    assert orm.status == status
+    assert orm.config == config
+    # The throwaway workspaces are removed
+    assert listdir(path.join(MOCK_CLUSTERS_PATH, ".previews")) == []
+
+
+def test_preview_workspace_error(client, mocker):
+    from os import listdir, path
+    from mchub.models.magic_castle.magic_castle import MagicCastle
+    from ..test_helpers import MOCK_CLUSTERS_PATH
+
+    run = mocker.patch("mchub.models.magic_castle.magic_castle.run")
+    mocker.patch.object(
+        MagicCastle, "copy_workspace", side_effect=OSError("No space left on device")
+    )
+    # Without a cloud, the cluster is previewed in its own project
+    res = client.post(
+        f"/api/magic-castles/{EXISTING_HOSTNAME}/preview",
+        json={**EXISTING_CLUSTER_CONFIGURATION, "cloud": None},
+    )
+    assert res.status_code == 500
+    assert res.get_json() == {
+        "message": "Could not create the workspace of the preview."
+    }
+    run.assert_not_called()
+    assert listdir(path.join(MOCK_CLUSTERS_PATH, ".previews")) == []
+
+
+def test_create_cluster_without_cloud(client):
+    res = client.post("/api/magic-castles", json=NON_EXISTING_CLUSTER_CONFIGURATION)
+    assert res.status_code == 400
+    assert res.get_json() == {"message": "Invalid project id"}
+
+
+# POST /api/magic-castles/<hostname>/cancel
+def test_cancel_queued_apply(client, mocker):
+    from mchub.configuration import get_config
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+
+    mocker.patch.dict(get_config(), {"max_concurrent_applies": 0})
+    res = client.post(f"/api/magic-castles/created.magic-castle.cloud/apply")
+    job_id = res.get_json()["job_id"]
+
+    res = client.post(f"/api/magic-castles/created.magic-castle.cloud/cancel")
+    assert res.status_code == 200
+    assert res.get_json() == {"job_id": job_id, "status": "cancelled"}
+    res = client.get(f"/api/magic-castles/created.magic-castle.cloud/status")
+    assert res.get_json()["status"] == "created"
+    assert res.get_json()["job"]["status"] == "cancelled"
+    # The plan can still be applied
+    orm = MagicCastleORM.query.filter_by(hostname="created.magic-castle.cloud").first()
+    assert orm.plan is not None
+
+    res = client.post(f"/api/magic-castles/created.magic-castle.cloud/cancel")
+    assert res.status_code == 400
+
+
+# GET /api/metrics
+def test_get_metrics(client):
+    res = client.get(f"/api/metrics")
+    assert res.status_code == 200
+    pools = res.get_json()["workspace_pool"]
+    assert {pool["dns_module"] for pool in pools.values()} == {
+        None,
+        "cloudflare",
+        "gcloud",
+    }
+
+
+# PUT /api/projects/<id>/warm-pools/<name>, POST /api/magic-castles with a warm pool
+def test_warm_pool(client, inline_applies, mocker):
+    from copy import deepcopy
+    from getpass import getuser
+    from os import path
+    from unittest.mock import Mock
+    from mchub.database import db
+    from mchub.models.cloud.project import Project
+    from mchub.models.job.job import JobORM
+    from mchub.models.job.job_priority import JobPriority
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.models.user import UserORM
+
+    def fake_terraform(args, cwd=None, **kwargs):
+        if args[1] == "plan":
+            open(path.join(cwd, "terraform_plan"), "w").close()
+        return Mock()
+
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.run", side_effect=fake_terraform
+    )
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=False,
+    )
+    config = deepcopy(VALID_CLUSTER_CONFIGURATION)
+    res = client.put(
+        "/api/projects/1/warm-pools/workshop", json={"size": 1, "config": config}
+    )
+    assert res.status_code == 400
+
+    project = Project.query.get(1)
+    project.admin_id = (
+        UserORM.query.filter_by(scoped_id=f"{getuser()}@localhost").one().id
+    )
+    db.session.commit()
+    res = client.put(
+        "/api/projects/1/warm-pools/workshop", json={"size": 1, "config": config}
+    )
+    assert res.status_code == 200
+    assert res.get_json()["building"] == 1
+
+    # The cluster of the pool is planned and applied, and hidden from the list
+    (orm,) = MagicCastleORM.query.filter(MagicCastleORM.warm_pool_id.isnot(None))
+    assert orm.hostname.startswith("workshop-")
+    assert orm.status == ClusterStatusCode.PROVISIONING_RUNNING
+    apply = JobORM.query.filter_by(hostname=orm.hostname, type="apply").one()
+    assert apply.priority == JobPriority.WARM_POOL
+    hostnames = {
+        cluster["hostname"] for cluster in client.get("/api/magic-castles").get_json()
+    }
+    assert orm.hostname not in hostnames
+
+    # Nothing is provisioned yet
+    request = {"cloud": {"id": 1}, "warm_pool": "workshop", "cluster_name": "late"}
+    res = client.post("/api/magic-castles", json=request)
+    assert res.status_code == 202
+    assert res.get_json()["warm_pool"] == "miss"
+    assert res.get_json()["hostname"] == "late.magic-castle.cloud"
+
+    orm.status = ClusterStatusCode.PROVISIONING_SUCCESS
+    db.session.commit()
+    request = {
+        "cloud": {"id": 1},
+        "warm_pool": "workshop",
+        "expiration_date": "2029-01-01",
+    }
+    res = client.post("/api/magic-castles", json=request)
+    assert res.status_code == 201
+    assert res.get_json() == {"hostname": orm.hostname, "warm_pool": "hit"}
+    assert orm.warm_pool_id is None
+    assert orm.expiration_date == "2029-01-01"
+    hostnames = {
+        cluster["hostname"] for cluster in client.get("/api/magic-castles").get_json()
+    }
+    assert orm.hostname in hostnames
+
+    # The pool was refilled
+    assert (
+        MagicCastleORM.query.filter(MagicCastleORM.warm_pool_id.isnot(None)).count()
+        == 1
+    )
+    (metrics,) = client.get("/api/metrics").get_json()["warm_pools"]
+    assert metrics["hits"] == 1
+    assert metrics["misses"] == 1
+    assert metrics["refills"] == 2
+
+    res = client.delete("/api/projects/1/warm-pools/workshop")
+    assert res.status_code == 200
+    assert client.get("/api/projects/1/warm-pools").get_json() == []
+
+
+def test_warm_pool_refill_error(client, mocker):
+    """
+    The cluster handed over is not lost when the pool cannot be refilled.
+    """
+    from copy import deepcopy
+    from getpass import getuser
+    from unittest.mock import Mock
+    from mchub.database import db
+    from mchub.models.cloud.project import Project
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.models.magic_castle.plan_type import PlanType
+    from mchub.models.user import UserORM
+    from mchub.models.warm_pool.warm_pool import WarmPool
+
+    mocker.patch("mchub.models.magic_castle.magic_castle.run", return_value=Mock())
+    project = Project.query.get(1)
+    project.admin_id = (
+        UserORM.query.filter_by(scoped_id=f"{getuser()}@localhost").one().id
+    )
+    db.session.commit()
+    config = deepcopy(VALID_CLUSTER_CONFIGURATION)
+    res = client.put(
+        "/api/projects/1/warm-pools/workshop", json={"size": 1, "config": config}
+    )
+    assert res.status_code == 200
+    (orm,) = MagicCastleORM.query.filter(MagicCastleORM.warm_pool_id.isnot(None))
+    orm.status = ClusterStatusCode.PROVISIONING_SUCCESS
+    orm.plan_type = PlanType.NONE
+    db.session.commit()
+    hostname = orm.hostname
+
+    refill = mocker.patch.object(
+        WarmPool, "refill", side_effect=OSError("No space left on device")
+    )
+    res = client.post(
+        "/api/magic-castles", json={"cloud": {"id": 1}, "warm_pool": "workshop"}
+    )
+    assert res.status_code == 201
+    assert res.get_json() == {"hostname": hostname, "warm_pool": "hit"}
+    refill.assert_called_once()
+    orm = MagicCastleORM.query.filter_by(hostname=hostname).one()
+    assert orm.warm_pool_id is None
+
+
 # DELETE /api/magic-castles/<hostname>
 def test_delete_invalid_status(client):
     from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
@@ -8,6 +8,7 @@ from ..test_helpers import (
     app,
     generate_test_clusters,
     mock_clusters_path,
+    inline_job_queue,
 )  # noqa;
 from ..mocks.configuration.config_mock import (
     config_auth_saml_mock as config_mock,
@@ -228,3 +229,26 @@ def test_modify_invalid_status(client):
     )
     assert res.get_json() == {"message": "This cluster is busy."}
     assert res.status_code != 200
+
+
+# PATCH /api/projects/<id>
+def test_patch_project_parallelism_bounds(client):
+    res = client.patch(
+        "/api/projects/1",
+        json={"min_parallelism": 2, "max_parallelism": 8},
+        headers=ALICE_HEADERS,
+    )
+    assert res.status_code == 200
+    res = client.get("/api/projects/1", headers=ALICE_HEADERS)
+    assert res.get_json()["parallelism"] == {"current": 8, "min": 2, "max": 8}
+
+    res = client.patch(
+        "/api/projects/1", json={"min_parallelism": 10}, headers=ALICE_HEADERS
+    )
+    assert res.status_code != 200
+    res = client.patch(
+        "/api/projects/1", json={"max_parallelism": 1000}, headers=ALICE_HEADERS
+    )
+    assert res.status_code != 200
+    res = client.get("/api/projects/1", headers=ALICE_HEADERS)
+    assert res.get_json()["parallelism"] == {"current": 8, "min": 2, "max": 8}
@@ -59,6 +59,19 @@ def setup_module(module):
         db.create_all()
 
 
+def wait_for_plan(client, max_timeout_seconds=120):
+    start_time = time()
+    status = client.get(
+        f"/api/magic-castles/{HOSTNAME}/status", headers=JOHN_DOE_HEADERS
+    ).get_json()["status"]
+    while status == "plan_running" and time() - start_time <= max_timeout_seconds:
+        sleep(1)
+        status = client.get(
+            f"/api/magic-castles/{HOSTNAME}/status", headers=JOHN_DOE_HEADERS
+        ).get_json()["status"]
+    return status
+
+
 def teardown_module(module):
     global db_filename
     remove(db_filename)
@@ -132,15 +145,16 @@ def test_plan_creation(client):
         },
         headers=JOHN_DOE_HEADERS,
     )
-    assert res.get_json() == {}
-    assert res.status_code == 200
+    assert "job_id" in res.get_json()
+    assert res.status_code == 202
+    assert wait_for_plan(client) != "plan_running"
 
 
 @pytest.mark.build_live_cluster
 def test_apply_creation_plan(client):
     res = client.post(f"/api/magic-castles/{HOSTNAME}/apply", headers=JOHN_DOE_HEADERS)
-    assert res.get_json() == {}
-    assert res.status_code == 200
+    assert "job_id" in res.get_json()
+    assert res.status_code == 202
 
 
 @pytest.mark.build_live_cluster
@@ -234,15 +248,16 @@ def test_plan_modify(client):
         },
         headers=JOHN_DOE_HEADERS,
     )
-    assert res.get_json() == {}
-    assert res.status_code == 200
+    assert "job_id" in res.get_json()
+    assert res.status_code == 202
+    assert wait_for_plan(client) != "plan_running"
 
 
 @pytest.mark.build_live_cluster
 def test_apply_modification_plan(client):
     res = client.post(f"/api/magic-castles/{HOSTNAME}/apply", headers=JOHN_DOE_HEADERS)
-    assert res.get_json() == {}
-    assert res.status_code == 200
+    assert "job_id" in res.get_json()
+    assert res.status_code == 202
 
 
 @pytest.mark.build_live_cluster
@@ -292,15 +307,16 @@ def test_modify_success(client):
 @pytest.mark.build_live_cluster
 def test_plan_destroy(client):
     res = client.delete(f"/api/magic-castles/{HOSTNAME}", headers=JOHN_DOE_HEADERS)
-    assert res.get_json() == {}
-    assert res.status_code == 200
+    assert "job_id" in res.get_json()
+    assert res.status_code == 202
+    assert wait_for_plan(client) != "plan_running"
 
 
 @pytest.mark.build_live_cluster
 def test_apply_destruction_plan(client):
     res = client.post(f"/api/magic-castles/{HOSTNAME}/apply", headers=JOHN_DOE_HEADERS)
-    assert res.get_json() == {}
-    assert res.status_code == 200
+    assert "job_id" in res.get_json()
+    assert res.status_code == 202
 
 
 @pytest.mark.build_live_cluster
@@ -18,6 +18,27 @@ BASE_CONFIGURATION = {
     "token": "abcdefghijklmnopqrstuv123q123561",
     "admins": ["the-admin@computecanada.ca"],
     "cors_allowed_origins": ["https://hc-hub.example.com"],
+    "plan_workers": 4,
+    "max_concurrent_applies": 4,
+    "max_concurrent_applies_per_project": 2,
+    "external_runners": False,
+    "runner_lease_duration": 60,
+    "terraform_cache": False,
+    "workspace_pool_size": 0,
+    "targeted_plans": True,
+    "drift_detection_interval": 86400,
+    "max_concurrent_drift_checks_per_project": 1,
+    "default_parallelism": 10,
+    "max_parallelism": 30,
+    "cancel_timeout": 120,
+    "terraform_memory_limit": 0,
+    "terraform_cpu_limit": 0,
+    "terraform_cgroup": "",
+    "terraform_min_free_memory": 0,
+    "terraform_timeout": 0,
+    "plan_debounce": 0,
+    "keep_full_plan": False,
+    "idempotency_key_ttl": 86400,
     "domains": {
         "magic-castle.cloud": {"dns_provider": "cf1"},
         "mc.ca": {"dns_provider": "gcloud1"},
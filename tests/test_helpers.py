@@ -208,3 +208,37 @@ def fake_successful_subprocess_run(mocker):
     mock = Mock()
     mock.stdout = "{}"
     mocker.patch("mchub.models.magic_castle.magic_castle.run", return_value=mock)
+
+
+@pytest.fixture(autouse=True)
+def inline_job_queue(mocker):
+    """
+    Runs the jobs submitted to the job queue synchronously, in the caller's application
+    context, as the in-memory test database is not shared between threads.
+    """
+    from mchub.models.job.job_queue import JobQueue
+    from mchub.models.warm_pool.warm_pool import WarmPool
+
+    mocker.patch.object(
+        JobQueue, "submit", side_effect=lambda job: JobQueue.execute(job.id)
+    )
+    mocker.patch.object(
+        WarmPool,
+        "refill_async",
+        autospec=True,
+        side_effect=lambda warm_pool: WarmPool.refill_safely(warm_pool.id),
+    )
+
+
+@pytest.fixture
+def inline_applies(mocker):
+    """
+    Runs the applies started by the apply scheduler synchronously with `run_apply`,
+    rather than through the TerraformSupervisor.
+    """
+    from mchub.models.job.job_queue import JobQueue
+    from mchub.models.job.apply_scheduler import ApplyScheduler
+
+    mocker.patch.object(
+        ApplyScheduler, "start", side_effect=lambda app, job: JobQueue.perform(job)
+    )
@@ -0,0 +1,22 @@
+import pytest
+
+from sqlalchemy import inspect, text
+
+from ...test_helpers import app, generate_test_clusters, mock_clusters_path  # noqa;
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+def test_add_missing_columns(app):
+    from mchub.database import db
+    from mchub.database.schema_manager import SchemaManager
+
+    db.session.execute(text("ALTER TABLE magiccastle DROP COLUMN plan_fingerprint"))
+    db.session.commit()
+    assert SchemaManager.add_missing_columns() == ["magiccastle.plan_fingerprint"]
+    columns = [
+        column["name"] for column in inspect(db.engine).get_columns("magiccastle")
+    ]
+    assert "plan_fingerprint" in columns
+    assert SchemaManager.add_missing_columns() == []
@@ -0,0 +1,34 @@
+from os import listdir
+
+from mchub.models.events.cluster_events import ClusterEvents
+
+from ...test_helpers import mock_clusters_path  # noqa;
+
+
+def test_notify():
+    cluster = ClusterEvents.subscribe("test1.calculquebec.cloud")
+    fleet = ClusterEvents.subscribe()
+    try:
+        ClusterEvents.notify("test1.calculquebec.cloud")
+        assert "test1.calculquebec.cloud" in listdir(ClusterEvents.get_path())
+        assert cluster.wait(5) == {"test1.calculquebec.cloud"}
+        assert fleet.wait(5) == {"test1.calculquebec.cloud"}
+
+        ClusterEvents.notify("test1.calculquebec.cloud", deleted=True)
+        assert "test1.calculquebec.cloud" not in listdir(ClusterEvents.get_path())
+    finally:
+        ClusterEvents.unsubscribe(cluster)
+        ClusterEvents.unsubscribe(fleet)
+
+
+def test_apply_progress_not_sent_to_fleet():
+    cluster = ClusterEvents.subscribe("test1.calculquebec.cloud")
+    fleet = ClusterEvents.subscribe()
+    try:
+        ClusterEvents.publish("test1.calculquebec.cloud", status=False)
+        assert cluster.wait(5) == {"test1.calculquebec.cloud"}
+        assert fleet.wait(0) == set()
+    finally:
+        ClusterEvents.unsubscribe(cluster)
+        ClusterEvents.unsubscribe(fleet)
+    assert ClusterEvents._subscriptions == {}
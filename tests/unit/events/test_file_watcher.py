@@ -0,0 +1,45 @@
+import pytest
+
+from os import mkdir, path
+from queue import Queue
+
+from mchub.models.events import file_watcher
+from mchub.models.events.file_watcher import FileWatcher
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "polling"])
+def watcher(request, mocker):
+    mocker.patch.object(file_watcher, "POLL_INTERVAL", 0.05)
+    if not request.param:
+        mocker.patch.object(file_watcher, "load_libc", return_value=None)
+    changes = Queue()
+    watcher = FileWatcher(lambda directory, name: changes.put((directory, name)))
+    if request.param and watcher.fd is None:
+        pytest.skip("inotify is not available")
+    return watcher, changes
+
+
+def test_watch(watcher, tmp_path):
+    watcher, changes = watcher
+    directory = str(tmp_path)
+    watcher.watch(directory)
+    # Let the polling take its first snapshot
+    watcher.poll()
+    with open(path.join(directory, "terraform_apply.log"), "w") as file:
+        file.write("module.openstack.random_string.munge_key: Creating...\n")
+    assert changes.get(timeout=5) == (directory, "terraform_apply.log")
+
+    watcher.unwatch(directory)
+    assert watcher.directories == {}
+    assert watcher.watches == {}
+
+
+def test_watch_missing_directory(watcher, tmp_path):
+    watcher, changes = watcher
+    directory = str(tmp_path / "cluster")
+    watcher.watch(directory)
+    mkdir(directory)
+    watcher.poll()
+    with open(path.join(directory, "terraform_apply.log"), "w") as file:
+        file.write("module.openstack.random_string.munge_key: Creating...\n")
+    assert changes.get(timeout=5) == (directory, "terraform_apply.log")
@@ -0,0 +1,162 @@
+import pytest
+
+from datetime import datetime, timedelta
+from os import environ, path, pathsep
+from shutil import copy
+from types import SimpleNamespace
+
+from mchub.database import db
+from mchub.models.job.apply_scheduler import ApplyScheduler
+from mchub.models.job.job import Job, JobORM
+from mchub.models.job.job_priority import JobPriority
+from mchub.models.job.job_status_code import JobStatusCode
+from mchub.models.job.job_type import JobType
+
+from ...test_helpers import (
+    MOCK_CLUSTERS_PATH,
+    app,
+    generate_test_clusters,
+    inline_job_queue,
+    mock_clusters_path,
+)  # noqa;
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+# Stands for terraform apply, which completes once the test creates $STUB_RELEASE
+# and records the cluster it applied in $STUB_APPLIED
+STUB_TERRAFORM = """#!/bin/sh
+while [ ! -e "$STUB_RELEASE" ]; do sleep 0.01; done
+basename "$PWD" >> "$STUB_APPLIED"
+echo '{"@level": "info", "type": "apply_complete", "hook": {}}'
+"""
+
+
+def make_jobs(*specs):
+    """
+    Creates fake apply jobs from (project_id, priority) tuples, in arrival order.
+    """
+    start = datetime(2022, 1, 1)
+    return [
+        SimpleNamespace(
+            id=index + 1,
+            project_id=project_id,
+            priority=priority,
+            queued=start + timedelta(seconds=index),
+        )
+        for index, (project_id, priority) in enumerate(specs)
+    ]
+
+
+def ids(jobs):
+    return [job.id for job in jobs]
+
+
+def test_order_priority_lanes():
+    queued = make_jobs(
+        (1, JobPriority.CULLING),
+        (1, JobPriority.DESTROY),
+        (1, JobPriority.INTERACTIVE),
+    )
+    assert ids(ApplyScheduler.order(queued, [])) == [3, 2, 1]
+
+
+def test_order_fifo_fairness_between_projects():
+    # A workshop queues three builds in project 1 before project 2 queues one build.
+    queued = make_jobs(
+        (1, JobPriority.INTERACTIVE),
+        (1, JobPriority.INTERACTIVE),
+        (1, JobPriority.INTERACTIVE),
+        (2, JobPriority.INTERACTIVE),
+    )
+    assert ids(ApplyScheduler.order(queued, [])) == [1, 4, 2, 3]
+
+
+def test_order_running_jobs_count_as_turns():
+    queued = make_jobs(
+        (1, JobPriority.INTERACTIVE),
+        (2, JobPriority.INTERACTIVE),
+    )
+    running = [SimpleNamespace(id=10, project_id=1)]
+    assert ids(ApplyScheduler.order(queued, running)) == [2, 1]
+
+
+def test_select_global_limit():
+    queued = make_jobs(
+        *[(project_id, JobPriority.INTERACTIVE) for project_id in range(5)]
+    )
+    assert ids(ApplyScheduler.select(queued, [], 3, 2)) == [1, 2, 3]
+
+
+def test_select_project_limit():
+    queued = make_jobs(
+        (1, JobPriority.INTERACTIVE),
+        (1, JobPriority.INTERACTIVE),
+        (1, JobPriority.INTERACTIVE),
+        (2, JobPriority.CULLING),
+    )
+    running = [SimpleNamespace(id=10, project_id=1)]
+    assert ids(ApplyScheduler.select(queued, running, 10, 2)) == [1, 4]
+
+
+def test_select_nothing_when_full():
+    queued = make_jobs((1, JobPriority.INTERACTIVE))
+    running = [SimpleNamespace(id=10, project_id=2)]
+    assert ApplyScheduler.select(queued, running, 1, 2) == []
+
+
+def test_completed_apply_starts_next_apply(app, mocker, monkeypatch, tmp_path):
+    """
+    Runs the applies through the TerraformSupervisor, with a stub of terraform: the
+    completion of an apply starts the next queued apply.
+    """
+    from mchub.configuration import get_config
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+
+    terraform = tmp_path / "terraform"
+    terraform.write_text(STUB_TERRAFORM)
+    terraform.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{pathsep}{environ['PATH']}")
+    monkeypatch.setenv("STUB_RELEASE", str(tmp_path / "release"))
+    monkeypatch.setenv("STUB_APPLIED", str(tmp_path / "applied"))
+    mocker.patch.dict(get_config(), {"max_concurrent_applies": 1})
+
+    # The destruction is queued first, the build runs first in its higher priority lane
+    copy(
+        path.join(MOCK_CLUSTERS_PATH, "created.magic-castle.cloud", "terraform_plan"),
+        path.join(MOCK_CLUSTERS_PATH, "valid1.magic-castle.cloud", "terraform_plan"),
+    )
+    destroy = Job.create(
+        "valid1.magic-castle.cloud",
+        JobType.APPLY,
+        project_id=1,
+        priority=JobPriority.DESTROY,
+    )
+    build = Job.create("created.magic-castle.cloud", JobType.APPLY, project_id=1)
+    job_ids = [build.id, destroy.id]
+    ApplyScheduler.dispatch()
+    assert [JobORM.query.get(id).status for id in job_ids] == [
+        JobStatusCode.RUNNING,
+        JobStatusCode.QUEUED,
+    ]
+
+    (tmp_path / "release").touch()
+    ApplyScheduler.wait()
+    db.session.expire_all()
+    assert [JobORM.query.get(id).status for id in job_ids] == [
+        JobStatusCode.SUCCESS,
+        JobStatusCode.SUCCESS,
+    ]
+    assert (tmp_path / "applied").read_text().split() == [
+        "created.magic-castle.cloud",
+        "valid1.magic-castle.cloud",
+    ]
+    orm = MagicCastleORM.query.filter_by(hostname="created.magic-castle.cloud").first()
+    assert orm.status == ClusterStatusCode.PROVISIONING_RUNNING
+    assert orm.plan is None
+    # The destroyed cluster is deleted
+    assert (
+        MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").count()
+        == 0
+    )
@@ -0,0 +1,100 @@
+import pytest
+
+from mchub.models.job.drift_scheduler import DriftScheduler
+from mchub.models.job.job import Job, JobORM, utcnow
+from mchub.models.job.job_runner import JobRunner
+from mchub.models.job.job_status_code import JobStatusCode
+from mchub.models.job.job_type import JobType
+
+from ...test_helpers import (
+    app,
+    generate_test_clusters,
+    inline_job_queue,
+    mock_clusters_path,
+)  # noqa;
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+def test_schedule(app):
+    """
+    Mock context :
+
+    noowner.magic-castle.cloud is provisioned and has no plan. valid1.magic-castle.cloud
+    is provisioned but has a destruction plan waiting to be applied.
+    """
+    jobs = DriftScheduler.schedule()
+    assert [job.hostname for job in jobs] == ["noowner.magic-castle.cloud"]
+    assert jobs[0].type == JobType.DRIFT
+    # The check is already queued
+    assert DriftScheduler.schedule() == []
+
+
+def test_schedule_recently_checked(app):
+    from mchub.database import db
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+
+    orm = MagicCastleORM.query.filter_by(hostname="noowner.magic-castle.cloud").first()
+    orm.drift_checked = utcnow()
+    db.session.commit()
+    assert DriftScheduler.schedule() == []
+
+
+def test_schedule_disabled(app, mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"drift_detection_interval": 0})
+    assert DriftScheduler.schedule() == []
+
+
+def test_schedule_project_limit(app):
+    from mchub.database import db
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+
+    # missingnodes.mc.ca shares the project of noowner.magic-castle.cloud
+    orm = MagicCastleORM.query.filter_by(hostname="missingnodes.mc.ca").first()
+    orm.status = ClusterStatusCode.PROVISIONING_SUCCESS
+    db.session.commit()
+    assert len(DriftScheduler.schedule()) == 1
+
+
+def test_claim_waits_for_project_plans(app):
+    (drift,) = DriftScheduler.schedule()
+    plan = Job.create(
+        "missingnodes.mc.ca", JobType.PLAN, project_id=drift.orm.project_id
+    )
+    runner = JobRunner(name="runner-1", lease_duration=30, job_types=[JobType.DRIFT])
+    assert runner.claim() is None
+
+    plan.succeed()
+    assert runner.claim().id == drift.id
+    assert JobORM.query.get(drift.id).status == JobStatusCode.RUNNING
+
+
+def test_poll(app, mocker):
+    """
+    Without external runners, the web server queues and runs the drift checks itself.
+    """
+    from mchub.models.magic_castle.magic_castle import MagicCastle
+
+    start = mocker.patch.object(DriftScheduler, "start")
+    run_drift_check = mocker.patch.object(MagicCastle, "run_drift_check")
+    DriftScheduler.poll(app)
+
+    run_drift_check.assert_called_once()
+    (orm,) = JobORM.query.filter_by(type=JobType.DRIFT).all()
+    assert orm.hostname == "noowner.magic-castle.cloud"
+    assert orm.status == JobStatusCode.SUCCESS
+    # Polled again later
+    start.assert_called_once_with(app)
+
+
+def test_start_with_external_runners(app, mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"external_runners": True})
+    timer = mocker.patch("mchub.models.job.drift_scheduler.Timer")
+    DriftScheduler.start(app)
+    timer.assert_not_called()
@@ -0,0 +1,289 @@
+import pytest
+
+from datetime import timedelta
+
+from mchub.database import db
+from mchub.models.job.job import Job, JobORM, utcnow
+from mchub.models.job.job_runner import JobRunner
+from mchub.models.job.job_status_code import JobStatusCode
+from mchub.models.job.job_type import JobType
+
+from ...test_helpers import (
+    app,
+    generate_test_clusters,
+    inline_applies,
+    inline_job_queue,
+    mock_clusters_path,
+)  # noqa;
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+def test_claim_plan(app):
+    job = Job.create("valid1.magic-castle.cloud", JobType.PLAN)
+    runner = JobRunner(name="runner-1", lease_duration=30)
+    claimed = runner.claim()
+    assert claimed.id == job.id
+    orm = JobORM.query.get(job.id)
+    assert orm.status == JobStatusCode.RUNNING
+    assert orm.runner == "runner-1"
+    assert orm.lease_expires > utcnow()
+    assert runner.claim() is None
+
+
+def test_claim_plans_before_applies(app):
+    apply = Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    plan = Job.create("created.magic-castle.cloud", JobType.PLAN)
+    runner = JobRunner(name="runner-1", lease_duration=30)
+    assert runner.claim().id == plan.id
+    assert runner.claim().id == apply.id
+
+
+def test_claim_apply_limits(app, mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"max_concurrent_applies": 1})
+    Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    Job.create("created.magic-castle.cloud", JobType.APPLY, project_id=2)
+    first = JobRunner(name="runner-1", lease_duration=30)
+    second = JobRunner(name="runner-2", lease_duration=30)
+    assert first.claim() is not None
+    assert second.claim() is None
+
+
+def test_heartbeat(app):
+    Job.create("valid1.magic-castle.cloud", JobType.PLAN)
+    runner = JobRunner(name="runner-1", lease_duration=30)
+    job = runner.claim()
+    runner.active.add(job.id)
+    job.orm.lease_expires = utcnow()
+    db.session.commit()
+    runner.heartbeat()
+    assert JobORM.query.get(job.id).lease_expires > utcnow() + timedelta(seconds=20)
+
+
+def test_reclaim_expired_lease(app):
+    Job.create("valid1.magic-castle.cloud", JobType.PLAN)
+    dead = JobRunner(name="runner-1", lease_duration=30)
+    job = dead.claim()
+    assert JobRunner.reclaim() == 0
+
+    job.orm.lease_expires = utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert JobRunner.reclaim() == 1
+    orm = JobORM.query.get(job.id)
+    assert orm.status == JobStatusCode.QUEUED
+    assert orm.runner is None
+    assert orm.started is None
+
+    alive = JobRunner(name="runner-2", lease_duration=30)
+    assert alive.claim().id == job.id
+
+
+def test_expired_apply_lease(app, mocker):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud is being built by a runner that died before terraform
+    apply started, created.magic-castle.cloud by a runner of another host.
+    """
+    from os import path
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastleORM
+    from mchub.models.magic_castle.plan_type import PlanType
+    from mchub.models.terraform.apply_journal import ApplyJournal
+    from ...test_helpers import MOCK_CLUSTERS_PATH
+
+    for hostname in ["valid1.magic-castle.cloud", "created.magic-castle.cloud"]:
+        orm = MagicCastleORM.query.filter_by(hostname=hostname).first()
+        orm.status = ClusterStatusCode.BUILD_RUNNING
+        orm.plan_type = PlanType.BUILD
+    db.session.commit()
+    local = Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    remote = Job.create("created.magic-castle.cloud", JobType.APPLY, project_id=1)
+    dead = JobRunner(name="runner-1", lease_duration=30)
+    dead.claim()
+    dead.claim()
+    for job in (local, remote):
+        job.orm.lease_expires = utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    ApplyJournal.record(
+        path.join(MOCK_CLUSTERS_PATH, "created.magic-castle.cloud"), 1234
+    )
+    journal = ApplyJournal.read(
+        path.join(MOCK_CLUSTERS_PATH, "created.magic-castle.cloud")
+    )
+    mocker.patch.object(
+        ApplyJournal,
+        "read",
+        side_effect=lambda workspace: (
+            journal if workspace.endswith("created.magic-castle.cloud") else None
+        ),
+    )
+    journal.host = "another-host"
+
+    # The applies are never put back in the queue
+    assert JobRunner.reclaim() == 0
+    alive = JobRunner(name="runner-2", lease_duration=30)
+    assert alive.recover_applies(app) == 1
+
+    orm = JobORM.query.get(local.id)
+    assert orm.status == JobStatusCode.ERROR
+    assert orm.runner == "runner-2"
+    cluster = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").one()
+    assert cluster.status == ClusterStatusCode.PLAN_RUNNING
+    (plan,) = JobORM.query.filter_by(
+        hostname="valid1.magic-castle.cloud", type=JobType.PLAN
+    )
+    assert plan.status == JobStatusCode.QUEUED
+    # Left to the runners of the host running terraform
+    orm = JobORM.query.get(remote.id)
+    assert orm.status == JobStatusCode.RUNNING
+    assert orm.runner == "runner-1"
+
+
+def test_clean_status_keeps_leased_jobs(app, mocker):
+    from mchub.database.cleanup_manager import CleanupManager
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+    recover_apply = mocker.patch.object(MagicCastle, "recover_apply", autospec=True)
+
+    for hostname in ["valid1.magic-castle.cloud", "created.magic-castle.cloud"]:
+        MagicCastleORM.query.filter_by(hostname=hostname).first().status = (
+            ClusterStatusCode.BUILD_RUNNING
+        )
+    leased = Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    orphan = Job.create("created.magic-castle.cloud", JobType.APPLY, project_id=1)
+    JobRunner(name="runner-1", lease_duration=30).claim()
+    orphan.start()
+
+    CleanupManager.clean_status()
+    assert JobORM.query.get(leased.id).status == JobStatusCode.RUNNING
+    assert JobORM.query.get(orphan.id).status == JobStatusCode.ERROR
+    assert (
+        MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud")
+        .first()
+        .status
+        == ClusterStatusCode.BUILD_RUNNING
+    )
+    # The apply of the orphan job is recovered from its partial state
+    recovered = [call.args[0].hostname for call in recover_apply.call_args_list]
+    assert "created.magic-castle.cloud" in recovered
+    assert "valid1.magic-castle.cloud" not in recovered
+
+
+def test_clean_status_reattaches_live_applies(app, mocker):
+    import subprocess
+    import sys
+
+    from mchub.database.cleanup_manager import CleanupManager
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.terraform.apply_journal import ApplyJournal
+
+    popen = mocker.patch("mchub.database.cleanup_manager.Popen")
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    orm.status = ClusterStatusCode.BUILD_RUNNING
+    job = Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    job.start()
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        ApplyJournal.record(MagicCastle(orm).path, process.pid, job_id=job.id)
+        assert CleanupManager.clean_status() == [job.id]
+    finally:
+        process.kill()
+        process.wait()
+    assert JobORM.query.get(job.id).status == JobStatusCode.RUNNING
+    assert orm.status == ClusterStatusCode.BUILD_RUNNING
+    assert popen.call_args.args[0][-2:] == ["mchub.reattach", str(job.id)]
+
+
+def test_claim_waits_for_debounce(app):
+    job = Job.create(
+        "valid1.magic-castle.cloud",
+        JobType.PLAN,
+        project_id=1,
+        not_before=utcnow() + timedelta(seconds=30),
+    )
+    runner = JobRunner(name="runner-1", lease_duration=30)
+    assert runner.claim() is None
+
+    assert job.defer(utcnow() - timedelta(seconds=1))
+    assert runner.claim().id == job.id
+
+
+def test_clean_status_leaves_recovery_plan_queued(app, mocker):
+    from mchub.database.cleanup_manager import CleanupManager
+    from mchub.models.job.job_queue import JobQueue
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.plan_type import PlanType
+
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    orm.status = ClusterStatusCode.BUILD_RUNNING
+    orm.plan_type = PlanType.BUILD
+    apply = Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    apply.start()
+
+    CleanupManager.clean_status()
+    assert JobORM.query.get(apply.id).status == JobStatusCode.ERROR
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    assert orm.status == ClusterStatusCode.PLAN_RUNNING
+    assert orm.tf_state is not None
+    # The plan is not run by the process of schema_update, which exits right away
+    JobQueue.submit.assert_not_called()
+    plan = JobORM.query.filter_by(
+        hostname="valid1.magic-castle.cloud", type=JobType.PLAN
+    ).one()
+    assert plan.status == JobStatusCode.QUEUED
+
+    # The web server resumes the queued plan when it starts
+    run_plan = mocker.patch.object(MagicCastle, "run_plan", autospec=True)
+    mocker.patch.object(
+        JobQueue,
+        "schedule",
+        side_effect=lambda app, job_id, delay: JobQueue.execute(job_id),
+    )
+    JobQueue.resume(app)
+    assert JobORM.query.get(plan.id).status == JobStatusCode.SUCCESS
+    assert run_plan.call_count == 1
+
+    # Another process of the web server resuming the same plan does not run it again
+    JobQueue.execute(plan.id)
+    assert run_plan.call_count == 1
+
+
+def test_reattach_starts_queued_applies(app, inline_applies, mocker):
+    from mchub.configuration import get_config
+    from mchub.models.job.apply_scheduler import ApplyScheduler
+    from mchub.models.magic_castle.magic_castle import MagicCastle
+    from mchub.reattach import reattach
+
+    mocker.patch.dict(get_config(), {"max_concurrent_applies": 1})
+    applied = []
+    mocker.patch.object(
+        MagicCastle,
+        "run_apply",
+        autospec=True,
+        side_effect=lambda magic_castle, *args: applied.append(magic_castle.hostname),
+    )
+    reattached = Job.create("valid1.magic-castle.cloud", JobType.APPLY, project_id=1)
+    reattached.start()
+    queued = Job.create("created.magic-castle.cloud", JobType.APPLY, project_id=1)
+
+    # The reattached apply counts as running toward the limit
+    ApplyScheduler.dispatch()
+    assert JobORM.query.get(queued.id).status == JobStatusCode.QUEUED
+
+    job_ids = [reattached.id, queued.id]
+    reattach(app, reattached.id)
+    assert [JobORM.query.get(id).status for id in job_ids] == [
+        JobStatusCode.SUCCESS,
+        JobStatusCode.SUCCESS,
+    ]
+    assert applied == [
+        "valid1.magic-castle.cloud",
+        "created.magic-castle.cloud",
+    ]
@@ -1,3 +1,4 @@
+import json
 import pytest
 
 from copy import deepcopy
@@ -8,6 +9,7 @@ from ...test_helpers import (
     app,
     generate_test_clusters,
     fake_successful_subprocess_run,
+    inline_job_queue,
     mock_clusters_path,
 )  # noqa;
 from ...mocks.configuration.config_mock import (
@@ -19,9 +21,15 @@ from ...data import CLUSTERS_CONFIG, VALID_CLUSTER_CONFIGURATION
 @pytest.mark.usefixtures("fake_successful_subprocess_run")
 def test_create_magic_castle_plan_valid(app):
     from mchub.models.magic_castle.magic_castle import MagicCastle
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.job.job_status_code import JobStatusCode
 
     cluster = MagicCastle()
-    cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    job = cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    assert job.status == JobStatusCode.SUCCESS
+    assert job.state["started"] is not None
+    assert job.state["finished"] is not None
+    assert cluster.status == ClusterStatusCode.CREATED
 
 
 @pytest.mark.usefixtures("fake_successful_subprocess_run")
@@ -39,6 +47,22 @@ def test_create_magic_castle_twice(app):
         cluster2.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
 
 
+def test_create_magic_castle_plan_queued(app, mocker):
+    from mchub.models.magic_castle.magic_castle import MagicCastle
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.job.job_queue import JobQueue
+    from mchub.models.job.job_status_code import JobStatusCode
+
+    submit = mocker.patch.object(JobQueue, "submit")
+    cluster = MagicCastle()
+    job = cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    submit.assert_called_once_with(job)
+    assert job.status == JobStatusCode.QUEUED
+    assert job.state["queued"] is not None
+    assert job.state["started"] is None
+    assert cluster.status == ClusterStatusCode.PLAN_RUNNING
+
+
 def test_apply_before_planning(app):
     from mchub.models.magic_castle.magic_castle import MagicCastle
     from mchub.exceptions.invalid_usage_exception import (
@@ -52,7 +76,8 @@ def test_apply_before_planning(app):
 
 def test_create_magic_castle_init_fail(app, monkeypatch):
     from mchub.models.magic_castle.magic_castle import MagicCastle
-    from mchub.exceptions.server_exception import PlanException
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.job.job_status_code import JobStatusCode
 
     def fake_run(process_args, *args, **kwargs):
         if process_args == ["terraform", "init", "-no-color", "-input=false"]:
@@ -60,13 +85,16 @@ def test_create_magic_castle_init_fail(app, monkeypatch):
 
     monkeypatch.setattr("mchub.models.magic_castle.magic_castle.run", fake_run)
     cluster = MagicCastle()
-    with pytest.raises(PlanException, match="Could not initialize Terraform modules."):
-        cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    job = cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    assert job.status == JobStatusCode.ERROR
+    assert job.state["message"] == "Could not initialize Terraform modules."
+    assert cluster.status == ClusterStatusCode.PLAN_ERROR
 
 
 def test_create_magic_castle_plan_fail(app, monkeypatch):
     from mchub.models.magic_castle.magic_castle import MagicCastle
-    from mchub.exceptions.server_exception import PlanException
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.job.job_status_code import JobStatusCode
 
     def fake_run(process_args, *args, **kwargs):
         if process_args[:2] == [
@@ -77,31 +105,50 @@ def test_create_magic_castle_plan_fail(app, monkeypatch):
 
     monkeypatch.setattr("mchub.models.magic_castle.magic_castle.run", fake_run)
     cluster = MagicCastle()
-    with pytest.raises(
-        PlanException, match="An error occurred while planning changes."
-    ):
-        cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    job = cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    assert job.status == JobStatusCode.ERROR
+    assert job.state["message"] == "An error occurred while planning changes."
+    assert cluster.status == ClusterStatusCode.PLAN_ERROR
 
 
-def test_create_magic_castle_plan_export_fail(app, monkeypatch):
+def test_create_magic_castle_plan_json(app, monkeypatch):
     from mchub.models.magic_castle.magic_castle import MagicCastle
-    from mchub.exceptions.server_exception import PlanException
+    from mchub.models.job.job_status_code import JobStatusCode
 
     def fake_run(process_args, *args, **kwargs):
-        if process_args[:4] == [
-            "terraform",
-            "show",
-            "-no-color",
-            "-json",
-        ]:
-            raise CalledProcessError(1, "terraform show")
+        if process_args[:2] == ["terraform", "plan"]:
+            assert "-json" in process_args
+            kwargs["stdout"].write(
+                json.dumps({"type": "version", "terraform": "1.1.9"})
+                + "\n"
+                + json.dumps(
+                    {
+                        "type": "planned_change",
+                        "change": {
+                            "resource": {
+                                "addr": "module.openstack.random_string.munge_key",
+                                "resource_type": "random_string",
+                            },
+                            "action": "create",
+                        },
+                    }
+                )
+                + "\n"
+            )
+        elif process_args[:2] == ["terraform", "show"]:
+            raise AssertionError("terraform show should not be called")
 
     monkeypatch.setattr("mchub.models.magic_castle.magic_castle.run", fake_run)
     cluster = MagicCastle()
-    with pytest.raises(
-        PlanException, match="An error occurred while exporting planned changes."
-    ):
-        cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    job = cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    assert job.status == JobStatusCode.SUCCESS
+    assert cluster.plan["resource_changes"] == [
+        {
+            "address": "module.openstack.random_string.munge_key",
+            "type": "random_string",
+            "change": {"actions": ["create"]},
+        }
+    ]
 
 
 def test_get_status_valid(app):
@@ -279,3 +326,535 @@ def test_allocated_resources_not_found(app):
         "pre_allocated_volume_count": 0,
         "pre_allocated_volume_size": 0,
     }
+
+
+def test_create_magic_castle_full_plan(app, mocker):
+    import gzip
+
+    from subprocess import CompletedProcess
+    from os import path
+
+    from mchub.configuration import get_config
+    from mchub.database import db
+    from mchub.models.magic_castle.magic_castle import (
+        MagicCastle,
+        MagicCastleORM,
+        TERRAFORM_FULL_PLAN_FILENAME,
+    )
+
+    full_plan = json.dumps({"format_version": "1.0", "resource_changes": []})
+
+    def fake_run(process_args, *args, **kwargs):
+        if process_args[:2] == ["terraform", "plan"]:
+            kwargs["stdout"].write(
+                json.dumps(
+                    {
+                        "type": "change_summary",
+                        "changes": {
+                            "add": 0,
+                            "change": 0,
+                            "remove": 0,
+                            "operation": "plan",
+                        },
+                    }
+                )
+                + "\n"
+            )
+        elif process_args[:2] == ["terraform", "show"]:
+            assert kwargs["capture_output"]
+            return CompletedProcess(process_args, 0, full_plan.encode(), b"")
+
+    mocker.patch("mchub.models.magic_castle.magic_castle.run", side_effect=fake_run)
+    mocker.patch.dict(get_config(), {"keep_full_plan": True})
+    cluster = MagicCastle()
+    cluster.plan_creation(deepcopy(VALID_CLUSTER_CONFIGURATION))
+    with gzip.open(path.join(cluster.path, TERRAFORM_FULL_PLAN_FILENAME), "rt") as file:
+        assert file.read() == full_plan
+
+    # The plan is only loaded when requested
+    db.session.expire_all()
+    orm = MagicCastleORM.query.filter_by(hostname=cluster.hostname).first()
+    assert "plan" not in orm.__dict__
+    assert MagicCastle(orm).plan == {
+        "resource_changes": [],
+        "change_summary": {"add": 0, "change": 0, "remove": 0, "operation": "plan"},
+    }
+
+    cluster.remove_existing_plan()
+    assert not path.exists(path.join(cluster.path, TERRAFORM_FULL_PLAN_FILENAME))
+
+
+def test_reuse_plan(app, mocker):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud has a terraform state. Planning its destruction, then a build
+    with the same configuration, then its destruction again reuses the first plan.
+    """
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+
+    def fake_run(process_args, *args, **kwargs):
+        for arg in process_args:
+            if arg.startswith("-out="):
+                with open(arg[len("-out=") :], "w") as file:
+                    file.write("plan")
+
+    run = mocker.patch(
+        "mchub.models.magic_castle.magic_castle.run", side_effect=fake_run
+    )
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=True,
+    )
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+    assert magic_castle.plan_destruction() is not None
+    destroy_fingerprint = orm.plan_fingerprint
+    assert destroy_fingerprint is not None
+
+    config = {
+        **deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"]),
+        "cloud": {"id": 1},
+    }
+    assert magic_castle.plan_modification(config) is not None
+    assert orm.plan_fingerprint not in (None, destroy_fingerprint)
+    plan_runs = run.call_count
+
+    assert magic_castle.plan_destruction() is None
+    assert run.call_count == plan_runs
+    assert orm.plan_fingerprint == destroy_fingerprint
+    assert magic_castle.plan is not None
+    assert magic_castle.status == ClusterStatusCode.PROVISIONING_SUCCESS
+
+
+@pytest.mark.parametrize("targeted_plan_fails", [False, True])
+def test_plan_modification_targeted(app, mocker, targeted_plan_fails):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud has a terraform state. Adding compute nodes to its applied
+    configuration plans the new nodes only, unless the targeted plan fails.
+    """
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.plan_mode import PlanMode
+
+    def fake_run(process_args, *args, **kwargs):
+        if targeted_plan_fails and any(
+            arg.startswith("-target=") for arg in process_args
+        ):
+            raise CalledProcessError(1, process_args)
+
+    run = mocker.patch(
+        "mchub.models.magic_castle.magic_castle.run", side_effect=fake_run
+    )
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=True,
+    )
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    orm.applied_config = orm.config
+    magic_castle = MagicCastle(orm=orm)
+
+    config = {
+        **deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"]),
+        "cloud": {"id": 1},
+    }
+    config["instances"]["node"]["count"] = 2
+    assert magic_castle.plan_modification(config) is not None
+
+    plans = [call.args[0] for call in run.call_args_list if "plan" in call.args[0]]
+    assert [arg for arg in plans[0] if arg.startswith("-target=")][:2] == [
+        '-target=module.openstack.openstack_compute_instance_v2.instances["node2"]',
+        '-target=module.openstack.openstack_networking_port_v2.nic["node2"]',
+    ]
+    if targeted_plan_fails:
+        assert len(plans) == 2
+        assert not any(arg.startswith("-target=") for arg in plans[1])
+        assert magic_castle.plan_mode == PlanMode.FULL
+    else:
+        assert len(plans) == 1
+        assert magic_castle.plan_mode == PlanMode.TARGETED
+
+
+def test_run_drift_check(app, mocker):
+    """
+    Mock context :
+
+    noowner.magic-castle.cloud is provisioned. One of its nodes was deleted outside of
+    terraform.
+    """
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+    drift_event = {
+        "type": "resource_drift",
+        "change": {
+            "resource": {
+                "addr": 'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+                "resource_type": "openstack_compute_instance_v2",
+            },
+            "action": "delete",
+        },
+    }
+
+    def fake_run(process_args, *args, stdout=None, **kwargs):
+        if "-refresh-only" in process_args:
+            stdout.write(json.dumps(drift_event) + "\n")
+
+    run = mocker.patch(
+        "mchub.models.magic_castle.magic_castle.run", side_effect=fake_run
+    )
+    orm = MagicCastleORM.query.filter_by(hostname="noowner.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+    magic_castle.run_drift_check()
+
+    assert "-lock=false" in run.call_args.args[0]
+    assert magic_castle.state["drift"]["drifted"]
+    assert magic_castle.state["drift"]["resources"] == [
+        {
+            "address": 'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+            "type": "openstack_compute_instance_v2",
+            "action": "delete",
+        }
+    ]
+    assert orm.drift_checked is not None
+
+
+def test_run_drift_check_init_error(app, mocker):
+    """
+    Mock context :
+
+    noowner.magic-castle.cloud is provisioned, but its terraform modules are not
+    initialized and terraform init fails.
+    """
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.exceptions.server_exception import PlanException
+
+    def fake_run(process_args, *args, **kwargs):
+        raise CalledProcessError(1, process_args)
+
+    run = mocker.patch(
+        "mchub.models.magic_castle.magic_castle.run", side_effect=fake_run
+    )
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.TerraformCache.populate",
+        return_value=False,
+    )
+    mocker.patch.object(
+        MagicCastle, "initialized", new_callable=mocker.PropertyMock, return_value=False
+    )
+    orm = MagicCastleORM.query.filter_by(hostname="noowner.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+    with pytest.raises(PlanException):
+        magic_castle.run_drift_check()
+
+    assert run.call_args.args[0][:2] == ["terraform", "init"]
+    assert magic_castle.status == ClusterStatusCode.PROVISIONING_SUCCESS
+    assert orm.status == ClusterStatusCode.PROVISIONING_SUCCESS
+    assert not orm.drift["drifted"]
+    assert orm.drift["errors"] == [
+        {
+            "summary": "Could not initialize Terraform modules.",
+            "detail": None,
+            "address": None,
+        }
+    ]
+    assert orm.drift_checked is not None
+
+
+def test_cancel_running_plan(app, mocker):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud has a terraform state. Its destruction plan is cancelled
+    while terraform runs.
+    """
+    from mchub.models.job.job import Job
+    from mchub.models.job.job_status_code import JobStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.plan_type import PlanType
+    from mchub.models.terraform.terraform_process import TerraformCancelledError
+
+    def fake_run(process_args, *args, job=None, **kwargs):
+        if "plan" in process_args:
+            magic_castle.cancel()
+            assert job.is_cancel_requested()
+            raise TerraformCancelledError(1, process_args)
+
+    mocker.patch("mchub.models.magic_castle.magic_castle.run", side_effect=fake_run)
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=True,
+    )
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+    job = magic_castle.plan_destruction()
+
+    assert Job.get(job.id).status == JobStatusCode.CANCELLED
+    assert magic_castle.plan is None
+    assert magic_castle.plan_type == PlanType.NONE
+    assert magic_castle.status == ClusterStatusCode.PROVISIONING_SUCCESS
+
+
+def test_recover_apply(app, mocker):
+    """
+    Mock context :
+
+    MC Hub restarted while building valid1.magic-castle.cloud, and terraform died with it.
+    """
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.plan_type import PlanType
+    from mchub.models.terraform.apply_journal import ApplyJournal
+
+    queue_plan = mocker.patch.object(MagicCastle, "queue_plan")
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    orm.status = ClusterStatusCode.BUILD_RUNNING
+    orm.plan_type = PlanType.BUILD
+    orm.tf_state = None
+    magic_castle = MagicCastle(orm=orm)
+    ApplyJournal.record(magic_castle.path, 2**22 + 1)
+
+    magic_castle.recover_apply()
+    queue_plan.assert_called_once()
+    assert magic_castle.tf_state is not None
+    assert magic_castle.plan_type == PlanType.BUILD
+    assert magic_castle.status == ClusterStatusCode.PLAN_RUNNING
+    assert ApplyJournal.read(magic_castle.path) is None
+
+
+def test_run_apply_reattaches(app, mocker):
+    """
+    Mock context :
+
+    MC Hub restarted while building valid1.magic-castle.cloud, and terraform kept running.
+    """
+    import subprocess
+    import sys
+
+    from os import path
+    from mchub.models.magic_castle.magic_castle import (
+        MagicCastle,
+        MagicCastleORM,
+        TERRAFORM_APPLY_LOG_FILENAME,
+        TERRAFORM_PLAN_BINARY_FILENAME,
+    )
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.plan_type import PlanType
+    from mchub.models.terraform.apply_journal import ApplyJournal
+
+    mocker.patch(
+        "mchub.models.terraform.apply_journal.REATTACH_POLL_INTERVAL", new=0.05
+    )
+    run = mocker.patch("mchub.models.magic_castle.magic_castle.run")
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    orm.status = ClusterStatusCode.BUILD_RUNNING
+    orm.plan_type = PlanType.BUILD
+    magic_castle = MagicCastle(orm=orm)
+    open(path.join(magic_castle.path, TERRAFORM_PLAN_BINARY_FILENAME), "w").close()
+    with open(path.join(magic_castle.path, TERRAFORM_APPLY_LOG_FILENAME), "w") as file:
+        file.write(
+            json.dumps({"type": "change_summary", "changes": {"operation": "apply"}})
+            + "\n"
+        )
+
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.3)"])
+    ApplyJournal.record(magic_castle.path, process.pid)
+    try:
+        magic_castle.run_apply()
+    finally:
+        process.wait()
+    run.assert_not_called()
+    assert orm.status == ClusterStatusCode.PROVISIONING_RUNNING
+    assert magic_castle.plan_type == PlanType.NONE
+    assert ApplyJournal.read(magic_castle.path) is None
+
+
+def test_start_apply_completion(app, mocker):
+    """
+    Mock context :
+
+    The apply of valid1.magic-castle.cloud is started through the terraform supervisor,
+    and its results are saved once terraform exited.
+    """
+    import sys
+
+    from os import path
+    from mchub.models.magic_castle.magic_castle import (
+        MagicCastle,
+        MagicCastleORM,
+        TERRAFORM_APPLY_LOG_FILENAME,
+        TERRAFORM_PLAN_BINARY_FILENAME,
+    )
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+    from mchub.models.magic_castle.plan_type import PlanType
+    from mchub.models.terraform.apply_journal import ApplyJournal
+    from mchub.models.terraform.terraform_process import TerraformSupervisor
+
+    start = TerraformSupervisor.start
+    summary = json.dumps({"type": "change_summary", "changes": {"operation": "apply"}})
+    commands = []
+
+    def fake_terraform(args, **kwargs):
+        commands.append(args)
+        return start([sys.executable, "-c", f"print({summary!r})"], **kwargs)
+
+    mocker.patch.object(TerraformSupervisor, "start", side_effect=fake_terraform)
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    orm.status = ClusterStatusCode.BUILD_RUNNING
+    orm.plan_type = PlanType.BUILD
+    magic_castle = MagicCastle(orm=orm)
+    open(path.join(magic_castle.path, TERRAFORM_PLAN_BINARY_FILENAME), "w").close()
+
+    terraform_run = magic_castle.start_apply(2)
+    assert terraform_run.wait(10)
+    assert ApplyJournal.read(magic_castle.path) is not None
+    magic_castle.finish_apply(terraform_run)
+    assert commands[0][:2] == ["terraform", "apply"]
+    assert "-parallelism=2" in commands[0]
+    with open(path.join(magic_castle.path, TERRAFORM_APPLY_LOG_FILENAME)) as file:
+        assert file.read() == summary + "\n"
+    assert orm.status == ClusterStatusCode.PROVISIONING_RUNNING
+    assert magic_castle.plan_type == PlanType.NONE
+    assert ApplyJournal.read(magic_castle.path) is None
+
+
+def test_plan_modification_coalesced(app, mocker):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud has a terraform state. Two modifications sent within the
+    debounce window are planned together.
+    """
+    from mchub.configuration import get_config
+    from mchub.models.job.job_queue import JobQueue
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+    from mchub.models.magic_castle.cluster_status_code import ClusterStatusCode
+
+    mocker.patch.dict(get_config(), {"plan_debounce": 5})
+    submit = mocker.patch.object(JobQueue, "submit")
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+
+    config = {
+        **deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"]),
+        "cloud": {"id": 1},
+    }
+    config["instances"]["node"]["count"] = 2
+    job = magic_castle.plan_modification(deepcopy(config))
+    not_before = job.orm.not_before
+    assert not_before is not None
+    assert orm.status == ClusterStatusCode.PLAN_RUNNING
+
+    config["instances"]["node"]["count"] = 3
+    assert magic_castle.plan_modification(deepcopy(config)).id == job.id
+    assert job.orm.not_before >= not_before
+    assert magic_castle.config["instances"]["node"]["count"] == 3
+    submit.assert_called_once()
+
+
+def test_plan_modification_supersedes_running_plan(app, mocker):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud has a terraform state. A modification sent while its plan
+    runs queues a new plan, and the outdated plan is discarded.
+    """
+    from os import path
+    from mchub.models.job.job import Job
+    from mchub.models.job.job_status_code import JobStatusCode
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+    planned_counts = []
+
+    def fake_run(process_args, *args, **kwargs):
+        if "plan" not in process_args:
+            return
+        with open(path.join(magic_castle.path, "main.tf.json")) as file:
+            planned_counts.append(
+                json.load(file)["module"]["openstack"]["instances"]["node"]["count"]
+            )
+        if len(planned_counts) == 1:
+            config["instances"]["node"]["count"] = 3
+            jobs.append(MagicCastle(orm=orm).plan_modification(deepcopy(config)))
+
+    mocker.patch("mchub.models.magic_castle.magic_castle.run", side_effect=fake_run)
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=True,
+    )
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+    config = {
+        **deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"]),
+        "cloud": {"id": 1},
+    }
+    config["instances"]["node"]["count"] = 2
+    jobs = []
+    outdated = magic_castle.plan_modification(deepcopy(config))
+
+    assert planned_counts == [2, 3]
+    assert jobs[0].id != outdated.id
+    assert Job.get(outdated.id).status == JobStatusCode.SUCCESS
+    assert Job.latest(magic_castle.hostname).id == jobs[0].id
+    assert magic_castle.config["instances"]["node"]["count"] == 3
+
+
+def test_reuse_superseded_plan(app, mocker):
+    """
+    Mock context :
+
+    valid1.magic-castle.cloud has a terraform state. A modification sent while its plan
+    runs supersedes the plan, then going back to the first configuration reuses the
+    binary of the outdated plan.
+    """
+    from os import path
+    from mchub.models.job.job_queue import JobQueue
+    from mchub.models.magic_castle.magic_castle import MagicCastle, MagicCastleORM
+
+    planned_counts = []
+
+    def fake_run(process_args, *args, **kwargs):
+        if "plan" not in process_args:
+            return
+        with open(path.join(magic_castle.path, "main.tf.json")) as file:
+            count = json.load(file)["module"]["openstack"]["instances"]["node"]["count"]
+        planned_counts.append(count)
+        for arg in process_args:
+            if arg.startswith("-out="):
+                # Like terraform, truncates an existing file in place
+                with open(arg[len("-out=") :], "w") as file:
+                    file.write(f"plan of {count} nodes")
+        if count == 2:
+            config["instances"]["node"]["count"] = 3
+            MagicCastle(orm=orm).plan_modification(deepcopy(config))
+
+    mocker.patch("mchub.models.magic_castle.magic_castle.run", side_effect=fake_run)
+    mocker.patch(
+        "mchub.models.magic_castle.magic_castle.ProvisioningManager.check_online",
+        return_value=True,
+    )
+    # The newer plan waits for the outdated plan to finish
+    submitted = []
+    mocker.patch.object(JobQueue, "submit", side_effect=submitted.append)
+    orm = MagicCastleORM.query.filter_by(hostname="valid1.magic-castle.cloud").first()
+    magic_castle = MagicCastle(orm=orm)
+    config = {
+        **deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"]),
+        "cloud": {"id": 1},
+    }
+    config["instances"]["node"]["count"] = 2
+    magic_castle.plan_modification(deepcopy(config))
+    while submitted:
+        JobQueue.execute(submitted.pop(0).id)
+    assert planned_counts == [2, 3]
+    with open(path.join(magic_castle.path, "terraform_plan")) as file:
+        assert file.read() == "plan of 3 nodes"
+
+    config["instances"]["node"]["count"] = 2
+    assert magic_castle.plan_modification(deepcopy(config)) is None
+    assert planned_counts == [2, 3]
+    with open(path.join(magic_castle.path, "terraform_plan")) as file:
+        assert file.read() == "plan of 2 nodes"
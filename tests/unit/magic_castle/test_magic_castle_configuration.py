@@ -125,3 +125,190 @@ def test_properties():
     config = MagicCastleConfiguration("openstack", CONFIG_DICT)
     assert config.cluster_name == "foo-123"
     assert config.domain == "magic-castle.cloud"
+
+
+def test_write_unchanged(tmp_path):
+    from mchub.models.magic_castle.magic_castle_configuration import (
+        MagicCastleConfiguration,
+    )
+
+    main_file = str(tmp_path / "main.tf.json")
+    config = MagicCastleConfiguration("openstack", deepcopy(CONFIG_DICT))
+    assert config.write(main_file)
+    with open(main_file) as file:
+        assert file.read() == config.render()
+    assert not config.write(main_file)
+
+    changed = deepcopy(CONFIG_DICT)
+    changed["nb_users"] += 1
+    assert MagicCastleConfiguration("openstack", changed).write(main_file)
+
+
+def load_state(hostname):
+    import json
+
+    with open(
+        path.join(
+            path.dirname(__file__),
+            "..",
+            "..",
+            "data",
+            "mock-clusters",
+            hostname,
+            "terraform.tfstate",
+        )
+    ) as file:
+        return json.load(file)
+
+
+def test_get_scaling_targets():
+    from mchub.models.magic_castle.magic_castle_configuration import (
+        MagicCastleConfiguration,
+    )
+    from mchub.models.terraform.terraform_state import TerraformState
+
+    tf_state = TerraformState(load_state("valid1.magic-castle.cloud"))
+    previous = MagicCastleConfiguration(
+        "openstack", deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    )
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["node"]["count"] = 3
+    assert MagicCastleConfiguration("openstack", config).get_scaling_targets(
+        previous, tf_state
+    ) == [
+        'module.openstack.openstack_compute_instance_v2.instances["node2"]',
+        'module.openstack.openstack_networking_port_v2.nic["node2"]',
+        'module.openstack.openstack_compute_instance_v2.instances["node3"]',
+        'module.openstack.openstack_networking_port_v2.nic["node3"]',
+        "module.openstack.module.cluster_config",
+    ]
+
+    # Resizing targets every instance of the prefix
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["node"]["type"] = "p4-6gb"
+    assert MagicCastleConfiguration("openstack", config).get_scaling_targets(
+        previous, tf_state
+    ) == [
+        'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+        'module.openstack.openstack_networking_port_v2.nic["node1"]',
+        "module.openstack.module.cluster_config",
+    ]
+
+
+def test_get_scaling_targets_instance_resources():
+    """
+    Targets the volumes and the floating IP of the instances, keyed by their names in the
+    state of the mock cluster.
+    """
+    from mchub.models.magic_castle.magic_castle_configuration import (
+        MagicCastleConfiguration,
+    )
+    from mchub.models.terraform.terraform_state import TerraformState
+
+    state = load_state("valid1.magic-castle.cloud")
+    # Gives the volumes of mgmt1 and the floating IP of login1 to node1
+    for resource in state["resources"]:
+        if resource["name"] in ("volumes", "attachments", "fip"):
+            for instance in resource["instances"]:
+                key = instance["index_key"]
+                instance["index_key"] = "node1" + key[len(key.split("-")[0]) :]
+    tf_state = TerraformState(state)
+    previous = MagicCastleConfiguration(
+        "openstack", deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    )
+
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["node"]["count"] = 0
+    assert MagicCastleConfiguration("openstack", config).get_scaling_targets(
+        previous, tf_state
+    ) == [
+        'module.openstack.openstack_blockstorage_volume_v3.volumes["node1-nfs-home"]',
+        'module.openstack.openstack_blockstorage_volume_v3.volumes["node1-nfs-project"]',
+        'module.openstack.openstack_blockstorage_volume_v3.volumes["node1-nfs-scratch"]',
+        'module.openstack.openstack_compute_floatingip_associate_v2.fip["node1"]',
+        'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+        'module.openstack.openstack_compute_volume_attach_v2.attachments["node1-nfs-home"]',
+        'module.openstack.openstack_compute_volume_attach_v2.attachments["node1-nfs-project"]',
+        'module.openstack.openstack_compute_volume_attach_v2.attachments["node1-nfs-scratch"]',
+        'module.openstack.openstack_networking_floatingip_v2.fip["node1"]',
+        'module.openstack.openstack_networking_port_v2.nic["node1"]',
+        "module.openstack.module.cluster_config",
+    ]
+
+    # The addresses of the volumes of an added instance cannot be derived
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["node"]["count"] = 2
+    assert (
+        MagicCastleConfiguration("openstack", config).get_scaling_targets(
+            previous, tf_state
+        )
+        is None
+    )
+
+
+def test_get_scaling_targets_full_plan():
+    from mchub.models.magic_castle.magic_castle_configuration import (
+        MagicCastleConfiguration,
+    )
+
+    from mchub.models.terraform.terraform_state import TerraformState
+
+    tf_state = TerraformState(load_state("valid1.magic-castle.cloud"))
+    previous = MagicCastleConfiguration(
+        "openstack", deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    )
+    unchanged = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    assert (
+        MagicCastleConfiguration("openstack", unchanged).get_scaling_targets(
+            previous, tf_state
+        )
+        is None
+    )
+    assert (
+        MagicCastleConfiguration("openstack", unchanged).get_scaling_targets(
+            None, tf_state
+        )
+        is None
+    )
+
+    # Instances without the node tag
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["login"]["count"] = 2
+    assert (
+        MagicCastleConfiguration("openstack", config).get_scaling_targets(
+            previous, tf_state
+        )
+        is None
+    )
+
+    # Changes outside of the instances
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["node"]["count"] = 2
+    config["nb_users"] += 1
+    assert (
+        MagicCastleConfiguration("openstack", config).get_scaling_targets(
+            previous, tf_state
+        )
+        is None
+    )
+
+    # New instance prefix
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["gpu"] = {"type": "p4-6gb", "count": 1, "tags": ["node"]}
+    assert (
+        MagicCastleConfiguration("openstack", config).get_scaling_targets(
+            previous, tf_state
+        )
+        is None
+    )
+
+    # Added instances of a prefix without instance in the state
+    config = deepcopy(CLUSTERS_CONFIG["valid1.magic-castle.cloud"])
+    config["instances"]["node"]["count"] = 2
+    tf_state = TerraformState(load_state("missingnodes.mc.ca"))
+    assert (
+        MagicCastleConfiguration("openstack", config).get_scaling_targets(
+            previous, tf_state
+        )
+        is None
+    )
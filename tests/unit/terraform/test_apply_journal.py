@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+from mchub.models.terraform.apply_journal import (
+    ApplyJournal,
+    TERRAFORM_APPLY_JOURNAL_FILENAME,
+)
+
+
+def test_record_read(tmp_path):
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        ApplyJournal.record(str(tmp_path), process.pid, job_id=3, log_offset=10)
+        journal = ApplyJournal.read(str(tmp_path))
+        assert journal.pid == process.pid
+        assert journal.job_id == 3
+        assert journal.log_offset == 10
+        assert journal.is_alive()
+    finally:
+        process.kill()
+        process.wait()
+    assert not journal.is_alive()
+
+    ApplyJournal.discard(str(tmp_path))
+    assert ApplyJournal.read(str(tmp_path)) is None
+
+
+def test_read_corrupted(tmp_path):
+    (tmp_path / TERRAFORM_APPLY_JOURNAL_FILENAME).write_text('{"pid": ')
+    assert ApplyJournal.read(str(tmp_path)) is None
+
+
+def test_is_alive_pid_reused(tmp_path):
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        journal = ApplyJournal.record(str(tmp_path), process.pid)
+        journal.start_time -= 1
+        assert not journal.is_alive()
+    finally:
+        process.kill()
+        process.wait()
@@ -0,0 +1,177 @@
+import json
+import os
+
+import pytest
+
+from mchub.models.terraform import apply_log_tracker
+from mchub.models.terraform.apply_log_tracker import ApplyLogTracker
+from mchub.models.terraform.terraform_plan_parser import TerraformPlanParser
+
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+PLAN = {
+    "resource_changes": [
+        {"address": address, "type": "null_resource", "change": {"actions": actions}}
+        for address, actions in [
+            ("first", ["create"]),
+            ("second", ["create"]),
+            ("replaced", ["delete", "create"]),
+        ]
+    ]
+}
+
+
+def hook(type, address, action, **kwargs):
+    return {
+        "type": type,
+        "hook": {"resource": {"addr": address}, "action": action, **kwargs},
+    }
+
+
+EVENTS = [
+    {"type": "version", "terraform": "1.1.9", "@timestamp": "2022-06-01T10:00:00"},
+    hook("apply_start", "first", "create"),
+    hook("apply_complete", "first", "create", elapsed_seconds=2),
+    hook("apply_start", "second", "create"),
+    hook("apply_progress", "second", "create", elapsed_seconds=10),
+    hook("apply_complete", "replaced", "delete", elapsed_seconds=1),
+    hook("apply_complete", "replaced", "create", elapsed_seconds=3),
+]
+
+
+def lines(events):
+    return "".join(json.dumps(event) + "\n" for event in events)
+
+
+def get_progress(changes):
+    return {change["address"]: change["change"]["progress"] for change in changes}
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    log_path = str(tmp_path / "terraform_apply.log")
+    yield log_path
+    ApplyLogTracker.discard(log_path)
+
+
+def test_missing_log(log_path):
+    assert get_progress(ApplyLogTracker.get(log_path).get_changes(PLAN)) == {
+        "first": "queued",
+        "second": "queued",
+        "replaced": "queued",
+    }
+
+
+def test_appended_messages(log_path):
+    tracker = ApplyLogTracker.get(log_path)
+    log = lines(EVENTS)
+    cut = log.index("apply_start") + 20
+    with open(log_path, "w") as file:
+        file.write(log[:cut])
+    assert get_progress(tracker.get_changes(PLAN))["first"] == "queued"
+    assert tracker.pending
+
+    with open(log_path, "a") as file:
+        file.write(log[cut:])
+    assert tracker.get_changes(PLAN) == TerraformPlanParser.get_applied_changes(
+        PLAN, EVENTS
+    )
+    assert tracker.offset == len(log)
+    assert tracker.pending == b""
+    assert ApplyLogTracker.get(log_path) is tracker
+
+
+def test_read_only_appended_bytes(log_path, mocker):
+    tracker = ApplyLogTracker.get(log_path)
+    with open(log_path, "w") as file:
+        file.write(lines(EVENTS[:3]))
+    tracker.get_changes(PLAN)
+
+    parse = mocker.spy(ApplyLogTracker, "parse")
+    with open(log_path, "a") as file:
+        file.write(lines(EVENTS[3:]))
+    assert get_progress(tracker.get_changes(PLAN)) == {
+        "first": "done",
+        "second": "running",
+        "replaced": "done",
+    }
+    assert parse.call_count == 1
+    _, buffer, start, end = parse.call_args.args
+    assert len(buffer[start:end]) == len(lines(EVENTS[3:]))
+
+
+def test_log_rewritten(log_path):
+    tracker = ApplyLogTracker.get(log_path)
+    with open(log_path, "w") as file:
+        file.write(lines(EVENTS))
+    assert get_progress(tracker.get_changes(PLAN))["first"] == "done"
+
+    # A new apply truncates the log
+    events = [
+        {**EVENTS[0], "@timestamp": "2022-06-01T11:00:00"},
+        hook("apply_start", "first", "create"),
+    ]
+    with open(log_path, "w") as file:
+        file.write(lines(events))
+    assert tracker.get_changes(PLAN) == TerraformPlanParser.get_applied_changes(
+        PLAN, events
+    )
+
+
+def test_log_replaced(log_path):
+    tracker = ApplyLogTracker.get(log_path)
+    with open(log_path, "w") as file:
+        file.write(lines(EVENTS))
+    tracker.get_changes(PLAN)
+
+    os.rename(log_path, log_path + ".1")
+    with open(log_path, "w") as file:
+        file.write(lines(EVENTS[:2]))
+    assert get_progress(tracker.get_changes(PLAN)) == {
+        "first": "running",
+        "second": "queued",
+        "replaced": "queued",
+    }
+
+
+def test_memory_mapped_log(log_path, mocker):
+    mocker.patch.object(apply_log_tracker, "MMAP_THRESHOLD", 0)
+    tracker = ApplyLogTracker.get(log_path)
+    with open(log_path, "w") as file:
+        file.write(lines(EVENTS))
+    assert tracker.get_changes(PLAN) == TerraformPlanParser.get_applied_changes(
+        PLAN, EVENTS
+    )
+
+
+def test_legacy_log(log_path):
+    log = "module.openstack.first: Creation complete after 1s\n"
+    with open(log_path, "w") as file:
+        file.write(log)
+    assert ApplyLogTracker.get(log_path).get_changes(
+        PLAN
+    ) == TerraformPlanParser.get_done_changes(PLAN, log)
+
+
+def test_legacy_log_appended(log_path):
+    tracker = ApplyLogTracker.get(log_path)
+    log = (
+        "null_resource.first: Creating...\n"
+        "null_resource.first: Creation complete after 1s\n"
+        "null_resource.second: Creating...\n"
+    )
+    cut = log.index("Creation") + 5
+    with open(log_path, "w") as file:
+        file.write(log[:cut])
+    assert get_progress(tracker.get_changes(PLAN))["first"] == "running"
+
+    with open(log_path, "a") as file:
+        file.write(log[cut:])
+    assert get_progress(tracker.get_changes(PLAN)) == {
+        "first": "done",
+        "second": "running",
+        "replaced": "queued",
+    }
+    assert tracker.offset == len(log)
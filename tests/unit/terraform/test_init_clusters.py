@@ -0,0 +1,108 @@
+import json
+import pytest
+
+from os import makedirs, path
+from subprocess import CalledProcessError
+
+from mchub.init_clusters import (
+    init_clusters,
+    is_initialized,
+    INITIALIZED,
+    SKIPPED,
+    FAILED,
+)
+from mchub.models.terraform.terraform_cache import TerraformCache
+
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+SOURCE = "git::https://github.com/ComputeCanada/magic_castle.git//openstack?ref=11.8"
+
+
+def make_cluster(clusters_path, name, installed_source=None, source=SOURCE):
+    cluster_path = path.join(clusters_path, name)
+    makedirs(cluster_path)
+    with open(path.join(cluster_path, "main.tf.json"), "w") as file:
+        json.dump({"module": {"openstack": {"source": source}}}, file)
+    if installed_source is not None:
+        makedirs(path.join(cluster_path, ".terraform", "modules"))
+        with open(
+            path.join(cluster_path, ".terraform", "modules", "modules.json"), "w"
+        ) as file:
+            json.dump(
+                {
+                    "Modules": [
+                        {"Key": "", "Source": "", "Dir": "."},
+                        {"Key": "openstack", "Source": installed_source},
+                    ]
+                },
+                file,
+            )
+        open(path.join(cluster_path, ".terraform.lock.hcl"), "w").close()
+        TerraformCache.mark_initialized(cluster_path)
+    return cluster_path
+
+
+def test_is_initialized(tmp_path):
+    assert is_initialized(make_cluster(tmp_path, "current", SOURCE))
+    assert not is_initialized(make_cluster(tmp_path, "new"))
+    assert not is_initialized(
+        make_cluster(tmp_path, "outdated", SOURCE.replace("11.8", "11.7"))
+    )
+
+
+def test_is_initialized_version_change(tmp_path, mocker):
+    """
+    Local module sources do not change with the Magic Castle version.
+    """
+    cluster_path = make_cluster(tmp_path, "local", "./openstack", "./openstack")
+    assert is_initialized(cluster_path)
+
+    mocker.patch("mchub.models.terraform.terraform_cache.MAGIC_CASTLE_VERSION", "99.0")
+    assert not is_initialized(cluster_path)
+
+    run = mocker.patch("mchub.init_clusters.run")
+    results = init_clusters(str(tmp_path), jobs=4)
+    assert results["local"][0] == INITIALIZED
+    run.assert_called_once()
+    assert is_initialized(cluster_path)
+
+
+def test_is_initialized_lock_file_change(tmp_path):
+    cluster_path = make_cluster(tmp_path, "current", SOURCE)
+    with open(path.join(cluster_path, ".terraform.lock.hcl"), "w") as file:
+        file.write('provider "registry.terraform.io/hashicorp/openstack" {}')
+    assert not is_initialized(cluster_path)
+
+
+def test_init_clusters(tmp_path, mocker):
+    def fake_run(process_args, *args, cwd=None, **kwargs):
+        if cwd.endswith("failing"):
+            raise CalledProcessError(1, "terraform init", stderr=b"Error")
+
+    run = mocker.patch("mchub.init_clusters.run", side_effect=fake_run)
+    make_cluster(tmp_path, "current", SOURCE)
+    make_cluster(tmp_path, "outdated", SOURCE.replace("11.8", "11.7"))
+    make_cluster(tmp_path, "failing")
+    make_cluster(tmp_path, "new")
+    makedirs(path.join(tmp_path, ".pool"))
+
+    results = init_clusters(str(tmp_path), jobs=4)
+    assert {name: result[0] for name, result in results.items()} == {
+        "current": SKIPPED,
+        "outdated": INITIALIZED,
+        "failing": FAILED,
+        "new": INITIALIZED,
+    }
+    assert results["failing"][2] == b"Error"
+    assert run.call_count == 3
+
+
+def test_init_clusters_upgrade(tmp_path, mocker):
+    run = mocker.patch("mchub.init_clusters.run")
+    make_cluster(tmp_path, "current", SOURCE)
+
+    results = init_clusters(str(tmp_path), jobs=4, upgrade=True)
+    assert results["current"][0] == INITIALIZED
+    assert run.call_args.args[0][-1] == "-upgrade"
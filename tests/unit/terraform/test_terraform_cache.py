@@ -0,0 +1,99 @@
+import pytest
+
+from os import makedirs, path, stat
+from pathlib import Path
+from shutil import copy
+
+from mchub.models.terraform.terraform_cache import TerraformCache
+
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+def fake_init(process_args, *args, cwd=None, **kwargs):
+    makedirs(path.join(cwd, ".terraform", "modules"))
+    with open(path.join(cwd, ".terraform", "modules", "modules.json"), "w") as file:
+        file.write('{"Modules": []}')
+    with open(path.join(cwd, ".terraform.lock.hcl"), "w") as file:
+        file.write("# lock")
+
+
+@pytest.fixture
+def cache(mocker, tmp_path):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"terraform_cache": True})
+    mocker.patch(
+        "mchub.models.terraform.terraform_cache.TERRAFORM_CACHE_PATH",
+        new=str(tmp_path / "cache"),
+    )
+    return mocker.patch(
+        "mchub.models.terraform.terraform_cache.run", side_effect=fake_init
+    )
+
+
+def make_cluster(tmp_path, name):
+    cluster_path = tmp_path / name
+    cluster_path.mkdir()
+    copy(
+        path.join(
+            Path(__file__).parent.parent.parent,
+            "data",
+            "mock-clusters",
+            "created.magic-castle.cloud",
+            "main.tf.json",
+        ),
+        cluster_path / "main.tf.json",
+    )
+    return str(cluster_path)
+
+
+def test_populate(cache, tmp_path):
+    first = make_cluster(tmp_path, "first")
+    second = make_cluster(tmp_path, "second")
+    assert TerraformCache.populate(first)
+    assert TerraformCache.populate(second)
+    # terraform init ran only once, for the cache entry
+    assert cache.call_count == 1
+    assert "-backend=false" in cache.call_args.args[0]
+
+    modules_json = path.join(".terraform", "modules", "modules.json")
+    assert path.exists(path.join(second, ".terraform.lock.hcl"))
+    # Files are hardlinked from the cache
+    assert (
+        stat(path.join(first, modules_json)).st_ino
+        == stat(path.join(second, modules_json)).st_ino
+    )
+
+
+def test_populate_disabled(cache, tmp_path, mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"terraform_cache": False})
+    assert not TerraformCache.populate(make_cluster(tmp_path, "cluster"))
+    cache.assert_not_called()
+
+
+def test_populate_init_fail(cache, tmp_path):
+    cluster = make_cluster(tmp_path, "cluster")
+    cache.side_effect = lambda *args, **kwargs: None
+    assert not TerraformCache.populate(cluster)
+    assert not path.exists(path.join(cluster, ".terraform"))
+
+
+def test_key_depends_on_version(mocker):
+    modules = {"openstack": "./openstack", "dns": "./dns/cloudflare"}
+    key = TerraformCache.get_key(modules)
+    assert key == TerraformCache.get_key(dict(reversed(modules.items())))
+    mocker.patch(
+        "mchub.models.terraform.terraform_cache.MAGIC_CASTLE_VERSION", new="12.0.0"
+    )
+    assert TerraformCache.get_key(modules) != key
+    assert TerraformCache.get_key(modules).startswith("12.0.0-dns-openstack-")
+
+
+def test_prewarm(cache):
+    TerraformCache.prewarm()
+    # Without DNS, with the cloudflare module and with the gcloud module
+    assert cache.call_count == 3
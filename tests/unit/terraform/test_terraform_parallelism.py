@@ -0,0 +1,91 @@
+import pytest
+
+from ...test_helpers import app, generate_test_clusters, mock_clusters_path  # noqa;
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+def apply_events(elapsed_seconds, diagnostic=None):
+    events = [
+        {
+            "type": "apply_complete",
+            "hook": {
+                "resource": {
+                    "addr": f'module.openstack.openstack_compute_instance_v2.instances["node{index}"]',
+                    "resource_type": "openstack_compute_instance_v2",
+                },
+                "action": "create",
+                "elapsed_seconds": seconds,
+            },
+        }
+        for index, seconds in enumerate(elapsed_seconds)
+    ]
+    if diagnostic:
+        events.append(
+            {
+                "type": "diagnostic",
+                "diagnostic": {"severity": "error", **diagnostic},
+            }
+        )
+    return events
+
+
+@pytest.fixture
+def project(app):
+    from mchub.models.cloud.project import Project
+
+    return Project.query.get(1)
+
+
+def test_choose_default(project):
+    from mchub.models.terraform.terraform_parallelism import TerraformParallelism
+
+    assert TerraformParallelism.choose(project) == 10
+    project.max_parallelism = 4
+    assert TerraformParallelism.choose(project) == 4
+
+
+def test_observe_increase(project):
+    from mchub.models.terraform.terraform_parallelism import TerraformParallelism
+
+    assert TerraformParallelism.observe(project, 10, apply_events([30, 40])) == 11
+    assert project.resource_latency == {"openstack_compute_instance_v2": 35}
+
+
+def test_observe_throttled(project):
+    from mchub.models.terraform.terraform_parallelism import TerraformParallelism
+
+    events = apply_events(
+        [30],
+        {
+            "summary": "Error creating OpenStack server",
+            "detail": "Expected HTTP response code [202] but got 429: Too Many Requests",
+        },
+    )
+    assert TerraformParallelism.observe(project, 10, events) == 5
+
+
+def test_observe_slowdown(project):
+    from mchub.models.terraform.terraform_parallelism import TerraformParallelism
+
+    project.resource_latency = {"openstack_compute_instance_v2": 30}
+    assert TerraformParallelism.observe(project, 12, apply_events([70, 80])) == 9
+    assert project.resource_latency == {"openstack_compute_instance_v2": 43.5}
+
+
+def test_observe_other_error(project):
+    from mchub.models.terraform.terraform_parallelism import TerraformParallelism
+
+    events = apply_events([30], {"summary": "Quota exceeded for cores", "detail": ""})
+    assert TerraformParallelism.observe(project, 10, events) == 10
+
+
+def test_observe_bounds(project):
+    from mchub.models.terraform.terraform_parallelism import TerraformParallelism
+
+    project.min_parallelism = 4
+    project.max_parallelism = 10
+    assert TerraformParallelism.observe(project, 10, apply_events([30])) == 10
+    events = apply_events([30], {"summary": "Rate limit exceeded", "detail": ""})
+    assert TerraformParallelism.observe(project, 5, events) == 4
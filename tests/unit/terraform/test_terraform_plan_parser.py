@@ -82,3 +82,345 @@ def test_get_done_changes(missing_floating_ips_initial_plan):
         read_terraform_apply_log("missingfloatingips.mc.ca"),
     )
     assert progress == PROGRESS_DATA["progress"]
+
+
+def search_done_changes(initial_plan, terraform_apply_output):
+    """
+    Progress found by searching the output for every action of every resource, as
+    get_done_changes did before indexing the output.
+    """
+    changes = TerraformPlanParser.get_resources_changes(initial_plan)
+    for change in changes:
+        address = change["address"]
+        found = {
+            action: terraform_apply_output.find(f"{address}: {text}")
+            for action, text in [
+                ("create", "Creating..."),
+                ("delete", "Destroying..."),
+                ("update", "Modifying..."),
+                ("created", "Creation complete"),
+                ("deleted", "Destruction complete"),
+                ("updated", "Modifications complete"),
+            ]
+        }
+        actions = change["change"]["actions"]
+        progress = "queued"
+        if actions in (["no-op"], ["read"]):
+            progress = "done"
+        elif actions == ["create"]:
+            if found["created"] != -1:
+                progress = "done"
+            elif found["create"] != -1:
+                progress = "running"
+        elif actions == ["update"]:
+            if found["updated"] != -1:
+                progress = "done"
+            elif found["update"] != -1:
+                progress = "running"
+        elif actions == ["delete", "create"]:
+            if -1 != found["deleted"] < found["created"]:
+                progress = "done"
+            elif found["delete"] != -1:
+                progress = "running"
+        elif actions == ["create", "delete"]:
+            if -1 != found["created"] < found["deleted"]:
+                progress = "done"
+            elif found["create"] != -1:
+                progress = "running"
+        elif actions == ["delete"]:
+            if found["deleted"] != -1:
+                progress = "done"
+            elif found["delete"] != -1:
+                progress = "running"
+        change["change"]["progress"] = progress
+    return changes
+
+
+def make_plan(changes):
+    return {
+        "resource_changes": [
+            {
+                "address": address,
+                "type": "null_resource",
+                "change": {"actions": actions},
+            }
+            for address, actions in changes
+        ]
+    }
+
+
+def test_get_done_changes_search_results(missing_floating_ips_initial_plan):
+    terraform_apply_output = read_terraform_apply_log("missingfloatingips.mc.ca")
+    assert TerraformPlanParser.get_done_changes(
+        missing_floating_ips_initial_plan, terraform_apply_output
+    ) == search_done_changes(missing_floating_ips_initial_plan, terraform_apply_output)
+
+
+def test_get_done_changes_ordering():
+    plan = make_plan(
+        [
+            ("replaced", ["delete", "create"]),
+            ("created-first", ["delete", "create"]),
+            ("replacing", ["delete", "create"]),
+            ("create-before-destroy", ["create", "delete"]),
+            ("destroyed-first", ["create", "delete"]),
+            ("module.openstack.null_resource.updated", ["update"]),
+            ("null_resource.updated", ["update"]),
+            ("module.openstack.null_resource.running", ["create"]),
+            ('module.openstack.null_resource.instances["node 1"]', ["delete"]),
+        ]
+    )
+    terraform_apply_output = "\n".join(
+        [
+            "created-first: Creation complete after 1s",
+            "replaced: Destroying... [id=1]",
+            "replacing: Destroying... [id=2]",
+            "replaced: Destruction complete after 1s",
+            "replaced: Creating...",
+            "replaced: Creation complete after 2s [id=3]",
+            "created-first: Destruction complete after 1s",
+            "destroyed-first: Destruction complete after 1s",
+            "destroyed-first: Creation complete after 1s",
+            "create-before-destroy: Creation complete after 1s",
+            "create-before-destroy: Destruction complete after 1s",
+            "\x1b[0m\x1b[1mmodule.openstack.null_resource.updated: "
+            "Modifications complete after 1s\x1b[0m",
+            "module.openstack.null_resource.running: Creating...",
+            '  module.openstack.null_resource.instances["node 1"]: Destroying...',
+        ]
+    )
+    progress = {
+        change["address"]: change["change"]["progress"]
+        for change in TerraformPlanParser.get_done_changes(plan, terraform_apply_output)
+    }
+    assert progress == {
+        "replaced": "done",
+        "created-first": "queued",
+        "replacing": "running",
+        "create-before-destroy": "done",
+        "destroyed-first": "queued",
+        "module.openstack.null_resource.updated": "done",
+        # Found within the address of the module resource, as by a text search
+        "null_resource.updated": "done",
+        "module.openstack.null_resource.running": "running",
+        'module.openstack.null_resource.instances["node 1"]': "running",
+    }
+    assert TerraformPlanParser.get_done_changes(
+        plan, terraform_apply_output
+    ) == search_done_changes(plan, terraform_apply_output)
+
+
+class CountingOutput(str):
+    """
+    Apply output counting how many times it is searched.
+    """
+
+    searches = 0
+
+    def find(self, *args):
+        CountingOutput.searches += 1
+        return super().find(*args)
+
+    def rfind(self, *args):
+        CountingOutput.searches += 1
+        return super().rfind(*args)
+
+
+def count_searches(get_changes, plan, terraform_apply_output):
+    CountingOutput.searches = 0
+    changes = get_changes(plan, CountingOutput(terraform_apply_output))
+    return changes, CountingOutput.searches
+
+
+def test_get_done_changes_searches():
+    """
+    The apply output is scanned once, whatever the number of resources of the plan.
+    """
+    actions = [["create"], ["update"], ["delete"], ["delete", "create"]]
+    changes = [
+        (
+            f'module.openstack.null_resource.instances["node{index}"]',
+            actions[index % len(actions)],
+        )
+        for index in range(600)
+    ]
+    terraform_apply_output = "".join(
+        f'module.openstack.null_resource.instances["node{index}"]: {text}\n'
+        for text in [
+            "Destroying... [id=1234]",
+            "Destruction complete after 3s",
+            "Creating...",
+            "Modifying... [id=1234]",
+            "Still creating... [10s elapsed]\n" * 8,
+            "Creation complete after 12s [id=5678]",
+            "Modifications complete after 2s [id=1234]",
+        ]
+        for index in range(0, 600, 2)
+    )
+    plan = make_plan(changes[:60])
+    larger_plan = make_plan(changes)
+
+    indexed, index_searches = count_searches(
+        TerraformPlanParser.get_done_changes, plan, terraform_apply_output
+    )
+    _, larger_index_searches = count_searches(
+        TerraformPlanParser.get_done_changes, larger_plan, terraform_apply_output
+    )
+    searched, search_searches = count_searches(
+        search_done_changes, plan, terraform_apply_output
+    )
+    _, larger_search_searches = count_searches(
+        search_done_changes, larger_plan, terraform_apply_output
+    )
+    assert indexed == searched
+    assert index_searches == larger_index_searches
+    assert search_searches * 10 == larger_search_searches
+
+
+def hook(type, address, action, **kwargs):
+    return {
+        "type": type,
+        "hook": {"resource": {"addr": address}, "action": action, **kwargs},
+    }
+
+
+def test_get_planned_changes():
+    events = TerraformPlanParser.parse_json_log(
+        "\n".join(
+            json.dumps(event)
+            for event in [
+                {"type": "version", "terraform": "1.1.9"},
+                {
+                    "type": "planned_change",
+                    "change": {
+                        "resource": {
+                            "addr": 'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+                            "resource_type": "openstack_compute_instance_v2",
+                        },
+                        "action": "replace",
+                    },
+                },
+                {
+                    "type": "change_summary",
+                    "changes": {
+                        "add": 1,
+                        "change": 0,
+                        "remove": 1,
+                        "operation": "plan",
+                    },
+                },
+            ]
+        )
+        + '\n{"type": "unfinished'
+    )
+    assert TerraformPlanParser.get_planned_changes(events) == {
+        "resource_changes": [
+            {
+                "address": 'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+                "type": "openstack_compute_instance_v2",
+                "change": {"actions": ["delete", "create"]},
+            }
+        ],
+        "change_summary": {"add": 1, "change": 0, "remove": 1, "operation": "plan"},
+    }
+
+
+def test_get_applied_changes():
+    plan = {
+        "resource_changes": [
+            {
+                "address": address,
+                "type": "null_resource",
+                "change": {"actions": actions},
+            }
+            for address, actions in [
+                ("done", ["create"]),
+                ("running", ["update"]),
+                ("queued", ["create"]),
+                ("replaced", ["delete", "create"]),
+                ("half-replaced", ["delete", "create"]),
+                ("failed", ["create"]),
+                ("unchanged", ["no-op"]),
+            ]
+        ]
+    }
+    events = [
+        hook("apply_start", "done", "create"),
+        hook("apply_complete", "done", "create", elapsed_seconds=2),
+        hook("apply_start", "running", "update"),
+        hook("apply_progress", "running", "update", elapsed_seconds=10),
+        hook("apply_complete", "replaced", "delete", elapsed_seconds=1),
+        hook("apply_complete", "replaced", "create", elapsed_seconds=3),
+        hook("apply_complete", "half-replaced", "delete", elapsed_seconds=1),
+        hook("apply_start", "failed", "create"),
+        hook("apply_errored", "failed", "create", elapsed_seconds=5),
+        {
+            "type": "diagnostic",
+            "diagnostic": {
+                "severity": "error",
+                "summary": "Error creating resource",
+                "detail": "Quota exceeded",
+                "address": "failed",
+            },
+        },
+    ]
+    progress = {
+        change["address"]: change["change"]
+        for change in TerraformPlanParser.get_applied_changes(plan, events)
+    }
+    assert progress["done"] == {
+        "actions": ["create"],
+        "progress": "done",
+        "elapsed_seconds": 2,
+    }
+    assert progress["running"] == {
+        "actions": ["update"],
+        "progress": "running",
+        "elapsed_seconds": 10,
+    }
+    assert progress["queued"] == {"actions": ["create"], "progress": "queued"}
+    assert progress["replaced"]["progress"] == "done"
+    assert progress["replaced"]["elapsed_seconds"] == 4
+    assert progress["half-replaced"]["progress"] == "running"
+    assert progress["failed"] == {
+        "actions": ["create"],
+        "progress": "error",
+        "elapsed_seconds": 5,
+        "error": {"summary": "Error creating resource", "detail": "Quota exceeded"},
+    }
+    assert progress["unchanged"]["progress"] == "done"
+
+
+def test_is_json_log():
+    assert TerraformPlanParser.is_json_log('{"type": "version"}\n')
+    assert not TerraformPlanParser.is_json_log(
+        read_terraform_apply_log("missingfloatingips.mc.ca")
+    )
+    assert not TerraformPlanParser.is_json_log("")
+
+
+def test_get_drifted_resources():
+    events = [
+        {"type": "version", "terraform": "1.1.9"},
+        {
+            "type": "resource_drift",
+            "change": {
+                "resource": {
+                    "addr": 'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+                    "resource_type": "openstack_compute_instance_v2",
+                },
+                "action": "delete",
+            },
+        },
+        {
+            "type": "change_summary",
+            "changes": {"add": 0, "change": 0, "remove": 0, "operation": "plan"},
+        },
+    ]
+    assert TerraformPlanParser.get_drifted_resources(events) == [
+        {
+            "address": 'module.openstack.openstack_compute_instance_v2.instances["node1"]',
+            "type": "openstack_compute_instance_v2",
+            "action": "delete",
+        }
+    ]
@@ -0,0 +1,283 @@
+import resource
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from subprocess import CalledProcessError
+
+from mchub.models.terraform.terraform_process import (
+    run,
+    ResourceLimits,
+    TerraformCancelledError,
+    TerraformSupervisor,
+    TerraformTimeoutError,
+)
+
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(mocker):
+    mocker.patch(
+        "mchub.models.terraform.terraform_process.CANCEL_POLL_INTERVAL", new=0.05
+    )
+    mocker.patch("mchub.models.terraform.terraform_process.KILL_TIMEOUT", new=0.2)
+
+
+class FakeJob:
+    def __init__(self, cancelled=lambda: False):
+        self.is_cancel_requested = cancelled
+        self.peak_memory = None
+
+    def record_peak_memory(self, peak_memory):
+        self.peak_memory = max(peak_memory, self.peak_memory or 0)
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_run_not_cancelled():
+    result = run(python("print('done')"), capture_output=True, job=FakeJob())
+    assert result.returncode == 0
+    assert result.stdout == b"done\n"
+
+    with pytest.raises(CalledProcessError) as error:
+        run(python("exit(3)"), check=True, job=FakeJob())
+    assert not isinstance(error.value, TerraformCancelledError)
+
+
+def test_run_cancelled_gracefully(tmp_path):
+    state = tmp_path / "terraform.tfstate"
+    ready = tmp_path / "ready"
+    code = f"""
+import signal, sys, time
+def stop(signum, frame):
+    open({str(state)!r}, "w").write("partial")
+    sys.exit(1)
+signal.signal(signal.SIGINT, stop)
+open({str(ready)!r}, "w").close()
+time.sleep(30)
+"""
+    with pytest.raises(TerraformCancelledError):
+        run(python(code), check=True, job=FakeJob(ready.exists))
+    assert state.read_text() == "partial"
+
+
+def test_run_cancelled_escalates(mocker, tmp_path):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"cancel_timeout": 0})
+    ready = tmp_path / "ready"
+    code = f"""
+import signal, time
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+open({str(ready)!r}, "w").close()
+time.sleep(30)
+"""
+    with pytest.raises(TerraformCancelledError) as error:
+        run(python(code), check=True, job=FakeJob(ready.exists))
+    assert error.value.returncode < 0
+
+
+def test_run_timeout():
+    with pytest.raises(TerraformTimeoutError):
+        run(python("import time; time.sleep(30)"), check=True, timeout=0.2)
+
+
+def test_run_streams_output(tmp_path):
+    log = tmp_path / "terraform.log"
+    chunks = []
+    code = "import sys; print('out'); print('err', file=sys.stderr)"
+    with open(log, "w") as output_file:
+        terraform_run = TerraformSupervisor.start(
+            python(code),
+            stdout=output_file,
+            stderr=output_file,
+            on_output=chunks.append,
+        )
+        assert terraform_run.wait(10)
+    assert terraform_run.result(check=True).returncode == 0
+    assert sorted(log.read_text().split()) == ["err", "out"]
+    assert sorted(b"".join(chunks).split()) == [b"err", b"out"]
+
+
+def test_supervisor_runs_concurrently_with_constant_threads():
+    TerraformSupervisor.get_loop()
+    threads = threading.active_count()
+    completed = []
+    runs = [
+        TerraformSupervisor.start(
+            python(f"import time; time.sleep(0.2); print({index})"),
+            capture_output=True,
+        )
+        for index in range(20)
+    ]
+    for terraform_run in runs:
+        terraform_run.future.add_done_callback(completed.append)
+    assert threading.active_count() <= threads + 1
+    for index, terraform_run in enumerate(runs):
+        assert terraform_run.wait(30)
+        assert terraform_run.result(check=True).stdout == f"{index}\n".encode()
+    assert len(completed) == 20
+
+
+def test_supervisor_cancelled_check():
+    terraform_run = TerraformSupervisor.start(
+        python("import time; time.sleep(30)"), cancelled=lambda: True
+    )
+    assert terraform_run.wait(10)
+    with pytest.raises(TerraformCancelledError):
+        terraform_run.result(check=True)
+
+
+def test_run_records_peak_memory():
+    job = FakeJob()
+    run(python("data = bytearray(64 * 2**20)"), check=True, job=job)
+    assert job.peak_memory >= 64 * 2**20
+
+
+def test_run_reaped_by_another_waiter(mocker):
+    """
+    Under gevent.monkey.patch_all(), the SIGCHLD watcher of gevent may reap terraform
+    before the supervisor does.
+    """
+    import os
+
+    started = []
+    wait4 = os.wait4
+
+    def reaped_by_watcher(pid, options):
+        # Like the watcher of gevent, which records the exit code in the Popen
+        _, status, _ = wait4(pid, 0)
+        started[0].returncode = os.waitstatus_to_exitcode(status)
+        raise ChildProcessError
+
+    mocker.patch(
+        "mchub.models.terraform.terraform_process.os.wait4",
+        side_effect=reaped_by_watcher,
+    )
+    job = FakeJob()
+    result = run(python("exit(3)"), job=job, on_start=started.append)
+    assert result.returncode == 3
+    assert job.peak_memory == 0
+
+
+def test_run_under_gevent():
+    """
+    Runs a command from a process patched by gevent, like the gevent workers of gunicorn.
+    """
+    pytest.importorskip("gevent")
+    import json
+
+    from ...mocks.configuration.config_mock import BASE_CONFIGURATION
+
+    script = f"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import json
+
+import mchub.configuration
+from mchub.models.terraform.terraform_process import run
+
+mchub.configuration._config = json.loads({json.dumps(BASE_CONFIGURATION)!r})
+for _ in range(5):
+    assert run([{sys.executable!r}, "-c", "exit(3)"]).returncode == 3
+result = run([{sys.executable!r}, "-c", "print('ran')"], capture_output=True)
+assert result.stdout == b"ran\\n"
+"""
+    result = subprocess.run(python(script), capture_output=True, timeout=60)
+    assert result.returncode == 0, result.stderr.decode()
+
+
+def test_run_waits_for_free_memory(mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"terraform_min_free_memory": 100})
+    available_memory = mocker.patch(
+        "mchub.models.terraform.terraform_process.get_available_memory",
+        side_effect=[50 * 2**20, 80 * 2**20, 200 * 2**20],
+    )
+    mocker.patch(
+        "mchub.models.terraform.terraform_process.ADMISSION_POLL_INTERVAL", new=0.01
+    )
+    run(python("pass"), check=True)
+    assert available_memory.call_count == 3
+
+
+def test_run_cancelled_while_waiting_for_memory(mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"terraform_min_free_memory": 100})
+    mocker.patch(
+        "mchub.models.terraform.terraform_process.get_available_memory",
+        return_value=0,
+    )
+    popen = mocker.patch("mchub.models.terraform.terraform_process.Popen")
+    with pytest.raises(TerraformCancelledError):
+        run(python("pass"), check=True, job=FakeJob(lambda: True))
+    popen.assert_not_called()
+
+
+def test_resource_limits_without_cgroup(mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(
+        get_config(), {"terraform_memory_limit": 512, "terraform_cpu_limit": 1}
+    )
+    # The command runs once its resources are limited
+    result = run(
+        python(
+            "import os, resource;"
+            "print(resource.getrlimit(resource.RLIMIT_DATA)[0], os.nice(0))"
+        ),
+        capture_output=True,
+        check=True,
+    )
+    assert result.stdout.split() == [str(512 * 2**20).encode(), b"10"]
+
+
+def test_resource_limits_not_applied(mocker, caplog):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"terraform_memory_limit": 512})
+    mocker.patch(
+        "mchub.models.terraform.terraform_process.resource.prlimit",
+        side_effect=PermissionError("Operation not permitted"),
+    )
+    result = run(python("print('ran')"), capture_output=True)
+    assert result.stdout == b"ran\n"
+    assert "Could not limit the resources of terraform" in caplog.text
+
+
+def test_resource_limits_cgroup(mocker, tmp_path):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(
+        get_config(),
+        {
+            "terraform_memory_limit": 512,
+            "terraform_cpu_limit": 1.5,
+            "terraform_cgroup": str(tmp_path),
+        },
+    )
+    limits = ResourceLimits()
+    limits.prepare()
+    (group,) = tmp_path.iterdir()
+    assert (group / "memory.max").read_text() == str(512 * 2**20)
+    assert (group / "cpu.max").read_text() == "150000 100000"
+
+    # The process joins the cgroup from the parent
+    process = subprocess.Popen(python("pass"))
+    limits.apply(process.pid)
+    process.wait()
+    assert (group / "cgroup.procs").read_text() == str(process.pid)
+
+    (group / "memory.peak").write_text("1000")
+    assert limits.get_peak_memory(None) == 1000
@@ -0,0 +1,81 @@
+import pytest
+
+from os import makedirs, path
+
+from mchub.models.terraform.terraform_cache import TerraformCache
+from mchub.models.terraform.workspace_pool import WorkspacePool
+
+from ...mocks.configuration.config_mock import (
+    config_auth_none_mock as config_mock,
+)  # noqa;
+
+
+def fake_init(process_args, *args, cwd=None, **kwargs):
+    makedirs(path.join(cwd, ".terraform", "modules"))
+
+
+@pytest.fixture
+def pool(mocker, tmp_path):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"workspace_pool_size": 2})
+    mocker.patch("mchub.configuration.env.CLUSTERS_PATH", new=str(tmp_path))
+    mocker.patch.object(WorkspacePool, "hits", new=WorkspacePool.hits.copy())
+    mocker.patch.object(WorkspacePool, "misses", new=WorkspacePool.misses.copy())
+    mocker.patch.object(WorkspacePool, "refill_async")
+    return mocker.patch(
+        "mchub.models.terraform.workspace_pool.run", side_effect=fake_init
+    )
+
+
+def test_refill(pool):
+    modules = TerraformCache.get_sources("openstack", "cloudflare")
+    WorkspacePool.refill(modules)
+    assert len(WorkspacePool.get_ready(modules)) == 2
+    WorkspacePool.refill(modules)
+    assert pool.call_count == 2
+
+
+def test_take(pool, tmp_path):
+    modules = TerraformCache.get_sources("openstack", "cloudflare")
+    WorkspacePool.refill(modules)
+    cluster_path = str(tmp_path / "test.magic-castle.cloud")
+    assert WorkspacePool.take(cluster_path, "openstack", "cloudflare")
+    assert path.isdir(path.join(cluster_path, ".terraform"))
+    assert path.exists(path.join(cluster_path, "main.tf.json"))
+    assert len(WorkspacePool.get_ready(modules)) == 1
+    WorkspacePool.refill_async.assert_called_once_with(modules)
+    # The cluster directory already exists
+    assert not WorkspacePool.take(cluster_path, "openstack", "cloudflare")
+
+
+def test_take_empty(pool, tmp_path):
+    cluster_path = str(tmp_path / "test.magic-castle.cloud")
+    assert not WorkspacePool.take(cluster_path, "openstack", "gcloud")
+    assert not path.exists(cluster_path)
+    key = TerraformCache.get_key(TerraformCache.get_sources("openstack", "gcloud"))
+    assert WorkspacePool.misses[key] == 1
+
+
+def test_take_disabled(pool, tmp_path, mocker):
+    from mchub.configuration import get_config
+
+    mocker.patch.dict(get_config(), {"workspace_pool_size": 0})
+    assert not WorkspacePool.take(str(tmp_path / "cluster"), "openstack", "gcloud")
+    WorkspacePool.refill_async.assert_not_called()
+
+
+def test_metrics(pool, tmp_path):
+    WorkspacePool.refill(TerraformCache.get_sources("openstack", "cloudflare"))
+    WorkspacePool.take(str(tmp_path / "cluster"), "openstack", "cloudflare")
+    metrics = {pool["dns_module"]: pool for pool in WorkspacePool.metrics().values()}
+    assert set(metrics) == {None, "cloudflare", "gcloud"}
+    assert metrics["cloudflare"] == {
+        "provider": "openstack",
+        "dns_module": "cloudflare",
+        "ready": 1,
+        "size": 2,
+        "hits": 1,
+        "misses": 0,
+    }
+    assert metrics["gcloud"]["ready"] == 0
@@ -4,6 +4,7 @@ from ...test_helpers import (
     app,
     generate_test_clusters,
     fake_successful_subprocess_run,
+    inline_job_queue,
     mock_clusters_path,
 )  # noqa
 from ...mocks.configuration.config_mock import (
@@ -9,6 +9,7 @@ from ...test_helpers import (
     bob,
     admin,
     fake_successful_subprocess_run,
+    inline_job_queue,
 )  # noqa
 
 from ...mocks.configuration.config_mock import (